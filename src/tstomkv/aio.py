@@ -0,0 +1,229 @@
+"""asyncio encodes for tstomkv
+
+ffmpeg and ffprobe are run as asyncio subprocesses and their progress is
+followed with asyncio sleeps, so one event loop can drive many encodes
+alongside the fetches and uploads that pipeline.AsyncPipeline runs in
+threads. Cancelling an encode kills its ffmpeg.
+"""
+
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+from tstomkv import errorRaise, probecache, progressBar
+from tstomkv.ffmpeg import (
+    checkOutputFile,
+    probeCommand,
+    probeResult,
+    transcodeCommand,
+)
+from tstomkv.metrics import encodeFigures, fileSize, measure
+from tstomkv.progress import END, EXITED, PROGRESS, ProgressWatch
+from tstomkv.stages import (
+    CopyError,
+    EncoderHandle,
+    encodeFinish,
+    encodeResult,
+    encodePlan,
+    markState,
+    progressSummary,
+    removeFileIfExists,
+    startUpload,
+)
+
+
+async def runProcess(cmd):
+    """run cmd, returns (returncode, stdout, stderr), killing it if cancelled"""
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = await proc.communicate()
+    except asyncio.CancelledError:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        raise
+    return proc.returncode, stdout, stderr
+
+
+async def probeInfo(fqfn):
+    """ffmpeg.fileInfo, probing with an asyncio subprocess"""
+    try:
+        if not os.path.exists(fqfn):
+            return None
+        cached = probecache.cache.get(fqfn)
+        if cached is not None:
+            return cached
+        returncode, stdout, _ = await runProcess(probeCommand(fqfn))
+        return probeResult(fqfn, returncode, stdout)
+    except Exception as e:
+        errorRaise(sys.exc_info()[2], e)
+
+
+async def progressEvents(statsfile, alive=None, interval=5, stall=600, startup=60):
+    """progress.progressEvents, waiting with asyncio sleeps"""
+    watch = ProgressWatch(statsfile, alive, interval, stall, startup)
+    while True:
+        events, wait = watch.poll()
+        for event in events:
+            yield event
+        if wait is None:
+            return
+        await asyncio.sleep(wait)
+
+
+async def doStats(statsfile, duration, alive=None, interval=5):
+    """stages.doStats for an asyncio encode"""
+    last = None
+    async for event in progressEvents(statsfile, alive=alive, interval=interval):
+        last = event
+        if event.kind == PROGRESS and duration and event.out_time is not None:
+            progressBar(event.out_time, duration)
+    return progressSummary(last, statsfile, duration)
+
+
+async def transcodeFile(
+    src, dst, statsfile, overwrite=False, x265params=None, profile=None
+):
+    """stages.transcodeFile with ffmpeg as an asyncio subprocess
+
+    returns True if ffmpeg exited cleanly.
+    """
+    if not src.lower().endswith(".ts"):
+        raise ValueError("Input file must be a .ts file")
+    Path(os.path.dirname(dst)).mkdir(mode=0o755, exist_ok=True, parents=True)
+    checkOutputFile(dst, overwrite=overwrite)
+    print(f"Transcoding {src} to {dst}...")
+    cmd = transcodeCommand(src, dst, statsfile, x265params=x265params, profile=profile)
+    returncode, _, _ = await runProcess(cmd)
+    print(f"Conversion complete: {dst}")
+    return returncode == 0
+
+
+async def runEncode(job, plan, interval=5):
+    """run the planned encode, following its progress if it has a stats file
+
+    raises CopyError if the encode stops making progress, which stops its
+    ffmpeg, or if ffmpeg fails.
+    """
+    encoder = None
+    async with asyncio.TaskGroup() as tg:
+        if plan["mode"] == "file":
+            runner = tg.create_task(transcodeFile(*plan["args"], **plan["kwargs"]))
+        else:
+            kwargs = plan["kwargs"]
+            if plan["mode"] == "stream":
+                # cancelling the thread wouldn't stop its ffmpeg
+                encoder = EncoderHandle()
+                kwargs = dict(kwargs, started=encoder.started)
+            runner = tg.create_task(
+                asyncio.to_thread(plan["target"], *plan["args"], **kwargs)
+            )
+        if plan["mode"] in ("segmented", "remote"):
+            # these report their own progress rather than in a local stats file
+            job["progress"] = None
+        else:
+            job["progress"] = await doStats(
+                plan["statsfile"],
+                plan["duration"],
+                alive=lambda: not runner.done(),
+                interval=interval,
+            )
+            if job["progress"].kind not in (END, EXITED):
+                if encoder is not None:
+                    await asyncio.to_thread(encoder.stop)
+                # kills the ffmpeg of a file encode, see runProcess
+                runner.cancel()
+    if runner.cancelled():
+        raise CopyError(f"Gave up on the encode of {plan['args'][0]}")
+    encodeResult(plan, runner.result())
+
+
+async def acquireCores(budget, n):
+    """budget.acquire(n) in a thread. If cancelled whilst waiting the cores
+    are given back as soon as the thread gets them."""
+    acquiring = asyncio.ensure_future(asyncio.to_thread(budget.acquire, n))
+
+    def giveBack(fut):
+        if not fut.cancelled() and fut.exception() is None:
+            budget.release(n)
+
+    try:
+        await asyncio.shield(acquiring)
+    except asyncio.CancelledError:
+        acquiring.add_done_callback(giveBack)
+        raise
+
+
+async def encodeStage(
+    job,
+    budget=None,
+    streamoutput=False,
+    cfg=None,
+    segments=1,
+    segmentmin=3600,
+    coordinator=None,
+    verify=None,
+    interval=5,
+):
+    """stages.encodeStage for pipeline.AsyncPipeline
+
+    a fetched recording is probed and encoded by asyncio subprocesses.
+    segmented, remote and streamed encodes, which drive their own
+    subprocesses, run in a thread, as do the checks of the finished mkv.
+    """
+    fps = job["fps"]
+    if not job.get("streaminput"):
+        # the plan's probes then come from the cache
+        await probeInfo(str(fps["dest"]))
+    plan = await asyncio.to_thread(
+        encodePlan,
+        job,
+        budget=budget,
+        cfg=cfg,
+        segments=segments,
+        segmentmin=segmentmin,
+        coordinator=coordinator,
+    )
+    if plan is None:
+        return job
+    threads = plan["threads"]
+    # a stats file left by an earlier run would look like a finished encode
+    removeFileIfExists(plan["statsfile"])
+    upload = None
+    if budget is not None:
+        await acquireCores(budget, threads)
+    try:
+        plan["started"] = time.time()
+        if threads is not None:
+            print(f"Encoding {fps['src']} using {threads} cores")
+        if streamoutput:
+            upload = await asyncio.to_thread(startUpload, job)
+        with measure(job, "encode") as step:
+            try:
+                await runEncode(job, plan, interval)
+            except ExceptionGroup as eg:
+                raise eg.exceptions[0]
+            step["bytes"] = fileSize(fps["destmkv"])
+            encodeFigures(step, job["progress"])
+        markState(job, "encoded")
+        if upload is not None:
+            resent = await asyncio.to_thread(upload.finish)
+            print(f"Upload of {fps['srcmkv']} caught up, {resent} bytes re-sent")
+    except BaseException:
+        if upload is not None:
+            await asyncio.to_thread(upload.abort)
+        raise
+    finally:
+        if budget is not None:
+            budget.release(threads)
+    await probeInfo(str(fps["destmkv"]))
+    return await asyncio.to_thread(
+        encodeFinish, job, plan, upload=upload, verify=verify
+    )
@@ -0,0 +1,368 @@
+"""throughput benchmarks for tstomkv
+
+Synthetic transport streams are made with ffmpeg's lavfi sources (SD
+mpeg2 and HD h264 or hevc, with one or more audio tracks, of various
+lengths) and each is taken through the stages a recording goes through:
+probe, fetch, encode, verify and upload. The transfers go through a
+loopback sftp stand-in over the local filesystem, so the chunking,
+hashing and manifest code is measured without a media server.
+
+The wall and cpu time of each stage is written as json, and two result
+files can be compared to catch a version that has got slower:
+
+    tsbench run -o before.json
+    tsbench run -o after.json
+    tsbench compare before.json after.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from importlib import metadata
+
+from tstomkv import __appname__, errorNotify, probecache
+from tstomkv.cores import coreCount, x265Params
+from tstomkv.ffmpeg import checkDuration, convert_ts_to_mkv, fileInfo, infoDuration
+from tstomkv.profiles import chooseProfile, copyDecision
+from tstomkv.transfer import ChunkedTransfer
+
+# name: (frame height, seconds, video codec, audio codec, audio tracks)
+SAMPLES = {
+    "sd-30s": (576, 30, "mpeg2video", "mp2", 1),
+    "sd-120s-3audio": (576, 120, "mpeg2video", "mp2", 3),
+    "hd-30s": (1080, 30, "h264", "aac", 2),
+    "hd-120s": (1080, 120, "h264", "aac", 2),
+    "hd-hevc-30s": (1080, 30, "hevc", "aac", 1),
+}
+
+VIDEOENCODERS = {
+    "mpeg2video": ["-c:v", "mpeg2video", "-b:v", "4M", "-flags", "+ilme+ildct"],
+    "h264": ["-c:v", "libx264", "-preset", "veryfast", "-b:v", "8M"],
+    "hevc": ["-c:v", "libx265", "-preset", "ultrafast", "-b:v", "4M"],
+}
+
+# transfers of the small samples still need several chunks to exercise
+# the parallel channels
+CHUNKSIZE = 4 * 1024 * 1024
+
+# stages quicker than this are too noisy to call a regression
+MINSECONDS = 0.5
+
+
+class BenchError(Exception):
+    pass
+
+
+def sampleCommand(path, height, seconds, vcodec, acodec, tracks):
+    """the ffmpeg command line to make a synthetic transport stream"""
+    width = 720 if height <= 576 else height * 16 // 9
+    cmd = ["ffmpeg", "-y", "-loglevel", "error", "-f", "lavfi"]
+    cmd.append("-i")
+    cmd.append(f"testsrc2=size={width}x{height}:rate=25:duration={seconds}")
+    for track in range(tracks):
+        cmd.extend(["-f", "lavfi", "-i"])
+        cmd.append(f"sine=frequency={440 * (track + 1)}:duration={seconds}")
+    cmd.extend(["-map", "0:v"])
+    for track in range(tracks):
+        cmd.extend(["-map", f"{track + 1}:a"])
+    cmd.extend(VIDEOENCODERS[vcodec])
+    cmd.extend(["-c:a", acodec, "-b:a", "192k", "-ar", "48000"])
+    cmd.extend(["-f", "mpegts", path])
+    return cmd
+
+
+def makeSample(path, spec):
+    proc = subprocess.run(sampleCommand(path, *spec), capture_output=True)
+    if proc.returncode != 0:
+        raise BenchError(f"cannot make {path}: {proc.stderr.decode().strip()}")
+    return path
+
+
+class LoopbackFile:
+    """enough of paramiko's SFTPFile, over a local file"""
+
+    def __init__(self, path, mode):
+        self.fp = open(path, {"wb": "w+b", "r+": "r+b", "rb": "rb"}[mode])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.fp.close()
+
+    def set_pipelined(self, pipelined):
+        pass
+
+    def readv(self, chunks):
+        for off, n in chunks:
+            self.fp.seek(off)
+            yield self.fp.read(n)
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+
+class LoopbackSFTP:
+    """an sftp client whose media server is the local filesystem
+
+    with failon the link drops when the failon'th file is opened.
+    """
+
+    def __init__(self, failon=None):
+        self.failon = failon
+        self.opens = 0
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def open(self, path, mode):
+        self.opens += 1
+        if self.failon is not None and self.opens == self.failon:
+            raise EOFError("link dropped")
+        return LoopbackFile(path, mode)
+
+    def posix_rename(self, src, dst):
+        os.replace(src, dst)
+
+
+class LoopbackPool:
+    """stands in for connections.pool when transferring"""
+
+    @contextmanager
+    def sftp(self, host, user, keyfn):
+        yield LoopbackSFTP()
+
+
+@contextmanager
+def isolatedProbeCache(path):
+    """probe with an empty cache kept at path"""
+    saved = probecache.cache
+    probecache.cache = probecache.ProbeCache(path)
+    try:
+        yield
+    finally:
+        probecache.cache = saved
+
+
+def cpuTime():
+    """cpu seconds used by this process and its children so far"""
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        ru = resource.getrusage(who)
+        total += ru.ru_utime + ru.ru_stime
+    return total
+
+
+def timed(sample, stage, func, *args, **kwargs):
+    """runs func, returns (its result, a result record)"""
+    cpu = cpuTime()
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    record = {
+        "sample": sample,
+        "stage": stage,
+        "seconds": round(time.perf_counter() - started, 4),
+        "cpu": round(cpuTime() - cpu, 4),
+        "ok": result is not False and result is not None,
+    }
+    return result, record
+
+
+def benchSample(name, spec, workdir, channels=4, cores=None):
+    """the result records for taking one sample through each stage"""
+    src = os.path.join(workdir, f"{name}.ts")
+    makeSample(src, spec)
+    seconds = spec[1]
+    records = []
+    with isolatedProbeCache(os.path.join(workdir, "probe.db")):
+        finfo, rec = timed(name, "probe", fileInfo, src)
+        records.append(rec)
+        _, rec = timed(name, "probe-cached", fileInfo, src)
+        records.append(rec)
+        fetched = os.path.join(workdir, f"{name}-fetched.ts")
+        _, rec = timed(name, "fetch", loopbackTransfer, src, fetched, "get", channels)
+        rec["bytes"] = os.path.getsize(src)
+        records.append(rec)
+        pname, profile = chooseProfile(finfo)
+        copyvideo, copyaudio, _ = copyDecision(finfo, profile)
+        profile.update(copyvideo=copyvideo, copyaudio=copyaudio)
+        mkv = os.path.join(workdir, f"{name}.mkv")
+        statsfile = os.path.join(workdir, f"{name}.stats")
+        x265params = None if cores is None else x265Params(cores)
+        ok, rec = timed(
+            name,
+            "encode",
+            convert_ts_to_mkv,
+            fetched,
+            mkv,
+            statsfile,
+            overwrite=True,
+            x265params=x265params,
+            profile=profile,
+        )
+        rec["ok"] = ok and os.path.exists(mkv)
+        rec["profile"] = pname
+        rec["speed"] = round(seconds / rec["seconds"], 3) if rec["seconds"] else None
+        rec["bytes"] = os.path.getsize(mkv) if rec["ok"] else 0
+        records.append(rec)
+        _, rec = timed(name, "verify", checkDuration, infoDuration(finfo), mkv)
+        records.append(rec)
+        uploaded = os.path.join(workdir, f"{name}-uploaded.mkv")
+        _, rec = timed(name, "upload", loopbackTransfer, mkv, uploaded, "put", channels)
+        rec["bytes"] = os.path.getsize(mkv)
+        records.append(rec)
+    for rec in records:
+        if "bytes" in rec and rec["stage"] in ("fetch", "upload") and rec["seconds"]:
+            rec["mbps"] = round(rec["bytes"] / rec["seconds"] / 1_000_000, 2)
+    return records
+
+
+def loopbackTransfer(src, dst, direction, channels):
+    xfer = ChunkedTransfer(
+        src,
+        dst,
+        direction=direction,
+        channels=channels,
+        chunksize=CHUNKSIZE,
+        server=("loopback", None, None),
+        sftppool=LoopbackPool(),
+    )
+    return xfer.run()
+
+
+def ffmpegVersion():
+    try:
+        proc = subprocess.run(["ffmpeg", "-version"], capture_output=True)
+        return proc.stdout.decode().split("\n")[0]
+    except FileNotFoundError:
+        return None
+
+
+def packageVersion():
+    try:
+        return metadata.version(__appname__)
+    except metadata.PackageNotFoundError:
+        return "0.0.0"
+
+
+def runBench(names=None, channels=4, cores=None, keep=None):
+    """benchmark the named samples (default all), returns the results dict"""
+    names = list(SAMPLES) if not names else names
+    unknown = [n for n in names if n not in SAMPLES]
+    if len(unknown) > 0:
+        raise BenchError(f"unknown samples: {', '.join(unknown)}")
+    if shutil.which("ffmpeg") is None or shutil.which("ffprobe") is None:
+        raise BenchError("ffmpeg and ffprobe are needed to run the benchmarks")
+    workdir = tempfile.mkdtemp(prefix=f"{__appname__}-bench-", dir=keep)
+    results = {
+        "version": packageVersion(),
+        "python": platform.python_version(),
+        "ffmpeg": ffmpegVersion(),
+        "host": platform.node(),
+        "cores": coreCount(),
+        "channels": channels,
+        "created": time.time(),
+        "results": [],
+    }
+    try:
+        for name in names:
+            print(f"benchmarking {name}", flush=True)
+            results["results"].extend(
+                benchSample(name, SAMPLES[name], workdir, channels, cores)
+            )
+    finally:
+        if keep is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compareResults(old, new, threshold=0.1, minseconds=MINSECONDS):
+    """the stages that took more than threshold longer in new than in old
+
+    returns a list of {"sample", "stage", "old", "new", "change"} dicts.
+    """
+    before = {(r["sample"], r["stage"]): r for r in old["results"]}
+    regressions = []
+    for rec in new["results"]:
+        was = before.get((rec["sample"], rec["stage"]))
+        if was is None or was["seconds"] < minseconds:
+            continue
+        change = (rec["seconds"] - was["seconds"]) / was["seconds"]
+        if change > threshold:
+            regressions.append(
+                {
+                    "sample": rec["sample"],
+                    "stage": rec["stage"],
+                    "old": was["seconds"],
+                    "new": rec["seconds"],
+                    "change": round(change, 3),
+                }
+            )
+    return regressions
+
+
+def printResults(results):
+    for rec in results["results"]:
+        extra = ""
+        if rec.get("speed") is not None:
+            extra = f" {rec['speed']}x realtime"
+        elif rec.get("mbps") is not None:
+            extra = f" {rec['mbps']}MB/s"
+        status = "" if rec["ok"] else " FAILED"
+        print(
+            f"{rec['sample']:16} {rec['stage']:13} {rec['seconds']:9.3f}s"
+            f" cpu {rec['cpu']:9.3f}s{extra}{status}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="tsbench", description=__doc__.split("\n")[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run", help="run the benchmarks")
+    run.add_argument("-o", "--output", help="write the results to this json file")
+    run.add_argument("-s", "--sample", action="append", choices=list(SAMPLES))
+    run.add_argument("-c", "--channels", type=int, default=4)
+    run.add_argument("--cores", type=int, help="limit x265 to this many cores")
+    run.add_argument("--keep", help="make and keep the samples in this directory")
+    cmp = sub.add_parser("compare", help="compare two result files")
+    cmp.add_argument("old")
+    cmp.add_argument("new")
+    cmp.add_argument("-t", "--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+    try:
+        if args.command == "run":
+            results = runBench(args.sample, args.channels, args.cores, args.keep)
+            printResults(results)
+            if args.output:
+                with open(args.output, "w") as fp:
+                    json.dump(results, fp, indent=2)
+            if not all(rec["ok"] for rec in results["results"]):
+                sys.exit(1)
+        else:
+            with open(args.old) as fp:
+                old = json.load(fp)
+            with open(args.new) as fp:
+                new = json.load(fp)
+            regressions = compareResults(old, new, args.threshold)
+            for reg in regressions:
+                print(
+                    f"{reg['sample']} {reg['stage']}: {reg['old']}s -> {reg['new']}s"
+                    f" ({reg['change']:+.0%})"
+                )
+            if len(regressions) > 0:
+                sys.exit(1)
+            print("no regressions")
+    except BenchError as e:
+        print(e)
+        sys.exit(2)
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+        sys.exit(2)
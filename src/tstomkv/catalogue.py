@@ -0,0 +1,163 @@
+"""local catalogue of tvheadend recordings for tstomkv
+
+The finished recordings, tidied (see recordings.tidyRecording), are kept
+in a sqlite database keyed on their uuid. A sync only asks tvheadend for
+the recordings that have finished since the latest one already in the
+catalogue, so a run's start up, and the load it puts on tvheadend, don't
+grow with the size of the library. Deletions are noticed when tvheadend's
+count of finished recordings no longer matches the catalogue's, which
+triggers a full sync, as does a catalogue that hasn't had one in a week.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from tstomkv import __appname__
+from tstomkv.recordings import tidyRecording
+from tstomkv.tvh import tvhClient
+
+ROUTE = "dvr/entry/grid_finished"
+
+# recordings that finished this close to the watermark are fetched again,
+# in case tvheadend was still writing them out at the last sync
+SLACK = 60
+
+# seconds between full syncs
+FULLSYNC = 7 * 24 * 60 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS recordings (
+    uuid TEXT PRIMARY KEY,
+    filename TEXT,
+    start_real REAL NOT NULL DEFAULT 0,
+    stop_real REAL NOT NULL DEFAULT 0,
+    rec TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def cataloguePath():
+    cachehome = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cachehome, __appname__, "catalogue.db")
+
+
+class Catalogue:
+    """The tidied recordings, kept in the sqlite database at path."""
+
+    def __init__(self, path=None, client=None):
+        self.path = cataloguePath() if path is None else path
+        self._client = client
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.executescript(SCHEMA)
+
+    @property
+    def client(self):
+        return tvhClient() if self._client is None else self._client
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _execute(self, sql, args=()):
+        with self._lock, self._db:
+            return self._db.execute(sql, args).fetchall()
+
+    def _meta(self, key, default=None):
+        rows = self._execute("SELECT value FROM meta WHERE key = ?", (key,))
+        return default if len(rows) == 0 else float(rows[0][0])
+
+    def _setMeta(self, key, value):
+        self._execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+        )
+
+    def count(self):
+        return self._execute("SELECT COUNT(*) FROM recordings")[0][0]
+
+    def _store(self, rec):
+        show = tidyRecording(rec)
+        if show is None or show["uuid"] is None:
+            return None
+        self._execute(
+            "INSERT OR REPLACE INTO recordings"
+            " (uuid, filename, start_real, stop_real, rec) VALUES (?, ?, ?, ?, ?)",
+            (
+                show["uuid"],
+                show["filename"],
+                show["start_real"] or 0,
+                show["stop_real"] or 0,
+                json.dumps(show),
+            ),
+        )
+        return show
+
+    def _fetch(self, since=None):
+        data = {"sort": "stop_real", "dir": "ASC"}
+        if since is not None:
+            data["filter"] = json.dumps(
+                [
+                    {
+                        "type": "numeric",
+                        "field": "stop_real",
+                        "comparison": "gt",
+                        "value": int(since),
+                    }
+                ]
+            )
+        return self.client.entries(ROUTE, data)
+
+    def sync(self, full=False):
+        """bring the catalogue up to date, returns (changed, removed)"""
+        total = self.client.get(ROUTE, {"limit": 1}).get("total", 0)
+        watermark = self._meta("watermark")
+        lastfull = self._meta("fullsync", 0)
+        full = full or watermark is None or time.time() - lastfull > FULLSYNC
+        changed = removed = 0
+        if not full:
+            for rec in self._fetch(since=watermark - SLACK):
+                if self._store(rec) is not None:
+                    changed += 1
+            # something was deleted (or missed), only a full sync can tell what
+            full = self.count() != total
+        if full:
+            seen = set()
+            for rec in self._fetch():
+                show = self._store(rec)
+                if show is not None:
+                    seen.add(show["uuid"])
+            stored = [row[0] for row in self._execute("SELECT uuid FROM recordings")]
+            gone = [uuid for uuid in stored if uuid not in seen]
+            for uuid in gone:
+                self._execute("DELETE FROM recordings WHERE uuid = ?", (uuid,))
+            changed, removed = len(seen), len(gone)
+            self._setMeta("fullsync", time.time())
+        rows = self._execute("SELECT MAX(stop_real) FROM recordings")
+        self._setMeta("watermark", rows[0][0] or 0)
+        return changed, removed
+
+    def recordings(self):
+        """the tidied recordings, oldest first"""
+        rows = self._execute("SELECT rec FROM recordings ORDER BY start_real")
+        return [json.loads(row[0]) for row in rows]
+
+    def moved(self, src, dst):
+        """tvheadend has been told the recording at src is now at dst"""
+        for uuid, rec in self._execute(
+            "SELECT uuid, rec FROM recordings WHERE filename = ?", (src,)
+        ):
+            show = json.loads(rec)
+            show["filename"] = dst
+            self._execute(
+                "UPDATE recordings SET filename = ?, rec = ? WHERE uuid = ?",
+                (dst, json.dumps(show), uuid),
+            )
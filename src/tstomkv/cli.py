@@ -1,229 +1,303 @@
+import argparse
 import os
 import sys
 import time
-from pathlib import Path
-from threading import Thread
+from contextlib import nullcontext
+from functools import partial
 
 import tstomkv
-from tstomkv import errorNotify, progressBar
-from tstomkv.config import readConfig
-from tstomkv.ffmpeg import checkPercentDuration, convert_ts_to_mkv, videoDuration
-from tstomkv.files import (
-    getFile,
-    pathManipulation,
-    remoteCommand,
-    remoteFileList,
-    sendFile,
-    stopNow,
+from tstomkv import aio, errorNotify
+from tstomkv.catalogue import Catalogue
+from tstomkv.config import (
+    defaultSettings,
+    getConfig,
+    mediaServerSettings,
+    workerSettings,
 )
+from tstomkv.cores import CoreBudget
+from tstomkv.files import remoteFileSizes, stopNow
+from tstomkv.inventory import Inventory
+from tstomkv.ledger import Ledger
+from tstomkv.metrics import Metrics
+from tstomkv.pipeline import AsyncPipeline, Pipeline, Stage, pipelineSettings
+from tstomkv.profiles import configRules
+from tstomkv.profiling import Profiler
 from tstomkv.recordings import filteredTitles, recordedTitles
-from tstomkv.tvh import fileMoved
+from tstomkv.remote import encodeMode, mediaServerWorker, remoteEncodeStage
+from tstomkv.schedule import heightClass, probeJobs, scheduleJobs
+from tstomkv.stages import (
+    CopyError,
+    encodeStage,
+    fetchStage,
+    kodiJob,
+    tvhJob,
+    uploadStage,
+)
+from tstomkv.staging import StagingBudget
+from tstomkv.workers import Coordinator, makeWorkers
 
 
 class StopAll(Exception):
     pass
 
 
-class CopyError(Exception):
-    pass
+def openLedger(ps):
+    """the job ledger, by default kept in the transcodedir"""
+    path = ps["ledger"]
+    if path is None:
+        path = os.path.join(defaultSettings().transcodedir, "tstomkv-jobs.db")
+    return Ledger(path, maxattempts=ps["maxattempts"], backoff=ps["failbackoff"])
 
 
-def transcodeFile(src, dst, statsfile, overwrite=False):
-    """Initiate the transcoder for a given source file to a destination file"""
-    dirname = os.path.dirname(dst)
-    Path(dirname).mkdir(mode=0o755, exist_ok=True, parents=True)
-    return convert_ts_to_mkv(src, dst, statsfile, overwrite=overwrite)
-
-
-def doStats(statsfile, duration):
-    """Read the stats file and show a progress bar"""
-    cn = 0
-    holdoff = 5
-    while Path(statsfile).exists() is False:
-        time.sleep(holdoff)
-        cn += 1
-        if cn > 12:
-            print("No stats file after 1 minute, giving up")
-            return
-    if duration > 0:
-        inprogress = True
-        lastelapsed = 0
-        while inprogress:
-            time.sleep(holdoff)
-            with open(statsfile, "r") as sf:
-                stats = {}
-                lines = sf.readlines()
-                for line in lines:
-                    if "=" in line:
-                        k, v = line.strip().split("=", 1)
-                        stats[k] = v
-                if "out_time_ms" in stats:
-                    try:
-                        elapsed = int(stats["out_time_ms"]) / 1_000_000
-                    except ValueError:
-                        elapsed = lastelapsed
-                    lastelapsed = elapsed
-                    progressBar(elapsed, duration)
-                if "progress" in stats:
-                    if stats["progress"] == "end":
-                        inprogress = False
-        print()  # newline after progress bar
-        print("Transcoding complete")
-    else:
-        print("No duration info, cannot show progress")
+def openCatalogue(ps):
+    """the local catalogue of tvheadend recordings, None if turned off"""
+    if ps["catalogue"] in ("no", "off", "false"):
+        return None
+    return Catalogue(ps["catalogue"])
 
 
-def kodimkv():
-    print(f"{tstomkv.__appname__} version: {tstomkv.getVersion()}")
-    cfg = readConfig()
-    files = remoteFileList()
-    print(f"{len(files)} Remote files")
-    if len(sys.argv) > 1:
-        skip = int(sys.argv[1])
-    for src in files:
-        # isfilm = False
-        if len(sys.argv) > 1:
-            if skip > 0:
-                print(f"Skipping {src}")
-                skip -= 1
-                continue
-        if stopNow():
-            raise StopAll("STOP file found, exiting")
-        if cfg["mediaserver"].get("koditvdir") in src:
-            replace = cfg["mediaserver"]["koditvdir"]
-            # dest = src.replace(
-            #     cfg["mediaserver"]["koditvdir"], cfg["DEFAULT"]["transcodedir"]
-            # )
-            # destdir = Path(dest).parent
-        elif cfg["mediaserver"].get("kodifilmdir") in src:
-            replace = cfg["mediaserver"]["kodifilmdir"]
-            # isfilm = True
-            # dest = src.replace(
-            #     cfg["mediaserver"]["kodifilmdir"], cfg["DEFAULT"]["transcodedir"]
-            # )
-            # destdir = Path(dest).parent
-        else:
-            print(f"Skipping {src} as not in tvdir or filmdir")
+def kodiSizes(ps):
+    """{path: size} of the .ts files in the kodi directories, from the
+    inventory unless it is turned off"""
+    if ps["inventory"] in ("no", "off", "false"):
+        return remoteFileSizes()
+    ms = mediaServerSettings()
+    inventory = Inventory(ps["inventory"])
+    try:
+        changed, removed = inventory.scan([ms.koditvdir, ms.kodifilmdir])
+        print(f"Inventory: {changed} directories changed, {removed} removed")
+        return inventory.sizes()
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+        return remoteFileSizes()
+    finally:
+        inventory.close()
+
+
+def openMetrics(ps):
+    """the metrics listener, by default logging to the transcodedir"""
+    path = ps["metrics"]
+    if path in ("no", "off", "false"):
+        path = None
+    elif path is None:
+        path = os.path.join(defaultSettings().transcodedir, "tstomkv-metrics.jsonl")
+    return Metrics(path, promfile=ps["promfile"])
+
+
+def ledgerJobs(jobs, ledger):
+    """add the jobs to the ledger, skipping any finished or waiting to retry"""
+    for job in jobs:
+        ledger.listed(job["src"])
+        if not ledger.ready(job["src"]):
+            row = ledger.job(job["src"])
+            if row["state"] != "removed":
+                print(f"Skipping {job['src']}: {row['lasterror']}")
             continue
-        fps = pathManipulation(src, replace=replace, mkdestdir=True)
-        starttime = time.time()
-        # destdir.mkdir(mode=0o755, exist_ok=True, parents=True)
-        if not getFile(str(fps["src"]), str(fps["dest"]), banner=True):
-            raise Exception(f"Failed to copy {fps['src']} to {fps['dest']}")
-        endtime = time.time()
-        print(
-            f"Time taken to copy {fps['src']} to {fps['dest']}: {humanTime(endtime - starttime)}"
-        )
-        # tsrc = dest
-        # tdest = dest.replace(".ts", ".mkv")
-        # vduration = videoDuration(tsrc)
-        statsfile = str(fps["dest"]) + "-transcode.stats"
-        fthread = Thread(
-            target=transcodeFile,
-            args=(str(fps["dest"]), str(fps["destmkv"]), statsfile),
-            # args=(tsrc, tdest, statsfile),
-            kwargs={"overwrite": True},
+        job["ledger"] = ledger
+        yield job
+
+
+def runPipeline(jobs, profiler=None):
+    """run the jobs through the fetch, encode and upload stages
+
+    with a profiling.Profiler every stage call is profiled.
+    """
+    cfg = getConfig()
+    ps = pipelineSettings(cfg)
+    # a mistake in a [profile:*] section stops the run here, not every encode
+    configRules(cfg)
+    workers = makeWorkers(workerSettings())
+    coordinator = None
+    if len(workers) > 0:
+        # encodes go to the workers, one encode stage worker per slot
+        coordinator = Coordinator(
+            workers, lease=ps["workerlease"], heartbeat=ps["workerheartbeat"]
         )
-        sthread = Thread(target=doStats, args=(statsfile, videoDuration(fps["dest"])))
-        fthread.start()
-        sthread.start()
-        fthread.join()
-        sthread.join()
-        print(
-            f"Transcoding and stats monitoring complete for {Path(fps['destmkv']).name}"
+        ps["encodeworkers"] = coordinator.slots()
+        print(f"Encoding on {len(workers)} workers, {ps['encodeworkers']} slots")
+    budget = CoreBudget(cores=ps["cores"], jobs=ps["encodeworkers"])
+    ledger = openLedger(ps)
+    # one event loop for every stage, or a thread for each stage worker
+    asyncrun = ps["orchestrator"] == "asyncio"
+    staging = StagingBudget(
+        defaultSettings().transcodedir,
+        maxbytes=ps["stagingmax"],
+        reserve=ps["stagingreserve"],
+    )
+    stages = [
+        Stage(
+            "fetch",
+            partial(
+                fetchStage,
+                streaminput=ps["streaminput"],
+                channels=ps["transferchannels"],
+                verify=ps["verifytransfers"],
+                staging=staging,
+            ),
+            ps["fetchworkers"],
+            retries=ps["retries"],
+            backoff=ps["retrybackoff"],
+        ),
+        Stage(
+            "encode",
+            partial(
+                aio.encodeStage if asyncrun else encodeStage,
+                budget=budget,
+                streamoutput=ps["streamoutput"],
+                cfg=cfg,
+                segments=ps["segments"],
+                segmentmin=ps["segmentmin"],
+                coordinator=coordinator,
+                verify=ps["verify"],
+            ),
+            ps["encodeworkers"],
+        ),
+        Stage(
+            "upload",
+            partial(
+                uploadStage,
+                channels=ps["transferchannels"],
+                verify=ps["verifytransfers"],
+                staging=staging,
+            ),
+            ps["uploadworkers"],
+            retries=ps["retries"],
+            backoff=ps["retrybackoff"],
+        ),
+    ]
+    if encodeMode(cfg) == "remote":
+        # the media server encodes the recordings where they are, there is
+        # nothing to fetch and the upload just moves the mkv into place
+        server = mediaServerWorker(cfg)
+        print(f"Encoding on the media server {server.host}, {server.slots} slots")
+        stages[:2] = [
+            Stage(
+                "encode",
+                partial(
+                    remoteEncodeStage,
+                    cfg=cfg,
+                    worker=server,
+                    heartbeat=ps["workerheartbeat"],
+                    verify=ps["verify"],
+                ),
+                server.slots,
+            )
+        ]
+    if profiler is not None:
+        for stage in stages:
+            stage.func = profiler.wrap(stage.name, stage.func)
+    pipe = (AsyncPipeline if asyncrun else Pipeline)(
+        stages,
+        queuedepth=ps["queuedepth"],
+        stopcheck=stopNow,
+        abortonerror=False,
+        listeners=[ledger, staging, openMetrics(ps)],
+    )
+    # biggest savings for the cpu first, see schedule.scheduleJobs
+    jobs = probeJobs(list(jobs), limit=ps["scheduleprobes"])
+    jobs = scheduleJobs(jobs, cfg, ledger.throughput(heightClass))
+    try:
+        completed, failed = pipe.run(ledgerJobs(jobs, ledger))
+    finally:
+        ledger.close()
+    print(f"{len(completed)} recordings converted")
+    if len(failed) > 0:
+        for job, stagename, e in failed:
+            print(f"{job['src']} failed in the {stagename} stage: {e}")
+        raise CopyError(f"{len(failed)} recordings failed, they will be retried")
+    if pipe.stopped:
+        raise StopAll("STOP file found, exiting")
+    return completed
+
+
+def parseArgs(prog, skip=False):
+    """the command line options of kodimkv and tvhmkv"""
+    parser = argparse.ArgumentParser(prog=prog)
+    if skip:
+        parser.add_argument(
+            "skip", nargs="?", type=int, default=0, help="skip this many files"
         )
-        if checkPercentDuration(fps["dest"], fps["destmkv"]):
-            print("Duration check OK")
-            sendFile(str(fps["destmkv"]), str(fps["srcmkv"]), banner=True)
-            # fileMoved(str(fps["src"]), str(fps["srcmkv"]))
-            remoteCommand(f"rm \"{str(fps['src'])}\"", banner=True)
-        else:
-            print("Duration check FAILED, not moving file or deleting source")
-            raise CopyError("Duration check failed")
-        nexttime = time.time()
-        print(f"time taken: {humanTime(nexttime - endtime)}")
-        # nexttime = time.time()
-        # print(f"time taken: {humanTime(nexttime - endtime)}")
-        # if isfilm:
-        #     # move the file to the film directory
-        #     dest = tdest.replace(
-        #         cfg["DEFAULT"]["transcodedir"], cfg["mediaserver"]["kodifilmdir"]
-        #     )
-        # else:
-        #     dest = tdest.replace(
-        #         cfg["DEFAULT"]["transcodedir"], cfg["mediaserver"]["koditvdir"]
-        #     )
-        # if not sendFile(tdest, dest, banner=True):
-        #     raise Exception(f"Failed to send {tdest} to {dest}")
-        # print(f"time taken to send file: {humanTime(time.time() - nexttime)}")
-        # res = remoteCommand(f"rm '{src}'", banner=True)
-        # if res != "":
-        #     raise Exception(f"Failed to remove remote file {src}")
-        # print(f"process time for {src}: {humanTime(time.time() - starttime)}")
-
-
-def humanTime(seconds):
-    """convert seconds to human readable time"""
-    m, s = divmod(seconds, 60)
-    h, m = divmod(m, 60)
-    if h > 0:
-        return f"{int(h)}h {int(m)}m {int(s)}s"
-    elif m > 0:
-        return f"{int(m)}m {int(s)}s"
-    else:
-        return f"{int(s)}s"
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="profile each stage, writing a bundle to the transcodedir",
+    )
+    parser.add_argument("--profile-dir", help="write the profile bundle here")
+    parser.add_argument(
+        "--profile-top", type=int, default=25, help="hot spots listed per stage"
+    )
+    return parser.parse_args()
+
+
+def makeProfiler(args):
+    """a Profiler if --profile was given, otherwise None"""
+    if not args.profile:
+        return None
+    outdir = args.profile_dir
+    if outdir is None:
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        outdir = os.path.join(defaultSettings().transcodedir, "profiles", stamp)
+    return Profiler(outdir, top=args.profile_top)
+
+
+def writeProfile(profiler):
+    if profiler is not None:
+        print(profiler.write())
+        print(f"Profile written to {profiler.outdir}")
+
+
+def kodiJobs(files, cfg, skip=0, sizes=None):
+    for src in files:
+        if skip > 0:
+            print(f"Skipping {src}")
+            skip -= 1
+            continue
+        job = kodiJob(src, cfg)
+        if job is not None:
+            job["filesize"] = (sizes or {}).get(src)
+            yield job
+
+
+def kodimkv():
+    args = parseArgs("kodimkv", skip=True)
+    print(f"{tstomkv.__appname__} version: {tstomkv.getVersion()}")
+    profiler = makeProfiler(args)
+    try:
+        with nullcontext() if profiler is None else profiler.section("list"):
+            cfg = getConfig()
+            sizes = kodiSizes(pipelineSettings(cfg))
+        files = list(sizes)
+        print(f"{len(files)} Remote files")
+        runPipeline(kodiJobs(files, cfg, skip=args.skip, sizes=sizes), profiler)
+    finally:
+        writeProfile(profiler)
+
+
+def tvhJobs(titles, catalogue=None):
+    for title in titles:
+        for rec in titles[title]:
+            job = tvhJob(rec)
+            if job is not None:
+                job["catalogue"] = catalogue
+                yield job
 
 
 def tvhmkv():
     """Entry point for tvhmkv script"""
+    args = parseArgs("tvhmkv")
+    profiler = None
     try:
         print(f"Starting tvhmkv {tstomkv.getVersion()}")
-        # recs, titles = recordedTitles()
-        recs, titles = filteredTitles()
+        profiler = makeProfiler(args)
+        with nullcontext() if profiler is None else profiler.section("list"):
+            catalogue = openCatalogue(pipelineSettings(getConfig()))
+            # recs, titles = recordedTitles()
+            recs, titles = filteredTitles(catalogue=catalogue)
         print(f"{len(recs)} Transport Stream recordings found")
-        for title in titles:
-            for rec in titles[title]:
-                if stopNow():
-                    raise StopAll("STOP file found, exiting")
-                if not rec["filename"].lower().endswith(".ts"):
-                    print(f"Skipping {rec['filename']}")
-                    continue
-                fps = pathManipulation(
-                    rec["filename"], replace="/var/lib/tvheadend", mkdestdir=True
-                )
-                starttime = time.time()
-                if not getFile(str(fps["src"]), str(fps["dest"]), banner=True):
-                    raise CopyError(f"Failed to copy {fps['src']} to {fps['dest']}")
-                endtime = time.time()
-                print(
-                    f"Time taken to copy {fps['src']} to {fps['dest']}: {humanTime(endtime - starttime)}"
-                )
-                statsfile = str(fps["dest"]) + "-transcode.stats"
-                fthread = Thread(
-                    target=transcodeFile,
-                    args=(str(fps["dest"]), str(fps["destmkv"]), statsfile),
-                    kwargs={"overwrite": True},
-                )
-                sthread = Thread(
-                    target=doStats, args=(statsfile, videoDuration(fps["dest"]))
-                )
-                fthread.start()
-                sthread.start()
-                fthread.join()
-                sthread.join()
-                print(
-                    f"Transcoding and stats monitoring complete for {Path(fps["dest"]).name}"
-                )
-                if checkPercentDuration(fps["dest"], fps["destmkv"]):
-                    print("Duration check OK")
-                    sendFile(str(fps["destmkv"]), str(fps["srcmkv"]), banner=True)
-                    fileMoved(str(fps["src"]), str(fps["srcmkv"]))
-                    remoteCommand(f"rm \"{str(fps['src'])}\"", banner=True)
-                else:
-                    print("Duration check FAILED, not moving file or deleting source")
-                    raise CopyError("Duration check failed")
-                nexttime = time.time()
-                print(f"time taken: {humanTime(nexttime - endtime)}")
+        try:
+            runPipeline(tvhJobs(titles, catalogue), profiler)
+        finally:
+            writeProfile(profiler)
     except StopAll as e:
         errorNotify(sys.exc_info()[2], e)
         sys.exit(0)
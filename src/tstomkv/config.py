@@ -21,6 +21,8 @@
 import configparser
 import os
 import sys
+import threading
+from dataclasses import dataclass
 from pathlib import Path
 
 from tstomkv import __appname__, errorNotify, errorRaise
@@ -32,6 +34,47 @@ class ConfigFileNotFound(Exception):
     pass
 
 
+@dataclass(frozen=True)
+class DefaultSettings:
+    transcodedir: str | None
+    tvhuser: str | None
+    tvhpass: str | None
+    tvhipaddr: str | None
+
+
+@dataclass(frozen=True)
+class MediaServerSettings:
+    host: str | None
+    user: str | None
+    keyfn: str | None
+    koditvdir: str | None
+    kodifilmdir: str | None
+
+
+@dataclass(frozen=True)
+class YoutubeSettings:
+    filenumber: int
+    videodir: str | None
+    playlistdir: str | None
+    iplayerdir: str | None
+
+
+@dataclass(frozen=True)
+class WorkerSettings:
+    name: str
+    host: str
+    user: str | None
+    keyfn: str | None
+    workdir: str
+    slots: int
+    cores: int | None
+
+
+# config file path -> [(mtime_ns, size), ConfigParser, {section name: settings}]
+_cache = {}
+_cachelock = threading.Lock()
+
+
 def expandPath(path):
     try:
         return os.path.abspath(os.path.expanduser(path))
@@ -53,10 +96,128 @@ def readConfig(overrideappname=None):
         errorRaise(sys.exc_info()[2], e)
 
 
+def _cached(overrideappname=None):
+    appname = __appname__ if overrideappname is None else overrideappname
+    absfn = expandPath(f"~/.config/{appname}.cfg")
+    try:
+        st = os.stat(absfn)
+    except FileNotFoundError:
+        raise ConfigFileNotFound(f"cannot find config file: {absfn}")
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _cachelock:
+        cached = _cache.get(absfn)
+        if cached is None or cached[0] != stamp:
+            cached = [stamp, readConfig(overrideappname), {}]
+            _cache[absfn] = cached
+        return cached
+
+
+def getConfig(overrideappname=None):
+    """The config, parsed once and only read again when the file changes.
+
+    Callers share the returned ConfigParser so should not modify it other
+    than to write it back out with writeConfig.
+    """
+    try:
+        return _cached(overrideappname)[1]
+    except Exception as e:
+        errorRaise(sys.exc_info()[2], e)
+
+
+def _settings(name, build):
+    """the typed settings for a section, built once per load of the file"""
+    try:
+        cached = _cached()
+        with _cachelock:
+            if name not in cached[2]:
+                cached[2][name] = build(cached[1])
+            return cached[2][name]
+    except Exception as e:
+        errorRaise(sys.exc_info()[2], e)
+
+
+def defaultSettings():
+    """the DEFAULT section of the config"""
+
+    def build(cfg):
+        sect = cfg["DEFAULT"]
+        return DefaultSettings(
+            transcodedir=sect.get("transcodedir"),
+            tvhuser=sect.get("tvhuser"),
+            tvhpass=sect.get("tvhpass"),
+            tvhipaddr=sect.get("tvhipaddr"),
+        )
+
+    return _settings("DEFAULT", build)
+
+
+def mediaServerSettings():
+    """the mediaserver section of the config, keyfn expanded to a full path"""
+
+    def build(cfg):
+        sect = cfg["mediaserver"]
+        keyfn = sect.get("keyfn")
+        return MediaServerSettings(
+            host=sect.get("host"),
+            user=sect.get("user"),
+            keyfn=None if keyfn is None else expandPath(f"~/.ssh/{keyfn}"),
+            koditvdir=sect.get("koditvdir"),
+            kodifilmdir=sect.get("kodifilmdir"),
+        )
+
+    return _settings("mediaserver", build)
+
+
+def youtubeSettings():
+    """the youtube section of the config"""
+
+    def build(cfg):
+        sect = cfg["youtube"]
+        return YoutubeSettings(
+            filenumber=sect.getint("filenumber", fallback=0),
+            videodir=sect.get("videodir"),
+            playlistdir=sect.get("playlistdir"),
+            iplayerdir=sect.get("iplayerdir"),
+        )
+
+    return _settings("youtube", build)
+
+
+def workerSettings():
+    """the [worker:<name>] sections of the config, a tuple of WorkerSettings"""
+
+    def build(cfg):
+        workers = []
+        for section in cfg.sections():
+            if not section.startswith("worker:"):
+                continue
+            sect = cfg[section]
+            name = section[len("worker:") :]  # noqa: E203
+            keyfn = sect.get("keyfn")
+            cores = sect.get("cores")
+            workers.append(
+                WorkerSettings(
+                    name=name,
+                    host=sect.get("host", fallback=name),
+                    user=sect.get("user"),
+                    keyfn=None if keyfn is None else expandPath(f"~/.ssh/{keyfn}"),
+                    workdir=sect.get("workdir", fallback="/var/tmp/tstomkv"),
+                    slots=sect.getint("slots", fallback=1),
+                    cores=None if cores is None else int(cores),
+                )
+            )
+        return tuple(workers)
+
+    return _settings("workers", build)
+
+
 def writeConfig(cfg):
     try:
         absfn = expandPath(f"~/.config/{__appname__}.cfg")
         with open(absfn, "w") as ofn:
             cfg.write(ofn)
+        with _cachelock:
+            # the file may be rewritten within the mtime granularity
+            _cache.pop(absfn, None)
     except Exception as e:
         errorNotify(sys.exc_info()[2], e)
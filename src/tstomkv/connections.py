@@ -0,0 +1,116 @@
+"""pooled ssh connections for tstomkv
+
+One authenticated ssh transport is kept open per host/user/key and shared
+by every caller. Commands each run on their own channel of it and file
+transfers each open their own sftp channel, so concurrent transfers do not
+each need a full ssh handshake.
+"""
+
+import sys
+import threading
+from contextlib import contextmanager
+
+from fabric import Connection
+from paramiko import SFTPClient, SSHException
+
+from tstomkv import errorNotify
+
+
+class ConnectionPool:
+    """Keeps one live fabric Connection per (host, user, keyfn).
+
+    keepalive is the interval, in seconds, for ssh keepalive packets so
+    that idle connections are not dropped by the server or by NAT whilst a
+    long encode runs.
+    """
+
+    def __init__(self, keepalive=30):
+        self.keepalive = keepalive
+        self._conns = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, host, user, keyfn):
+        c = Connection(host=host, user=user, connect_kwargs={"key_filename": keyfn})
+        c.open()
+        c.transport.set_keepalive(self.keepalive)
+        return c
+
+    def healthy(self, c):
+        """True if the connection's transport is still usable"""
+        try:
+            return c.is_connected and c.transport.is_active()
+        except Exception:
+            return False
+
+    def connection(self, host, user, keyfn):
+        """return a healthy connection, reconnecting if the old one died"""
+        key = (host, user, keyfn)
+        with self._lock:
+            c = self._conns.get(key)
+            if c is None or not self.healthy(c):
+                if c is not None:
+                    self._close(c)
+                c = self._connect(host, user, keyfn)
+                self._conns[key] = c
+            return c
+
+    def discard(self, host, user, keyfn):
+        """forget a connection, the next request for it will reconnect"""
+        with self._lock:
+            c = self._conns.pop((host, user, keyfn), None)
+        if c is not None:
+            self._close(c)
+
+    def _close(self, c):
+        try:
+            c.close()
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
+
+    def run(self, host, user, keyfn, cmd, hide=True, warn=False, retry=True):
+        """run cmd on the host, reconnecting and retrying once on failure
+
+        with warn a non-zero exit is returned rather than raised.
+        a command that mustn't run twice, a mv say, is given retry=False:
+        once it has been started a failure may have come after it ran, so
+        the error is raised rather than running it again.
+        """
+        started = False
+        try:
+            c = self.connection(host, user, keyfn)
+            started = True
+            return c.run(cmd, hide=hide, warn=warn)
+        except (EOFError, OSError, SSHException) as e:
+            print(f"connection to {host} lost ({e}), reconnecting")
+            self.discard(host, user, keyfn)
+            if started and not retry:
+                raise
+            return self.connection(host, user, keyfn).run(cmd, hide=hide, warn=warn)
+
+    @contextmanager
+    def sftp(self, host, user, keyfn):
+        """a new sftp channel over the host's shared transport"""
+        try:
+            client = SFTPClient.from_transport(
+                self.connection(host, user, keyfn).transport
+            )
+        except (EOFError, OSError, SSHException) as e:
+            print(f"connection to {host} lost ({e}), reconnecting")
+            self.discard(host, user, keyfn)
+            client = SFTPClient.from_transport(
+                self.connection(host, user, keyfn).transport
+            )
+        try:
+            yield client
+        finally:
+            client.close()
+
+    def closeAll(self):
+        with self._lock:
+            conns = list(self._conns.values())
+            self._conns.clear()
+        for c in conns:
+            self._close(c)
+
+
+pool = ConnectionPool()
@@ -0,0 +1,85 @@
+"""cpu core sharing for parallel transcodes
+
+x265 stops scaling well long before it fills a big host with a single SD
+encode, so when several encodes run at once each is given a share of the
+cores sized to its resolution and told to keep to it via -x265-params.
+"""
+
+import os
+import threading
+
+# cores a single encode can make good use of, by maximum frame height
+CORESPERJOB = ((576, 4), (720, 6), (1080, 8))
+UHDCORES = 16
+
+
+def coreCount():
+    """the number of cores this process may run on"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def coresPerJob(height):
+    """the share of cores to give an encode of the given frame height"""
+    if height is None:
+        height = CORESPERJOB[0][0]
+    for maxheight, cores in CORESPERJOB:
+        if height <= maxheight:
+            return cores
+    return UHDCORES
+
+
+def encodeJobs(cores, height=None):
+    """how many encodes of the given frame height to run at once"""
+    return max(1, cores // coresPerJob(height))
+
+
+def x265Params(threads):
+    """x265 thread pool and frame thread settings for a share of cores"""
+    if threads >= 32:
+        frames = 6
+    elif threads >= 16:
+        frames = 5
+    elif threads >= 8:
+        frames = 3
+    elif threads >= 4:
+        frames = 2
+    else:
+        frames = 1
+    return f"pools={threads}:frame-threads={frames}"
+
+
+class CoreBudget:
+    """Hands out shares of the host's cores to concurrent encodes.
+
+    A single encoder (jobs == 1) is left to use every core itself.
+    """
+
+    def __init__(self, cores=None, jobs=1):
+        self.cores = coreCount() if cores is None else int(cores)
+        self.jobs = jobs
+        self.free = self.cores
+        self._cond = threading.Condition()
+
+    def share(self, height):
+        """the number of cores an encode of this height should use,
+        or None if it should have them all"""
+        if self.jobs <= 1:
+            return None
+        return min(coresPerJob(height), self.cores)
+
+    def acquire(self, n):
+        if n is None:
+            return
+        with self._cond:
+            self._cond.wait_for(lambda: self.free >= n)
+            self.free -= n
+
+    def release(self, n):
+        if n is None:
+            return
+        with self._cond:
+            self.free += n
+            self._cond.notify_all()
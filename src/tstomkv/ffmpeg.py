@@ -6,61 +6,173 @@ import subprocess
 import sys
 from pathlib import Path
 
-from tstomkv import errorRaise
-from tstomkv.shell import shellCommand
+from tstomkv import errorRaise, probecache
+from tstomkv.files import remoteCommand
+
+
+def transcodeCommand(
+    input_file,
+    output_file,
+    statsfile,
+    x265params=None,
+    inputformat=None,
+    profile=None,
+):
+    """the ffmpeg command line to transcode input_file to output_file
+
+    profile is a dict of preset, crf, audiocodec and audiobitrate, see
+    profiles.chooseProfile, it defaults to x265 medium and 128k aac.
+    copyvideo and copyaudio in the profile copy those streams as they are.
+    """
+    profile = {} if profile is None else profile
+    # options:
+    # -stats_period 5 - write stats every 5 seconds to statsfile
+    # -progress statsfile - changes the output of ffmpeg to
+    #     issuing progress tables every stats_period
+    # -f mpegts - needed when reading the transport stream from a pipe
+    # -c:v libx265 - use h265 encoding
+    # -preset medium - use preset medium (default, but hey-ho)
+    # -crf N - the quality to aim for, if the profile sets one
+    # -x265-params pools=N:frame-threads=M - keep to a share of the cores
+    # -c:a aac -b:a 128k - use aac encoding for audio at a bitrate of 128k
+    # -c:v copy / -c:a copy - streams that are already hevc / aac are copied
+    # -c:s copy -map 0 - copy the dvb subtitles as is
+    #     (which is why we have to use a matroska container)
+    cmd = [
+        "ffmpeg",
+        "-loglevel",
+        "error",
+        "-hide_banner",
+        "-progress",
+        statsfile,
+        "-stats_period",
+        "5",
+    ]
+    if inputformat is not None:
+        cmd.extend(["-f", inputformat])
+    cmd += ["-i", input_file]
+    if profile.get("copyvideo"):
+        cmd.extend(["-c:v", "copy"])
+    else:
+        cmd.extend(["-c:v", "libx265", "-preset", profile.get("preset") or "medium"])
+        if profile.get("crf") is not None:
+            cmd.extend(["-crf", str(profile["crf"])])
+        if x265params is not None:
+            cmd.extend(["-x265-params", x265params])
+    if profile.get("copyaudio"):
+        cmd.extend(["-c:a", "copy"])
+    else:
+        cmd.extend(
+            [
+                "-c:a",
+                profile.get("audiocodec") or "aac",
+                "-b:a",
+                profile.get("audiobitrate") or "128k",
+            ]
+        )
+    cmd += [
+        "-c:s",
+        "copy",
+        output_file,
+    ]
+    return cmd
+
+
+def checkOutputFile(output_file, overwrite=False):
+    """make sure output_file is an mkv and remove it if overwrite is True"""
+    if not output_file.endswith(".mkv"):
+        raise ValueError("Output file must be a .mkv file")
+    if not overwrite and removeFileIfExists(output_file, reportOnly=True):
+        raise FileExistsError(f"Output file {output_file} exists and overwrite is False")
+    else:
+        removeFileIfExists(output_file)
 
 
 def convert_ts_to_mkv(
-    input_file: str, output_file: str, statsfile: str, overwrite=False
+    input_file: str,
+    output_file: str,
+    statsfile: str,
+    overwrite=False,
+    x265params=None,
+    profile=None,
+    started=None,
 ):
-    """transcode a transport stream file to mkv x265/aac"""
+    """transcode a transport stream file to mkv x265/aac
+
+    x265params, if given, is passed to libx265 to limit the cores it uses.
+    profile, if given, sets the preset, crf and audio settings.
+    started, if given, is called with the ffmpeg Popen once it is running,
+    so that a stalled encode can be stopped.
+    returns True if ffmpeg exited cleanly.
+    """
     try:
         if not input_file.lower().endswith(".ts"):
             raise ValueError("Input file must be a .ts file")
-        if not output_file.endswith(".mkv"):
-            raise ValueError("Output file must be a .mkv file")
-        if not overwrite and removeFileIfExists(output_file, reportOnly=True):
-            raise FileExistsError(
-                f"Output file {output_file} exists and overwrite is False"
-            )
-        else:
-            removeFileIfExists(output_file)
+        checkOutputFile(output_file, overwrite=overwrite)
         print(f"Transcoding {input_file} to {output_file}...")
-        # options:
-        # -stats_period 5 - write stats every 5 seconds to statsfile
-        # -progress statsfile - changes the output of ffmpeg to
-        #     issuing progress tables every stats_period
-        # -c:v libx265 - use h265 encoding
-        # -preset medium - use preset medium (default, but hey-ho)
-        # -c:a aac -b:a 128k - use aac encoding for audio at a bitrate of 128k
-        # -c:s copy -map 0 - copy the dvb subtitles as is
-        #     (which is why we have to use a matroska container)
-
-        cmd = [
-            "ffmpeg",
-            "-loglevel",
-            "error",
-            "-hide_banner",
-            "-progress",
-            statsfile,
-            "-stats_period",
-            "5",
-            "-i",
-            input_file,
-            "-c:v",
-            "libx265",
-            "-preset",
-            "medium",
-            "-c:a",
-            "aac",
-            "-b:a",
-            "128k",
-            "-c:s",
-            "copy",
+        cmd = transcodeCommand(
+            input_file, output_file, statsfile, x265params=x265params, profile=profile
+        )
+        proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        if started is not None:
+            started(proc)
+        proc.communicate()
+        print(f"Conversion complete: {output_file}")
+        return proc.returncode == 0
+    except Exception as e:
+        errorRaise(sys.exc_info()[2], e)
+
+
+def convert_stream_to_mkv(
+    blocks,
+    output_file: str,
+    statsfile: str,
+    overwrite=False,
+    x265params=None,
+    profile=None,
+    started=None,
+):
+    """transcode a transport stream, given as an iterable of byte blocks,
+    to mkv x265/aac by feeding the blocks to ffmpeg's stdin.
+
+    started is as for convert_ts_to_mkv.
+    returns True if ffmpeg read the whole stream and exited cleanly.
+    """
+    try:
+        checkOutputFile(output_file, overwrite=overwrite)
+        print(f"Transcoding stream to {output_file}...")
+        cmd = transcodeCommand(
+            "pipe:0",
             output_file,
-        ]
-        _, _ = shellCommand(cmd, canfail=True)
+            statsfile,
+            x265params=x265params,
+            inputformat="mpegts",
+            profile=profile,
+        )
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        if started is not None:
+            started(proc)
+        complete = True
+        try:
+            for block in blocks:
+                proc.stdin.write(block)
+        except BrokenPipeError:
+            print(f"ffmpeg stopped reading the stream for {output_file}")
+            complete = False
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        returncode = proc.wait()
         print(f"Conversion complete: {output_file}")
+        return complete and returncode == 0
     except Exception as e:
         errorRaise(sys.exc_info()[2], e)
 
@@ -80,25 +192,44 @@ def removeFileIfExists(infile, reportOnly=False):
         errorRaise(sys.exc_info()[2], e)
 
 
+def probeCommand(fqfn):
+    """probe the streams and format of fqfn in one go, as json"""
+    return [
+        "ffprobe",
+        "-loglevel",
+        "quiet",
+        "-of",
+        "json",
+        "-show_streams",
+        "-show_format",
+        fqfn,
+    ]
+
+
+def probeResult(fqfn, returncode, stdout):
+    """the fileinfo from probeCommand's exit code and stdout bytes, cached,
+    or None if ffprobe failed"""
+    if returncode != 0:
+        return None
+    finfo = json.loads(stdout.decode("utf-8"))
+    probecache.cache.put(fqfn, finfo)
+    return finfo
+
+
 def fileInfo(fqfn):
-    """use ffprobe. returns dict of fileinfo or None."""
+    """use ffprobe. returns dict of fileinfo or None.
+
+    the streams and format are probed in one go and the result is cached
+    until the file changes, so asking again costs a stat not a probe.
+    """
     try:
         fn = Path(fqfn)
         if fn.exists():
-            cmd = [
-                "ffprobe",
-                "-loglevel",
-                "quiet",
-                "-of",
-                "json",
-                "-show_streams",
-                fqfn,
-            ]
-            proc = subprocess.run(cmd, capture_output=True)
-            if proc.returncode == 0:
-                xstr = proc.stdout.decode("utf-8")
-                # print(xstr)
-                return json.loads(xstr)
+            cached = probecache.cache.get(fqfn)
+            if cached is not None:
+                return cached
+            proc = subprocess.run(probeCommand(fqfn), capture_output=True)
+            return probeResult(fqfn, proc.returncode, proc.stdout)
     except Exception as e:
         errorRaise(sys.exc_info()[2], e)
 
@@ -127,34 +258,75 @@ def takeSnapshot(src, outjpg, location="40"):
         errorRaise(sys.exc_info()[2], e)
 
 
+def remoteFileInfo(fqfn):
+    """run ffprobe on the media server. returns dict of fileinfo or None."""
+    try:
+        cmd = f'ffprobe -loglevel quiet -of json -show_streams -show_format "{fqfn}"'
+        xstr = remoteCommand(cmd)
+        if xstr != "":
+            return json.loads(xstr)
+    except Exception as e:
+        errorRaise(sys.exc_info()[2], e)
+
+
+def infoDuration(finfo):
+    """the duration, in int seconds, from ffprobe output or None"""
+    if finfo and "streams" in finfo:
+        for stream in finfo["streams"]:
+            # if "codec_type" in stream and stream["codec_type"] == "video":
+            # look for any stream with a duration
+            # after encoding to mkv, it would appear that only the subtitle
+            # stream has a duration, so don't check codec_type
+            if "duration" in stream:
+                # no need to be exact, just return int seconds
+                return int(float(stream["duration"]))
+    if finfo and "duration" in finfo.get("format", {}):
+        return int(float(finfo["format"]["duration"]))
+    return None
+
+
+def infoVideoStream(finfo):
+    """the first video stream from ffprobe output or None"""
+    if finfo and "streams" in finfo:
+        for stream in finfo["streams"]:
+            if stream.get("codec_type") == "video":
+                return stream
+    return None
+
+
+def infoHeight(finfo):
+    """the frame height of the first video stream from ffprobe output or None"""
+    stream = infoVideoStream(finfo)
+    if stream is not None and "height" in stream:
+        return int(stream["height"])
+    return None
+
+
 def videoDuration(fqfn):
     """use ffprobe. returns duration in seconds or None."""
     try:
-        finfo = fileInfo(fqfn)
-        # print(finfo)
-        if finfo and "streams" in finfo:
-            for stream in finfo["streams"]:
-                # if "codec_type" in stream and stream["codec_type"] == "video":
-                # look for any stream with a duration
-                # after encoding to mkv, it would appear that only the subtitle
-                # stream has a duration, so don't check codec_type
-                if "duration" in stream:
-                    # no need to be exact, just return int seconds
-                    return int(float(stream["duration"]))
+        return infoDuration(fileInfo(fqfn))
+    except Exception as e:
+        errorRaise(sys.exc_info()[2], e)
         return None
+
+
+def videoHeight(fqfn):
+    """use ffprobe. returns the frame height of the first video stream or None."""
+    try:
+        return infoHeight(fileInfo(fqfn))
     except Exception as e:
         errorRaise(sys.exc_info()[2], e)
         return None
 
 
-def checkPercentDuration(fn1, fn2, threshold=0.9):
-    """Check that the duration of fn2 is at least threshold percent of fn1"""
+def checkDuration(dur1, fn2, threshold=0.9):
+    """Check that the duration of fn2 is at least threshold percent of dur1"""
     try:
-        dur1 = videoDuration(fn1)
-        print(f"Duration of {fn1} is {dur1} seconds")
         dur2 = videoDuration(fn2)
         print(f"Duration of {fn2} is {dur2} seconds")
-        print(f"threshold is {dur1 * threshold} seconds")
+        if dur1:
+            print(f"threshold is {dur1 * threshold} seconds")
         if dur1 and dur2:
             if dur2 >= (dur1 * threshold):
                 return True
@@ -162,3 +334,14 @@ def checkPercentDuration(fn1, fn2, threshold=0.9):
     except Exception as e:
         errorRaise(sys.exc_info()[2], e)
         return False
+
+
+def checkPercentDuration(fn1, fn2, threshold=0.9):
+    """Check that the duration of fn2 is at least threshold percent of fn1"""
+    try:
+        dur1 = videoDuration(fn1)
+        print(f"Duration of {fn1} is {dur1} seconds")
+        return checkDuration(dur1, fn2, threshold=threshold)
+    except Exception as e:
+        errorRaise(sys.exc_info()[2], e)
+        return False
@@ -19,12 +19,24 @@
 
 import os
 import sys
+from contextlib import contextmanager
 from pathlib import Path
 
-from fabric import Connection
-
 from tstomkv import errorNotify
-from tstomkv.config import expandPath, readConfig, writeConfig
+from tstomkv.config import (
+    defaultSettings,
+    expandPath,
+    getConfig,
+    mediaServerSettings,
+    writeConfig,
+)
+from tstomkv.connections import pool
+
+# streamed reads are requested as blocks of BLOCKSIZE bytes, WINDOW blocks
+# at a time, so there are always requests in flight without buffering
+# more than BLOCKSIZE * WINDOW bytes of the remote file in memory
+BLOCKSIZE = 1024 * 1024
+WINDOW = 16
 
 
 def getOutputFileName(cfg, vtype="v"):
@@ -48,16 +60,19 @@ def getOutputFileName(cfg, vtype="v"):
         errorNotify(sys.exc_info()[2], e)
 
 
+def mediaServer():
+    """the media server's (host, user, ssh key filename)"""
+    ms = mediaServerSettings()
+    return ms.host, ms.user, ms.keyfn
+
+
 def sendFileTo(fn, vtype="v"):
     try:
-        cfg = readConfig()
-        mhost = cfg["mediaserver"]["host"]
-        muser = cfg["mediaserver"]["user"]
-        mkeyfn = expandPath(f'~/.ssh/{cfg["mediaserver"]["keyfn"]}')
-        ckwargs = {"key_filename": mkeyfn}
+        cfg = getConfig()
+        server = mediaServer()
         ofn = getOutputFileName(cfg, vtype=vtype)
-        with Connection(host=mhost, user=muser, connect_kwargs=ckwargs) as c:
-            c.put(fn, ofn)
+        with pool.sftp(*server) as sftp:
+            sftp.put(fn, ofn)
     except Exception as e:
         errorNotify(sys.exc_info()[2], e)
 
@@ -65,15 +80,11 @@ def sendFileTo(fn, vtype="v"):
 def sendFile(src, dst, banner=False):
     """send a file to the media server"""
     try:
-        cfg = readConfig()
-        mhost = cfg["mediaserver"]["host"]
-        muser = cfg["mediaserver"]["user"]
-        mkeyfn = expandPath(f'~/.ssh/{cfg["mediaserver"]["keyfn"]}')
-        ckwargs = {"key_filename": mkeyfn}
+        server = mediaServer()
         if banner:
-            print(f"sending {src} to {mhost}:{dst}")
-        with Connection(host=mhost, user=muser, connect_kwargs=ckwargs) as c:
-            c.put(src, dst)
+            print(f"sending {src} to {server[0]}:{dst}")
+        with pool.sftp(*server) as sftp:
+            sftp.put(src, dst)
         return True
     except Exception as e:
         errorNotify(sys.exc_info()[2], e)
@@ -83,21 +94,41 @@ def sendFile(src, dst, banner=False):
 def getFile(src, dst, banner=False):
     """get a file from the media server"""
     try:
-        cfg = readConfig()
-        mhost = cfg["mediaserver"]["host"]
-        muser = cfg["mediaserver"]["user"]
-        mkeyfn = expandPath(f'~/.ssh/{cfg["mediaserver"]["keyfn"]}')
-        ckwargs = {"key_filename": mkeyfn}
+        server = mediaServer()
         if banner:
-            print(f"Retrieving {dst} from {mhost}:{src}", flush=True)
-        with Connection(host=mhost, user=muser, connect_kwargs=ckwargs) as c:
-            c.get(src, dst)
+            print(f"Retrieving {dst} from {server[0]}:{src}", flush=True)
+        with pool.sftp(*server) as sftp:
+            sftp.get(src, dst)
         return True
     except Exception as e:
         errorNotify(sys.exc_info()[2], e)
         return False
 
 
+@contextmanager
+def remoteBlocks(src, blocksize=BLOCKSIZE, window=WINDOW):
+    """yields an iterator over the blocks of a file on the media server
+
+    each window of blocks is requested in one go so that the reads are
+    pipelined over the sftp channel rather than waiting on each other.
+    """
+    with pool.sftp(*mediaServer()) as sftp:
+        size = sftp.stat(src).st_size
+        with sftp.open(src, "rb") as f:
+
+            def blocks():
+                offset = 0
+                while offset < size:
+                    chunks = []
+                    while len(chunks) < window and offset < size:
+                        n = min(blocksize, size - offset)
+                        chunks.append((offset, n))
+                        offset += n
+                    yield from f.readv(chunks)
+
+            yield blocks()
+
+
 def fileSize(fn):
     try:
         return os.path.getsize(fn)
@@ -130,34 +161,41 @@ def dirFileList(path, filterext=None):
 def remoteFileList():
     """list files on the media server"""
     try:
-        cfg = readConfig()
-        mhost = cfg["mediaserver"]["host"]
-        muser = cfg["mediaserver"]["user"]
-        mkeyfn = expandPath(f'~/.ssh/{cfg["mediaserver"]["keyfn"]}')
-        ckwargs = {"key_filename": mkeyfn}
-        findcmd = f"find {cfg['mediaserver']['koditvdir']} {cfg['mediaserver']['kodifilmdir']} -name \\*.ts"
-        with Connection(host=mhost, user=muser, connect_kwargs=ckwargs) as c:
-            result = c.run(findcmd, hide=True)
-            files = result.stdout.strip().split("\n")
-            return files
+        ms = mediaServerSettings()
+        findcmd = f"find {ms.koditvdir} {ms.kodifilmdir} -name \\*.ts"
+        result = pool.run(*mediaServer(), findcmd)
+        files = result.stdout.strip().split("\n")
+        return files
     except Exception as e:
         errorNotify(sys.exc_info()[1], e)
         return []
 
 
-def remoteCommand(cmd, banner=False):
-    """run a command on the media server"""
+def remoteFileSizes():
+    """{path: size in bytes} of the files remoteFileList would list"""
+    try:
+        ms = mediaServerSettings()
+        findcmd = f"find {ms.koditvdir} {ms.kodifilmdir} -name \\*.ts"
+        result = pool.run(*mediaServer(), f"{findcmd} -printf '%s %p\\n'")
+        sizes = {}
+        for line in result.stdout.strip().split("\n"):
+            size, _, path = line.partition(" ")
+            if path != "":
+                sizes[path] = int(size)
+        return sizes
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+        return {}
+
+
+def remoteCommand(cmd, banner=False, retry=True):
+    """run a command on the media server, see ConnectionPool.run for retry"""
     try:
-        cfg = readConfig()
-        mhost = cfg["mediaserver"]["host"]
-        muser = cfg["mediaserver"]["user"]
-        mkeyfn = expandPath(f'~/.ssh/{cfg["mediaserver"]["keyfn"]}')
-        ckwargs = {"key_filename": mkeyfn}
+        server = mediaServer()
         if banner:
-            print(f"Running remote command on {mhost}: {cmd}", flush=True)
-        with Connection(host=mhost, user=muser, connect_kwargs=ckwargs) as c:
-            result = c.run(cmd, hide=True)
-            return result.stdout.strip()
+            print(f"Running remote command on {server[0]}: {cmd}", flush=True)
+        result = pool.run(*server, cmd, retry=retry)
+        return result.stdout.strip()
     except Exception as e:
         errorNotify(sys.exc_info()[1], e)
         return ""
@@ -166,11 +204,11 @@ def remoteCommand(cmd, banner=False):
 def pathManipulation(src, replace="/var/lib/tvheadend", mkdestdir=True):
     try:
         op = {}
-        cfg = readConfig()
+        transcodedir = defaultSettings().transcodedir
         op["src"] = Path(src)
         op["srcmkv"] = op["src"].with_suffix(".mkv")
         op["srcdir"] = op["src"].parent
-        op["dest"] = Path(src.replace(replace, cfg["DEFAULT"]["transcodedir"]))
+        op["dest"] = Path(src.replace(replace, transcodedir))
         op["destdir"] = op["dest"].parent
         op["destmkv"] = op["dest"].with_suffix(".mkv")
         if mkdestdir:
@@ -182,6 +220,5 @@ def pathManipulation(src, replace="/var/lib/tvheadend", mkdestdir=True):
 
 def stopNow():
     """Stop the transcoding process"""
-    cfg = readConfig()
-    stopfn = "/".join([cfg["DEFAULT"]["transcodedir"], "STOP"])
+    stopfn = "/".join([defaultSettings().transcodedir, "STOP"])
     return Path(stopfn).exists()
@@ -0,0 +1,180 @@
+"""indexed inventory of the transport streams on the media server
+
+kodimkv used to find every .ts file under the kodi tv and film
+directories on each start. The inventory keeps the path, size and mtime
+of each in a sqlite database, along with the mtime of every directory
+under them. A scan lists only the directories, in one find, and looks
+again at the files of just those whose mtime has changed, as adding,
+removing or renaming a file changes its directory's mtime. A library
+that hasn't changed costs one directory listing, and the sizes are
+there for the scheduler without statting anything. The whole tree is
+listed again once a week in case something was missed.
+"""
+
+import os
+import shlex
+import sqlite3
+import threading
+import time
+
+from tstomkv import __appname__
+from tstomkv.connections import pool
+from tstomkv.files import mediaServer
+
+# seconds between full scans
+FULLSCAN = 7 * 24 * 60 * 60
+
+# directories whose files are listed by one find
+BATCH = 200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS filesdir ON files (dir);
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def inventoryPath():
+    cachehome = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cachehome, __appname__, "inventory.db")
+
+
+def mediaServerRun(cmd):
+    """run cmd on the media server, returns its stdout"""
+    return pool.run(*mediaServer(), cmd).stdout
+
+
+def dirsCommand(roots):
+    """list every directory under roots with its mtime"""
+    quoted = " ".join(shlex.quote(r) for r in roots)
+    return f"find {quoted} -type d -printf '%T@ %p\\n'"
+
+
+def filesCommand(dirs, maxdepth=True):
+    """list the .ts files in dirs, or under them, with size and mtime"""
+    quoted = " ".join(shlex.quote(d) for d in dirs)
+    depth = " -maxdepth 1" if maxdepth else ""
+    return f"find {quoted}{depth} -type f -name '*.ts' -printf '%s %T@ %p\\n'"
+
+
+def parseDirs(out):
+    """{path: mtime} from the output of dirsCommand"""
+    dirs = {}
+    for line in out.split("\n"):
+        mtime, _, path = line.partition(" ")
+        if path != "":
+            dirs[path] = float(mtime)
+    return dirs
+
+
+def parseFiles(out):
+    """[(path, size, mtime)] from the output of filesCommand"""
+    files = []
+    for line in out.split("\n"):
+        parts = line.split(" ", 2)
+        if len(parts) == 3:
+            files.append((parts[2], int(parts[0]), float(parts[1])))
+    return files
+
+
+class Inventory:
+    """The .ts files on the media server, kept in the sqlite database at path.
+
+    run is called with a shell command to run on the media server and
+    returns its output, it defaults to using the shared ssh connection.
+    """
+
+    def __init__(self, path=None, run=None):
+        self.path = inventoryPath() if path is None else path
+        self.run = mediaServerRun if run is None else run
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _execute(self, sql, args=()):
+        with self._lock, self._db:
+            return self._db.execute(sql, args).fetchall()
+
+    def _meta(self, key, default=None):
+        rows = self._execute("SELECT value FROM meta WHERE key = ?", (key,))
+        return default if len(rows) == 0 else rows[0][0]
+
+    def _setMeta(self, key, value):
+        self._execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+        )
+
+    def _replace(self, dirs, files):
+        """forget the files of dirs and store files in their place"""
+        with self._lock, self._db:
+            self._db.executemany(
+                "DELETE FROM files WHERE dir = ?", [(d,) for d in dirs]
+            )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO files (path, dir, size, mtime)"
+                " VALUES (?, ?, ?, ?)",
+                [(p, os.path.dirname(p), s, m) for p, s, m in files],
+            )
+
+    def scan(self, roots, full=False):
+        """bring the inventory up to date, returns (changed dirs, removed dirs)"""
+        roots = [r for r in roots if r]
+        lastfull = float(self._meta("fullscan", 0))
+        full = (
+            full
+            or self._meta("roots") != "\n".join(roots)
+            or time.time() - lastfull > FULLSCAN
+        )
+        current = parseDirs(self.run(dirsCommand(roots)))
+        known = dict(self._execute("SELECT path, mtime FROM dirs"))
+        removed = [d for d in known if d not in current]
+        if full:
+            changed = list(current)
+            files = parseFiles(self.run(filesCommand(roots, maxdepth=False)))
+            with self._lock, self._db:
+                self._db.execute("DELETE FROM files")
+            self._replace([], files)
+        else:
+            changed = [d for d, m in current.items() if known.get(d) != m]
+            for n in range(0, len(changed), BATCH):
+                batch = changed[n : n + BATCH]  # noqa: E203
+                self._replace(batch, parseFiles(self.run(filesCommand(batch))))
+            self._replace(removed, [])
+        with self._lock, self._db:
+            self._db.executemany(
+                "DELETE FROM dirs WHERE path = ?", [(d,) for d in removed]
+            )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO dirs (path, mtime) VALUES (?, ?)",
+                [(d, current[d]) for d in changed],
+            )
+        if full:
+            self._setMeta("fullscan", time.time())
+            self._setMeta("roots", "\n".join(roots))
+        return len(changed), len(removed)
+
+    def sizes(self):
+        """{path: size in bytes} of every file, in path order"""
+        return dict(self._execute("SELECT path, size FROM files ORDER BY path"))
+
+    def files(self):
+        """[(path, size, mtime)] of every file, in path order"""
+        return self._execute("SELECT path, size, mtime FROM files ORDER BY path")
@@ -0,0 +1,182 @@
+"""sqlite job ledger for tstomkv
+
+Records how far each source file has got through the pipeline, how long
+each stage took and how often it has failed, so that a run can pick up
+exactly where the last one stopped and failures are retried after a
+backoff rather than aborting everything.
+"""
+
+import sqlite3
+import threading
+import time
+
+# the states a job passes through, in order
+STATES = ("listed", "fetched", "encoded", "verified", "uploaded", "removed")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    src TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    lasterror TEXT,
+    nextattempt REAL NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS timings (
+    src TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL NOT NULL,
+    ok INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS encodes (
+    src TEXT NOT NULL,
+    height INTEGER,
+    duration REAL NOT NULL,
+    cpu REAL NOT NULL,
+    srcbytes INTEGER,
+    dstbytes INTEGER NOT NULL,
+    finished REAL NOT NULL
+);
+"""
+
+
+class Ledger:
+    """The job ledger, kept in the sqlite database at path.
+
+    Failed jobs are retried after backoff seconds, doubling for each
+    further failure, and are given up on after maxattempts.
+    """
+
+    def __init__(self, path, maxattempts=5, backoff=600):
+        self.path = path
+        self.maxattempts = maxattempts
+        self.backoff = backoff
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._lock, self._db:
+            self._db.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _execute(self, sql, args=()):
+        with self._lock, self._db:
+            return self._db.execute(sql, args).fetchall()
+
+    def job(self, src):
+        """the ledger row for src as a dict, or None"""
+        rows = self._execute("SELECT * FROM jobs WHERE src = ?", (src,))
+        return dict(rows[0]) if rows else None
+
+    def state(self, src):
+        row = self.job(src)
+        return None if row is None else row["state"]
+
+    def listed(self, src):
+        """add src to the ledger if it isn't already there"""
+        now = time.time()
+        self._execute(
+            "INSERT OR IGNORE INTO jobs (src, state, created, updated)"
+            " VALUES (?, 'listed', ?, ?)",
+            (src, now, now),
+        )
+
+    def advance(self, src, state):
+        """record that src has reached state, clearing any failures"""
+        if state not in STATES:
+            raise ValueError(f"unknown job state {state}")
+        self._execute(
+            "UPDATE jobs SET state = ?, lasterror = NULL, nextattempt = 0,"
+            " updated = ? WHERE src = ?",
+            (state, time.time(), src),
+        )
+
+    def reached(self, src, state):
+        """True if src has got as far as state"""
+        current = self.state(src)
+        return current is not None and STATES.index(current) >= STATES.index(state)
+
+    def failed(self, src, error):
+        """record a failure, the job will be retried after a backoff"""
+        row = self.job(src)
+        attempts = 1 if row is None else row["attempts"] + 1
+        delay = self.backoff * 2 ** (attempts - 1)
+        self._execute(
+            "UPDATE jobs SET attempts = ?, lasterror = ?, nextattempt = ?,"
+            " updated = ? WHERE src = ?",
+            (attempts, str(error), time.time() + delay, time.time(), src),
+        )
+
+    def ready(self, src, now=None):
+        """True if src still has work to do and is not waiting to retry"""
+        row = self.job(src)
+        if row is None:
+            return True
+        now = time.time() if now is None else now
+        return (
+            row["state"] != STATES[-1]
+            and row["attempts"] < self.maxattempts
+            and row["nextattempt"] <= now
+        )
+
+    def timing(self, src, stage, started, finished, ok=True):
+        self._execute(
+            "INSERT INTO timings (src, stage, started, finished, ok)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (src, stage, started, finished, 1 if ok else 0),
+        )
+
+    def timings(self, src):
+        rows = self._execute(
+            "SELECT * FROM timings WHERE src = ? ORDER BY started", (src,)
+        )
+        return [dict(row) for row in rows]
+
+    def encoded(self, src, height, duration, cpu, srcbytes, dstbytes):
+        """record the outcome of an encode, for throughput()"""
+        self._execute(
+            "INSERT INTO encodes"
+            " (src, height, duration, cpu, srcbytes, dstbytes, finished)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (src, height, duration, cpu, srcbytes, dstbytes, time.time()),
+        )
+
+    def throughput(self, heightclass=None):
+        """{height class: (output bytes per second, cpu seconds per second)}
+        of content, from the encodes recorded so far"""
+        rows = self._execute(
+            "SELECT height, SUM(duration) AS duration, SUM(cpu) AS cpu,"
+            " SUM(dstbytes) AS dstbytes FROM encodes WHERE duration > 0"
+            " GROUP BY height"
+        )
+        totals = {}
+        for row in rows:
+            key = row["height"] if heightclass is None else heightclass(row["height"])
+            t = totals.setdefault(key, [0, 0, 0])
+            t[0] += row["duration"]
+            t[1] += row["cpu"]
+            t[2] += row["dstbytes"]
+        return {k: (t[2] / t[0], t[1] / t[0]) for k, t in totals.items()}
+
+    # pipeline listener interface
+
+    def stageDone(self, job, stagename, started, finished):
+        self.timing(job["src"], stagename, started, finished)
+        enc = job.get("encoded")
+        if stagename == "encode" and enc is not None:
+            self.encoded(
+                job["src"],
+                enc["height"],
+                enc["duration"],
+                (finished - started) * enc["cores"],
+                enc["srcbytes"],
+                enc["dstbytes"],
+            )
+
+    def stageFailed(self, job, stagename, started, finished, error):
+        self.timing(job["src"], stagename, started, finished, ok=False)
+        self.failed(job["src"], error)
@@ -0,0 +1,159 @@
+"""per stage timing and throughput metrics for tstomkv
+
+The stages time their steps (fetch, probe, encode, verify, upload, tvh
+update and remote delete) with measure(), which keeps the seconds, bytes
+and MB/s of each, and the fps and speed of an encode, in the job's
+"steps" list. Metrics is a pipeline listener that writes a json line for
+every stage a job finishes, or fails, with the steps it took, and keeps a
+Prometheus textfile collector file of running totals for each step, so it
+shows whether the network, the disk or the cpu is holding a host up.
+"""
+
+import json
+import os
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from tstomkv import errorNotify
+
+PREFIX = "tstomkv"
+
+
+@contextmanager
+def measure(job, step, nbytes=None):
+    """time the step of job, yields a dict to add "bytes" and other
+    figures to once they are known"""
+    record = {"step": step, "started": time.time(), "bytes": nbytes}
+    try:
+        yield record
+    finally:
+        record["seconds"] = round(time.time() - record["started"], 3)
+        if record["bytes"] and record["seconds"] > 0:
+            record["mbps"] = round(record["bytes"] / record["seconds"] / 1e6, 3)
+        job.setdefault("steps", []).append(record)
+
+
+def fileSize(path):
+    """the size of the local file path, or None"""
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return None
+
+
+def encodeFigures(record, event):
+    """add the fps and speed of the encode's last progress event"""
+    if event is not None:
+        record["fps"] = event.fps
+        record["speed"] = event.speed
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+
+class Metrics:
+    """Writes job metrics as json lines to logpath and, if promfile is
+    given, Prometheus textfile collector totals to promfile."""
+
+    def __init__(self, logpath=None, promfile=None, host=None):
+        self.logpath = logpath
+        self.promfile = promfile
+        self.host = socket.gethostname() if host is None else host
+        self._lock = threading.Lock()
+        # (stage, step) -> {"count", "seconds", "bytes"}
+        self.totals = {}
+        # stage -> count of failures
+        self.failures = {}
+        # step -> (fps, speed) of the last encode
+        self.last = {}
+
+    def _steps(self, job, started):
+        """the job's steps taken since the stage started, the steps of any
+        earlier attempts at it are dropped"""
+        steps = job.pop("steps", [])
+        return [s for s in steps if s["started"] >= started]
+
+    def _record(self, job, stagename, started, finished, error=None):
+        steps = self._steps(job, started)
+        line = {
+            "time": round(finished, 3),
+            "host": self.host,
+            "src": job.get("src"),
+            "stage": stagename,
+            "ok": error is None,
+            "seconds": round(finished - started, 3),
+            "steps": steps,
+        }
+        if error is not None:
+            line["error"] = str(error)
+        with self._lock:
+            for s in steps:
+                total = self.totals.setdefault(
+                    (stagename, s["step"]), {"count": 0, "seconds": 0.0, "bytes": 0}
+                )
+                total["count"] += 1
+                total["seconds"] += s["seconds"]
+                total["bytes"] += s["bytes"] or 0
+                if s.get("fps") is not None or s.get("speed") is not None:
+                    self.last[s["step"]] = (s.get("fps"), s.get("speed"))
+            if error is not None:
+                self.failures[stagename] = self.failures.get(stagename, 0) + 1
+            try:
+                if self.logpath is not None:
+                    with open(self.logpath, "a") as fp:
+                        fp.write(json.dumps(line) + "\n")
+                if self.promfile is not None:
+                    self.writeProm()
+            except Exception as e:
+                errorNotify(sys.exc_info()[2], e)
+
+    def promText(self):
+        """the totals in the Prometheus text exposition format"""
+        host = _label(self.host)
+        lines = []
+        for name, key, kind, text in (
+            ("step_runs_total", "count", "counter", "steps finished"),
+            ("step_seconds_total", "seconds", "counter", "seconds spent in steps"),
+            ("step_bytes_total", "bytes", "counter", "bytes moved by steps"),
+        ):
+            lines.append(f"# HELP {PREFIX}_{name} {text}")
+            lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+            for (stage, step), total in sorted(self.totals.items()):
+                labels = f'host="{host}",stage="{_label(stage)}"'
+                labels += f',step="{_label(step)}"'
+                lines.append(f"{PREFIX}_{name}{{{labels}}} {total[key]}")
+        lines.append(f"# HELP {PREFIX}_stage_failures_total jobs failed by stage")
+        lines.append(f"# TYPE {PREFIX}_stage_failures_total counter")
+        for stage, count in sorted(self.failures.items()):
+            labels = f'host="{host}",stage="{_label(stage)}"'
+            lines.append(f"{PREFIX}_stage_failures_total{{{labels}}} {count}")
+        for name, index, text in (
+            ("encode_fps", 0, "frames per second of the last encode"),
+            ("encode_speed", 1, "multiple of real time of the last encode"),
+        ):
+            lines.append(f"# HELP {PREFIX}_{name} {text}")
+            lines.append(f"# TYPE {PREFIX}_{name} gauge")
+            for step, figures in sorted(self.last.items()):
+                if figures[index] is not None:
+                    labels = f'host="{host}",step="{_label(step)}"'
+                    lines.append(f"{PREFIX}_{name}{{{labels}}} {figures[index]}")
+        return "\n".join(lines) + "\n"
+
+    def writeProm(self):
+        # written aside then renamed, so the collector never reads half a file
+        tmp = f"{self.promfile}.{os.getpid()}.tmp"
+        with open(tmp, "w") as fp:
+            fp.write(self.promText())
+        os.replace(tmp, self.promfile)
+
+    # pipeline listener interface
+
+    def stageDone(self, job, stagename, started, finished):
+        self._record(job, stagename, started, finished)
+
+    def stageFailed(self, job, stagename, started, finished, error):
+        self._record(job, stagename, started, finished, error=error)
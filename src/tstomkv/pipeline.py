@@ -0,0 +1,332 @@
+"""staged pipeline module for tstomkv
+
+Jobs are fed into the first stage and handed from stage to stage through
+bounded queues, so that whilst one recording is being transcoded the next
+can be fetched and the previous one uploaded. Pipeline runs each stage
+worker in a thread, AsyncPipeline runs them all as tasks on one asyncio
+event loop.
+"""
+
+import asyncio
+import inspect
+import queue
+import signal
+import sys
+import threading
+import time
+
+from tstomkv import errorNotify
+from tstomkv.cores import coreCount, encodeJobs
+from tstomkv.staging import parseSize
+
+# marker placed on a queue to tell a stage worker there is no more work
+_DONE = object()
+# returned by _runStage when the stage has failed the job
+_FAILED = object()
+
+
+class Stage:
+    """A named step of the pipeline, run by a number of worker threads.
+
+    func is called with the job dict and should return the job (possibly
+    updated) to pass it on to the next stage, or None to drop it.
+    If func raises it is tried again up to retries times, waiting backoff
+    seconds before the first retry and doubling the wait each time.
+    """
+
+    def __init__(self, name, func, workers=1, retries=0, backoff=30):
+        self.name = name
+        self.func = func
+        self.workers = max(1, int(workers))
+        self.retries = retries
+        self.backoff = backoff
+
+
+class Pipeline:
+    """Run jobs through a list of Stages connected by bounded queues.
+
+    queuedepth is the number of jobs that may wait between two stages.
+    stopcheck is an optional callable, checked before each new job is fed
+    in, that returns True when no more jobs should be started.
+    If abortonerror is True the first failure stops any new jobs
+    being started, jobs already in the pipeline are allowed to finish.
+    listeners are told as each stage finishes with a job, through their
+    stageDone(job, stagename, started, finished) and
+    stageFailed(job, stagename, started, finished, exception) methods.
+    """
+
+    def __init__(
+        self,
+        stages,
+        queuedepth=1,
+        stopcheck=None,
+        abortonerror=True,
+        listeners=None,
+    ):
+        self.stages = stages
+        self.queuedepth = max(1, int(queuedepth))
+        self.stopcheck = stopcheck
+        self.abortonerror = abortonerror
+        self.listeners = [] if listeners is None else listeners
+        self.completed = []
+        self.failed = []
+        self.stopped = False
+        self._abort = threading.Event()
+        self._lock = threading.Lock()
+
+    def _notify(self, event, *args):
+        for listener in self.listeners:
+            try:
+                getattr(listener, event)(*args)
+            except Exception as e:
+                errorNotify(sys.exc_info()[2], e)
+
+    def _runStage(self, stage, job):
+        attempt = 0
+        while True:
+            started = time.time()
+            try:
+                result = stage.func(job)
+            except Exception as e:
+                finished = time.time()
+                errorNotify(sys.exc_info()[2], e)
+                if attempt < stage.retries and not self._abort.is_set():
+                    delay = stage.backoff * 2**attempt
+                    attempt += 1
+                    print(f"{stage.name} failed for {job.get('src')}, retry in {delay}s")
+                    time.sleep(delay)
+                    continue
+                self._notify("stageFailed", job, stage.name, started, finished, e)
+                with self._lock:
+                    self.failed.append((job, stage.name, e))
+                if self.abortonerror:
+                    self._abort.set()
+                return _FAILED
+            self._notify("stageDone", job, stage.name, started, time.time())
+            return result
+
+    def _worker(self, index, inq, outq, remaining):
+        stage = self.stages[index]
+        while True:
+            job = inq.get()
+            if job is _DONE:
+                break
+            job = self._runStage(stage, job)
+            if job is None or job is _FAILED:
+                continue
+            if outq is None:
+                with self._lock:
+                    self.completed.append(job)
+            else:
+                outq.put(job)
+        with self._lock:
+            remaining[index] -= 1
+            last = remaining[index] == 0
+        if last and outq is not None:
+            # the last worker out tells every worker of the next stage to finish
+            for _ in range(self.stages[index + 1].workers):
+                outq.put(_DONE)
+
+    def run(self, jobs):
+        """Feed jobs through every stage, blocking until all are done.
+
+        returns a tuple of (completed jobs, failed (job, stagename, exception))
+        """
+        queues = [queue.Queue(maxsize=self.queuedepth) for _ in self.stages]
+        remaining = [stage.workers for stage in self.stages]
+        threads = []
+        for index, stage in enumerate(self.stages):
+            outq = queues[index + 1] if index + 1 < len(self.stages) else None
+            for n in range(stage.workers):
+                t = threading.Thread(
+                    target=self._worker,
+                    args=(index, queues[index], outq, remaining),
+                    name=f"{stage.name}-{n}",
+                )
+                t.start()
+                threads.append(t)
+        try:
+            for job in jobs:
+                if self._abort.is_set():
+                    break
+                if self.stopcheck is not None and self.stopcheck():
+                    self.stopped = True
+                    break
+                queues[0].put(job)
+        finally:
+            for _ in range(self.stages[0].workers):
+                queues[0].put(_DONE)
+            for t in threads:
+                t.join()
+        return self.completed, self.failed
+
+
+class AsyncPipeline(Pipeline):
+    """A Pipeline whose stage workers are asyncio tasks.
+
+    A stage func that is a coroutine function is awaited, any other is
+    run in a thread so a blocking transfer or tvheadend call doesn't hold
+    up the event loop. Cancelling the run, by cancel(), SIGTERM or ctrl-c,
+    cancels every stage in flight (killing the ffmpegs of asyncio encodes)
+    and leaves the jobs for the ledger to resume on the next run.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._loop = None
+        self._task = None
+
+    async def _runStage(self, stage, job):
+        attempt = 0
+        while True:
+            started = time.time()
+            try:
+                if inspect.iscoroutinefunction(stage.func):
+                    result = await stage.func(job)
+                else:
+                    result = await asyncio.to_thread(stage.func, job)
+            except Exception as e:
+                finished = time.time()
+                errorNotify(sys.exc_info()[2], e)
+                if attempt < stage.retries and not self._abort.is_set():
+                    delay = stage.backoff * 2**attempt
+                    attempt += 1
+                    print(f"{stage.name} failed for {job.get('src')}, retry in {delay}s")
+                    await asyncio.sleep(delay)
+                    continue
+                self._notify("stageFailed", job, stage.name, started, finished, e)
+                self.failed.append((job, stage.name, e))
+                if self.abortonerror:
+                    self._abort.set()
+                return _FAILED
+            self._notify("stageDone", job, stage.name, started, time.time())
+            return result
+
+    async def _worker(self, index, inq, outq, remaining):
+        stage = self.stages[index]
+        while True:
+            job = await inq.get()
+            if job is _DONE:
+                break
+            job = await self._runStage(stage, job)
+            if job is None or job is _FAILED:
+                continue
+            if outq is None:
+                self.completed.append(job)
+            else:
+                await outq.put(job)
+        remaining[index] -= 1
+        if remaining[index] == 0 and outq is not None:
+            # the last worker out tells every worker of the next stage to finish
+            for _ in range(self.stages[index + 1].workers):
+                await outq.put(_DONE)
+
+    async def _feed(self, jobs, inq):
+        try:
+            for job in jobs:
+                if self._abort.is_set():
+                    break
+                if self.stopcheck is not None and self.stopcheck():
+                    self.stopped = True
+                    break
+                await inq.put(job)
+        finally:
+            if not asyncio.current_task().cancelling():
+                for _ in range(self.stages[0].workers):
+                    await inq.put(_DONE)
+
+    async def arun(self, jobs):
+        """Pipeline.run on the running event loop"""
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.current_task()
+        try:
+            self._loop.add_signal_handler(signal.SIGTERM, self.cancel)
+        except (NotImplementedError, RuntimeError, ValueError):
+            pass  # not the main thread, or no signals here
+        queues = [asyncio.Queue(maxsize=self.queuedepth) for _ in self.stages]
+        remaining = [stage.workers for stage in self.stages]
+        try:
+            async with asyncio.TaskGroup() as tg:
+                for index, stage in enumerate(self.stages):
+                    outq = queues[index + 1] if index + 1 < len(self.stages) else None
+                    for n in range(stage.workers):
+                        tg.create_task(
+                            self._worker(index, queues[index], outq, remaining),
+                            name=f"{stage.name}-{n}",
+                        )
+                tg.create_task(self._feed(jobs, queues[0]), name="feed")
+        except asyncio.CancelledError:
+            # asyncio.run still raises KeyboardInterrupt after a ctrl-c
+            self.stopped = True
+        except ExceptionGroup as eg:
+            raise eg.exceptions[0]
+        finally:
+            try:
+                self._loop.remove_signal_handler(signal.SIGTERM)
+            except (NotImplementedError, RuntimeError, ValueError):
+                pass
+        return self.completed, self.failed
+
+    def cancel(self):
+        """cancel the run from any thread"""
+        if self._loop is not None and self._task is not None:
+            self._loop.call_soon_threadsafe(self._task.cancel)
+
+    def run(self, jobs):
+        """Feed jobs through every stage on a new event loop, see Pipeline.run"""
+        return asyncio.run(self.arun(jobs))
+
+
+def pipelineSettings(cfg):
+    """Read the pipeline section of the config, with defaults.
+
+    encodeworkers may be "auto" to run as many encodes at once as the
+    host's cores allow for SD recordings, HD recordings take a bigger
+    share of the cores so fewer of them will run together.
+    """
+    cores = cfg.get("pipeline", "cores", fallback="auto")
+    cores = coreCount() if cores == "auto" else int(cores)
+    encodeworkers = cfg.get("pipeline", "encodeworkers", fallback="1")
+    if encodeworkers == "auto":
+        encodeworkers = encodeJobs(cores)
+    return {
+        "fetchworkers": cfg.getint("pipeline", "fetchworkers", fallback=1),
+        "encodeworkers": int(encodeworkers),
+        "uploadworkers": cfg.getint("pipeline", "uploadworkers", fallback=1),
+        "queuedepth": cfg.getint("pipeline", "queuedepth", fallback=1),
+        "cores": cores,
+        "streaminput": cfg.getboolean("pipeline", "streaminput", fallback=False),
+        "streamoutput": cfg.getboolean("pipeline", "streamoutput", fallback=False),
+        "transferchannels": cfg.getint("pipeline", "transferchannels", fallback=1),
+        "verifytransfers": cfg.getboolean(
+            "pipeline", "verifytransfers", fallback=False
+        ),
+        "retries": cfg.getint("pipeline", "retries", fallback=2),
+        "retrybackoff": cfg.getint("pipeline", "retrybackoff", fallback=30),
+        "ledger": cfg.get("pipeline", "ledger", fallback=None),
+        "catalogue": cfg.get("pipeline", "catalogue", fallback=None),
+        "inventory": cfg.get("pipeline", "inventory", fallback=None),
+        "metrics": cfg.get("pipeline", "metrics", fallback=None),
+        "promfile": cfg.get("pipeline", "promfile", fallback=None),
+        "maxattempts": cfg.getint("pipeline", "maxattempts", fallback=5),
+        "failbackoff": cfg.getint("pipeline", "failbackoff", fallback=600),
+        "segments": cfg.getint("pipeline", "segments", fallback=1),
+        "segmentmin": cfg.getint("pipeline", "segmentminduration", fallback=3600),
+        "verify": {
+            "windows": cfg.getint("pipeline", "verifywindows", fallback=4),
+            "length": cfg.getint("pipeline", "verifywindowlength", fallback=10),
+            "workers": cfg.getint("pipeline", "verifyworkers", fallback=4),
+            "quality": cfg.getboolean("pipeline", "verifyquality", fallback=False),
+            "budget": cfg.getint("pipeline", "verifybudget", fallback=120),
+            "minssim": cfg.getfloat("pipeline", "verifyminssim", fallback=0.9),
+        },
+        "workerlease": cfg.getint("pipeline", "workerlease", fallback=300),
+        "workerheartbeat": cfg.getint("pipeline", "workerheartbeat", fallback=10),
+        "orchestrator": cfg.get("pipeline", "orchestrator", fallback="asyncio"),
+        "scheduleprobes": cfg.getint("pipeline", "scheduleprobes", fallback=200),
+        "stagingmax": parseSize(cfg.get("pipeline", "stagingmax", fallback=None)),
+        "stagingreserve": parseSize(
+            cfg.get("pipeline", "stagingreserve", fallback="5G")
+        )
+        or 0,
+    }
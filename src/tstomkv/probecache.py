@@ -0,0 +1,142 @@
+"""on-disk cache of ffprobe results for tstomkv
+
+Results are keyed on the file's path, size and mtime so a file that
+changes is probed again, files on the media server on their path and
+size. The cache is a sqlite database in ~/.cache/tstomkv (or under
+$XDG_CACHE_HOME) shared between runs, so a probe adds or touches one row
+rather than rewriting the whole cache.
+"""
+
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from tstomkv import __appname__, errorNotify
+
+# entries beyond this are dropped, least recently used first
+MAXENTRIES = 5000
+
+# prefix of the paths of files probed on the media server, which are keyed
+# on their size alone
+REMOTE = "mediaserver:"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS probes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    used REAL NOT NULL,
+    info TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS probesused ON probes (used);
+"""
+
+
+def cachePath():
+    cachehome = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cachehome, __appname__, "probe.db")
+
+
+class ProbeCache:
+    """ffprobe results stored in the sqlite database at path.
+
+    The database is opened on first use, a cache that can't be opened is
+    reported and treated as empty.
+    """
+
+    def __init__(self, path=None, maxentries=MAXENTRIES):
+        self.path = cachePath() if path is None else path
+        self.maxentries = maxentries
+        self._db = None
+        self._broken = False
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """the open database, or None if it can't be opened"""
+        if self._db is None and not self._broken:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+                self._db = sqlite3.connect(self.path, check_same_thread=False)
+                with self._db:
+                    self._db.executescript(SCHEMA)
+            except Exception as e:
+                errorNotify(sys.exc_info()[2], e)
+                self._broken = True
+        return self._db
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    @staticmethod
+    def _key(fqfn):
+        st = os.stat(fqfn)
+        return os.path.abspath(fqfn), st.st_size, st.st_mtime_ns
+
+    def get(self, fqfn):
+        """the cached probe of fqfn, or None if it has none or has changed"""
+        return self._get(*self._key(fqfn))
+
+    def put(self, fqfn, info):
+        self._put(*self._key(fqfn), info)
+
+    def getRemote(self, fqfn, size):
+        """the cached probe of fqfn on the media server, or None if it has
+        none or its size has changed"""
+        return self._get(f"{REMOTE}{fqfn}", size, 0)
+
+    def putRemote(self, fqfn, size, info):
+        self._put(f"{REMOTE}{fqfn}", size, 0, info)
+
+    def _get(self, path, size, mtime):
+        with self._lock:
+            db = self._connect()
+            if db is None:
+                return None
+            try:
+                with db:
+                    rows = db.execute(
+                        "SELECT size, mtime, info FROM probes WHERE path = ?",
+                        (path,),
+                    ).fetchall()
+                    if len(rows) == 0 or rows[0][0] != size or rows[0][1] != mtime:
+                        return None
+                    # kept so that eviction is least recently used across runs
+                    db.execute(
+                        "UPDATE probes SET used = ? WHERE path = ?",
+                        (time.time(), path),
+                    )
+                return json.loads(rows[0][2])
+            except Exception as e:
+                errorNotify(sys.exc_info()[2], e)
+                return None
+
+    def _put(self, path, size, mtime, info):
+        with self._lock:
+            db = self._connect()
+            if db is None:
+                return
+            try:
+                with db:
+                    db.execute(
+                        "INSERT OR REPLACE INTO probes (path, size, mtime, used, info)"
+                        " VALUES (?, ?, ?, ?, ?)",
+                        (path, size, mtime, time.time(), json.dumps(info)),
+                    )
+                    count = db.execute("SELECT COUNT(*) FROM probes").fetchone()[0]
+                    if count > self.maxentries:
+                        db.execute(
+                            "DELETE FROM probes WHERE path IN (SELECT path FROM"
+                            " probes ORDER BY used, rowid LIMIT ?)",
+                            (count - self.maxentries,),
+                        )
+            except Exception as e:
+                errorNotify(sys.exc_info()[2], e)
+
+
+cache = ProbeCache()
@@ -0,0 +1,175 @@
+"""encoding profiles for tstomkv
+
+A profile is the x265 preset and crf and the audio codec and bitrate to
+encode a recording with. It is chosen by matching rules against the
+recording's ffprobe streams (height, codec, field order) and, for tvh
+recordings, its metadata (category, channel, duration) so that cheap
+content like the news gets a fast preset and CPU time is spent where it
+saves the most bytes.
+
+Rules are read from [profile:<name>] sections of the config, in the order
+they appear, and the first that matches wins. There are no built in rules,
+a recording that matches none is encoded as before, with DEFAULTPROFILE:
+
+    [profile:kids]
+    channelname = CBBC, CBeebies
+    preset = fast
+    crf = 28
+
+Match keys (all given must match): category, channelname, codec and
+fieldorder take comma separated lists ("interlaced" matches any field order
+other than progressive), minheight, maxheight, minduration and maxduration
+are numbers, durations in seconds. A section with any other key, or a
+number that isn't one, stops the run when the config is loaded.
+
+Streams that are already efficiently coded (hevc video, aac audio) are
+copied into the mkv rather than re-encoded, unless the profile sets
+copy = no.
+"""
+
+from tstomkv.ffmpeg import infoDuration, infoVideoStream
+
+DEFAULTPROFILE = {
+    "preset": "medium",
+    "crf": None,
+    "audiocodec": "aac",
+    "audiobitrate": "128k",
+    "copy": "auto",
+}
+
+# codecs that re-encoding to x265/aac would save little on
+COPYVIDEO = ("hevc", "av1")
+COPYAUDIO = ("aac", "opus")
+
+SETTINGS = tuple(DEFAULTPROFILE)
+
+MATCHKEYS = (
+    "category",
+    "channelname",
+    "codec",
+    "fieldorder",
+    "minheight",
+    "maxheight",
+    "minduration",
+    "maxduration",
+)
+
+class ProfileError(Exception):
+    pass
+
+
+def _words(value):
+    return [w.strip().lower() for w in value.split(",") if w.strip() != ""]
+
+
+def ruleMatches(match, details):
+    """True if every key of the match dict agrees with the details"""
+    for key, value in match.items():
+        if key == "category":
+            cats = " ".join(details.get("category") or []).lower()
+            if not any(word in cats for word in _words(value)):
+                return False
+        elif key in ("channelname", "codec"):
+            if (details.get(key) or "").lower() not in _words(value):
+                return False
+        elif key == "fieldorder":
+            order = (details.get("fieldorder") or "progressive").lower()
+            wanted = _words(value)
+            interlaced = "interlaced" in wanted and order != "progressive"
+            if order not in wanted and not interlaced:
+                return False
+        elif key in ("minheight", "maxheight", "minduration", "maxduration"):
+            actual = details.get(key[3:])
+            if actual is None:
+                return False
+            if key.startswith("min") and actual < float(value):
+                return False
+            if key.startswith("max") and actual > float(value):
+                return False
+        else:
+            raise ValueError(f"unknown profile match key {key}")
+    return True
+
+
+def checkMatch(section, match):
+    """raise ProfileError if the match dict of the config section is wrong"""
+    for key, value in match.items():
+        if key not in MATCHKEYS:
+            raise ProfileError(
+                f"unknown match key {key} in [{section}],"
+                f" expected one of {', '.join(MATCHKEYS)}"
+            )
+        if key.startswith(("min", "max")):
+            try:
+                float(value)
+            except ValueError:
+                raise ProfileError(f"{key} in [{section}] is not a number: {value}")
+
+
+def configRules(cfg):
+    """the (name, match, settings) rules from the [profile:*] config sections
+
+    raises ProfileError for a section with a key that isn't understood.
+    """
+    rules = []
+    if cfg is None:
+        return rules
+    for section in cfg.sections():
+        if not section.startswith("profile:"):
+            continue
+        match, settings = {}, {}
+        for key, value in cfg[section].items():
+            if key in cfg.defaults():
+                continue
+            if key in SETTINGS:
+                settings[key] = value
+            else:
+                match[key] = value
+        checkMatch(section, match)
+        rules.append((section[len("profile:") :], match, settings))  # noqa: E203
+    return rules
+
+
+def copyDecision(finfo, settings=DEFAULTPROFILE):
+    """returns (copyvideo, copyaudio, reason) for the streams in finfo"""
+    if str(settings.get("copy", "auto")).lower() in ("no", "false", "off", "0"):
+        return False, False, "copying disabled by profile"
+    streams = [] if not finfo else finfo.get("streams", [])
+    video = [s.get("codec_name") for s in streams if s.get("codec_type") == "video"]
+    audio = [s.get("codec_name") for s in streams if s.get("codec_type") == "audio"]
+    copyvideo = len(video) > 0 and all(c in COPYVIDEO for c in video)
+    copyaudio = len(audio) > 0 and all(c in COPYAUDIO for c in audio)
+    reason = (
+        f"video {'/'.join(map(str, video)) or 'none'}"
+        f" {'copied' if copyvideo else 'encoded'},"
+        f" audio {'/'.join(map(str, audio)) or 'none'}"
+        f" {'copied' if copyaudio else 'encoded'}"
+    )
+    return copyvideo, copyaudio, reason
+
+
+def recordingDetails(finfo, rec=None):
+    """the details the rules match against, from ffprobe output and a tidied
+    tvh recording (see recordings.tidyRecording)"""
+    stream = infoVideoStream(finfo) or {}
+    details = {
+        "height": stream.get("height"),
+        "codec": stream.get("codec_name"),
+        "fieldorder": stream.get("field_order"),
+        "duration": infoDuration(finfo),
+    }
+    if rec is not None:
+        details["category"] = rec.get("category")
+        details["channelname"] = rec.get("channelname")
+        if details["duration"] is None:
+            details["duration"] = rec.get("duration")
+    return details
+
+
+def chooseProfile(finfo, rec=None, cfg=None):
+    """returns (name, settings) of the first matching profile"""
+    details = recordingDetails(finfo, rec)
+    for name, match, settings in configRules(cfg):
+        if ruleMatches(match, details):
+            return name, {**DEFAULTPROFILE, **settings}
+    return "default", dict(DEFAULTPROFILE)
@@ -0,0 +1,247 @@
+"""profiling of a tvhmkv or kodimkv run
+
+With --profile every call of a pipeline stage, and the listing of the
+recordings before them, is run between two tracemalloc snapshots and,
+unless another call already is, under cProfile. Since python 3.12 only
+one profiler can be active in a process, and it sees every thread, so
+calls that overlap the profiled one just have their figures recorded.
+Each call's wall time is split into this process's cpu, the cpu of the
+subprocesses it waited for (ffmpeg, ffprobe), from getrusage, and the
+rest, which is time spent waiting on the network, the disk or a
+subprocess. getrusage only counts the whole process's subprocesses, so
+the child cpu of a call that overlapped others (the fetch and upload
+threads, or encodes on the event loop) includes theirs, and the call is
+marked as overlapped. At the end of the run a bundle is written to a
+directory: a pstats file per stage, for snakeviz or pstats, the figures
+for every call as json lines, and summary.txt with the totals and the
+top hot spots of each stage.
+"""
+
+import cProfile
+import functools
+import inspect
+import io
+import json
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# frames kept for each traced allocation
+FRAMES = 5
+
+# subprocesses started, counted by the audit hook once profiling starts
+_spawned = [0]
+_hooked = [False]
+
+# held by the call that is running under cProfile
+_profiling = threading.Lock()
+
+
+def _audit(event, args):
+    if event == "subprocess.Popen":
+        _spawned[0] += 1
+
+
+def childTimes():
+    """(cpu seconds of the finished subprocesses, subprocesses started)"""
+    ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return ru.ru_utime + ru.ru_stime, _spawned[0]
+
+
+class Profiler:
+    """Profiles the stages of a run, writing a bundle to outdir.
+
+    top is the number of hot spots listed for each stage in the summary.
+    """
+
+    def __init__(self, outdir, top=25):
+        self.outdir = outdir
+        self.top = top
+        self.started = time.time()
+        # stage -> pstats.Stats of all its calls
+        self.stats = {}
+        # one dict of figures per call
+        self.calls = []
+        # the calls in progress -> whether it has overlapped another
+        self._active = {}
+        self._lock = threading.Lock()
+        if not _hooked[0]:
+            sys.addaudithook(_audit)
+            _hooked[0] = True
+        # stop tracing once the bundle is written, if it was started here
+        self._tracing = not tracemalloc.is_tracing()
+        if self._tracing:
+            tracemalloc.start(FRAMES)
+
+    @contextmanager
+    def section(self, name, src=None):
+        """profile the block as a call of the stage name"""
+        prof = None
+        if _profiling.acquire(blocking=False):
+            prof = cProfile.Profile()
+        token = object()
+        with self._lock:
+            for other in self._active:
+                self._active[other] = True
+            self._active[token] = len(self._active) > 0
+        before = tracemalloc.take_snapshot()
+        childcpu, spawned = childTimes()
+        wall, cpu = time.time(), time.thread_time()
+        if prof is not None:
+            try:
+                prof.enable()
+            except ValueError:
+                # a profiler from outside tstomkv is already active
+                _profiling.release()
+                prof = None
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            if prof is not None:
+                prof.disable()
+                _profiling.release()
+            wall, cpu = time.time() - wall, time.thread_time() - cpu
+            after = tracemalloc.take_snapshot()
+            childcpu2, spawned2 = childTimes()
+            current, peak = tracemalloc.get_traced_memory()
+            allocs = after.compare_to(before, "lineno")[:10]
+            with self._lock:
+                overlapped = self._active.pop(token)
+            call = {
+                "stage": name,
+                "src": src,
+                "ok": ok,
+                "profiled": prof is not None,
+                "wall": round(wall, 3),
+                "cpu": round(cpu, 3),
+                "childcpu": round(childcpu2 - childcpu, 3),
+                "subprocesses": spawned2 - spawned,
+                # childcpu and subprocesses include the other calls'
+                "overlapped": overlapped,
+                "waiting": round(max(0, wall - cpu), 3),
+                "memory": current,
+                "peakmemory": peak,
+                "allocations": [
+                    {"where": str(a.traceback[0]), "bytes": a.size_diff}
+                    for a in allocs
+                    if a.size_diff > 0
+                ],
+            }
+            with self._lock:
+                self.calls.append(call)
+                if prof is not None and name in self.stats:
+                    self.stats[name].add(prof)
+                elif prof is not None:
+                    self.stats[name] = pstats.Stats(prof)
+
+    def wrap(self, name, func):
+        """func, a stage func taking a job, profiled as the stage name"""
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def profiled(job):
+                # on the event loop this also catches the other tasks
+                # that ran whilst this one was waiting
+                with self.section(name, job.get("src")):
+                    return await func(job)
+
+        else:
+
+            @functools.wraps(func)
+            def profiled(job):
+                with self.section(name, job.get("src")):
+                    return func(job)
+
+        return profiled
+
+    def totals(self):
+        """{stage: {"calls", "profiled", "wall", "cpu", "childcpu",
+        "waiting", "subprocesses"}}"""
+        totals = {}
+        for call in self.calls:
+            total = totals.setdefault(
+                call["stage"],
+                {
+                    "calls": 0,
+                    "profiled": 0,
+                    "wall": 0.0,
+                    "cpu": 0.0,
+                    "childcpu": 0.0,
+                    "waiting": 0.0,
+                    "subprocesses": 0,
+                },
+            )
+            total["calls"] += 1
+            total["profiled"] += call["profiled"]
+            for key in ("wall", "cpu", "childcpu", "waiting", "subprocesses"):
+                total[key] += call[key]
+        return totals
+
+    def hotSpots(self, name):
+        """the top functions of the stage name by cumulative time, as text"""
+        out = io.StringIO()
+        stats = self.stats[name]
+        stats.stream = out
+        stats.sort_stats("cumulative").print_stats(self.top)
+        return out.getvalue()
+
+    def summary(self):
+        lines = [f"run of {time.time() - self.started:.1f}s"]
+        overlapped = sum(call["overlapped"] for call in self.calls)
+        if overlapped > 0:
+            lines.append(
+                f"{overlapped} of {len(self.calls)} calls overlapped others,"
+                " their childcpu and subprocs include the others' so are"
+                " approximate"
+            )
+        lines.append(
+            f"{'stage':<10} {'calls':>5} {'profiled':>8} {'wall':>9} {'cpu':>9}"
+            f" {'childcpu':>9} {'waiting':>9} {'subprocs':>8}"
+        )
+        totals = self.totals()
+        for name, t in totals.items():
+            lines.append(
+                f"{name:<10} {t['calls']:>5} {t['profiled']:>8} {t['wall']:>9.1f}"
+                f" {t['cpu']:>9.1f} {t['childcpu']:>9.1f} {t['waiting']:>9.1f}"
+                f" {t['subprocesses']:>8}"
+            )
+        allocs = {}
+        for call in self.calls:
+            for a in call["allocations"]:
+                allocs[a["where"]] = allocs.get(a["where"], 0) + a["bytes"]
+        lines.append("")
+        lines.append("largest allocations kept by a stage:")
+        biggest = sorted(allocs.items(), key=lambda a: -a[1])
+        for where, size in biggest[: self.top]:  # noqa: E203
+            lines.append(f"{size:>12} {where}")
+        for name in self.stats:
+            lines.append("")
+            lines.append(
+                f"hot spots of the {name} stage,"
+                f" from {totals[name]['profiled']} of its calls:"
+            )
+            lines.append(self.hotSpots(name))
+        return "\n".join(lines)
+
+    def write(self):
+        """write the bundle to outdir, returns the summary"""
+        os.makedirs(self.outdir, exist_ok=True)
+        with self._lock:
+            for name, stats in self.stats.items():
+                stats.dump_stats(os.path.join(self.outdir, f"{name}.prof"))
+            with open(os.path.join(self.outdir, "calls.jsonl"), "w") as fp:
+                for call in self.calls:
+                    fp.write(json.dumps(call) + "\n")
+            summary = self.summary()
+        with open(os.path.join(self.outdir, "summary.txt"), "w") as fp:
+            fp.write(summary + "\n")
+        if self._tracing:
+            tracemalloc.stop()
+        return summary
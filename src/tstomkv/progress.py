@@ -0,0 +1,156 @@
+"""ffmpeg progress events for tstomkv
+
+ffmpeg's -progress output is a series of key=value blocks, each ended by
+a progress=continue or progress=end line. The file is tailed from where
+the last read stopped, so each poll only costs the new blocks, and every
+block becomes a ProgressEvent. Events are also produced when ffmpeg exits
+without finishing, or stops making progress, so nothing waits forever.
+"""
+
+import os
+import time
+from dataclasses import dataclass
+
+# kinds of ProgressEvent
+PROGRESS = "progress"
+END = "end"
+EXITED = "exited"
+STALLED = "stalled"
+NOSTATS = "nostats"
+
+
+@dataclass(frozen=True)
+class ProgressEvent:
+    kind: str
+    frame: int | None = None
+    fps: float | None = None
+    bitrate: float | None = None  # kbits/s
+    total_size: int | None = None  # bytes
+    out_time: float | None = None  # seconds of output written
+    speed: float | None = None  # multiple of real time
+
+    @property
+    def finished(self):
+        return self.kind != PROGRESS
+
+
+def _number(value, convert, suffix=""):
+    value = value.strip()
+    if suffix and value.endswith(suffix):
+        value = value[: -len(suffix)]  # noqa: E203
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parseBlock(stats):
+    """a ProgressEvent from a dict of one block of ffmpeg -progress output"""
+    outtime = _number(stats.get("out_time_us", ""), int)
+    return ProgressEvent(
+        kind=END if stats.get("progress") == "end" else PROGRESS,
+        frame=_number(stats.get("frame", ""), int),
+        fps=_number(stats.get("fps", ""), float),
+        bitrate=_number(stats.get("bitrate", ""), float, "kbits/s"),
+        total_size=_number(stats.get("total_size", ""), int),
+        out_time=None if outtime is None else outtime / 1_000_000,
+        speed=_number(stats.get("speed", ""), float, "x"),
+    )
+
+
+class ProgressTail:
+    """Reads the blocks added to an ffmpeg -progress file since the last read."""
+
+    def __init__(self, statsfile):
+        self.statsfile = statsfile
+        self.offset = 0
+        self._partial = ""
+        self._block = {}
+
+    def read(self):
+        """the events for the blocks completed since the last call"""
+        try:
+            with open(self.statsfile, "r") as sf:
+                sf.seek(self.offset)
+                data = sf.read()
+                self.offset = sf.tell()
+        except FileNotFoundError:
+            return []
+        return self.feed(data)
+
+    def feed(self, data):
+        """the events for the blocks completed by data, the next part of
+        the file, however it was read"""
+        events = []
+        lines = (self._partial + data).split("\n")
+        # the last line may not have been completely written yet
+        self._partial = lines.pop()
+        for line in lines:
+            if "=" not in line:
+                continue
+            k, v = line.strip().split("=", 1)
+            self._block[k] = v
+            if k == "progress":
+                events.append(parseBlock(self._block))
+                self._block = {}
+        return events
+
+
+class ProgressWatch:
+    """Follows an encode writing to statsfile, one poll at a time.
+
+    poll() returns (events, wait): the new ProgressEvents and the seconds
+    to wait before polling again, or None once the last event is in
+    events. The waiting is left to the caller, so the same polls drive
+    progressEvents and its asyncio twin in aio.
+    """
+
+    def __init__(self, statsfile, alive=None, interval=5, stall=600, startup=60):
+        self.statsfile = statsfile
+        self.alive = alive
+        self.interval = interval
+        self.stall = stall
+        self.startup = startup
+        self.tail = ProgressTail(statsfile)
+        self.started = time.time()
+        # when ffmpeg last wrote a block, None until the file appears
+        self.lastchange = None
+
+    def poll(self):
+        if self.lastchange is None:
+            if not os.path.exists(self.statsfile):
+                if self.alive is not None and not self.alive():
+                    return [ProgressEvent(kind=EXITED)], None
+                if time.time() - self.started > self.startup:
+                    return [ProgressEvent(kind=NOSTATS)], None
+                return [], min(self.interval, 1)
+            self.lastchange = time.time()
+        running = self.alive is None or self.alive()
+        events = self.tail.read()
+        for n, event in enumerate(events):
+            if event.kind == END:
+                return events[: n + 1], None  # noqa: E203
+        if len(events) > 0:
+            self.lastchange = time.time()
+        elif not running:
+            return [ProgressEvent(kind=EXITED)], None
+        elif time.time() - self.lastchange > self.stall:
+            return [ProgressEvent(kind=STALLED)], None
+        return events, self.interval
+
+
+def progressEvents(statsfile, alive=None, interval=5, stall=600, startup=60):
+    """yields ProgressEvents for an encode writing to statsfile.
+
+    alive, if given, is a callable returning False once ffmpeg has exited.
+    Ends with an END event, or EXITED if ffmpeg went away without one,
+    STALLED if nothing was written for stall seconds or NOSTATS if the file
+    did not appear within startup seconds.
+    """
+    watch = ProgressWatch(statsfile, alive, interval, stall, startup)
+    while True:
+        events, wait = watch.poll()
+        yield from events
+        if wait is None:
+            return
+        time.sleep(wait)
@@ -5,7 +5,7 @@ import sys
 import time
 
 from tstomkv import errorNotify
-from tstomkv.tvh import allRecordings
+from tstomkv.tvh import finishedRecordings
 
 
 def cleanStringStart(xstr, remove="new:"):
@@ -91,13 +91,27 @@ def getEpisode(eps):
         errorNotify(sys.exc_info()[2], e)
 
 
-def recordedTitles():
+def tidiedRecordings(catalogue=None):
+    """yields the tidied finished recordings, from the catalogue if given
+    (synced first) or straight from tvheadend"""
+    if catalogue is not None:
+        changed, removed = catalogue.sync()
+        print(f"Catalogue synced, {changed} recordings updated, {removed} removed")
+        yield from catalogue.recordings()
+    else:
+        for rec in finishedRecordings():
+            show = tidyRecording(rec)
+            if show is not None:
+                yield show
+
+
+def recordedTitles(catalogue=None):
     """Obtain all recorded titles as a dictionary of lists of those recordings."""  # noqa: E501
     try:
-        recs, tot = allRecordings()
+        recs = []
         titles = {}
-        for rec in recs:
-            show = tidyRecording(rec)
+        for show in tidiedRecordings(catalogue):
+            recs.append(show)
             if not show["filename"].startswith("/var/lib/tvheadend/radio"):
                 if show["title"] not in titles:
                     titles[show["title"]] = []
@@ -107,18 +121,16 @@ def recordedTitles():
         errorNotify(sys.exc_info()[2], e)
 
 
-def filteredTitles(filetype=".ts"):
+def filteredTitles(filetype=".ts", catalogue=None):
     """Obtain all recorded titles as a dictionary of lists of those recordings."""  # noqa: E501
     try:
-        recs, tot = allRecordings()
         titles = {}
         tsrecs = []
-        for rec in recs:
-            if not rec["filename"].lower().endswith(filetype.lower()):
-                # print(f"Skipping {rec['filename']}")
+        for show in tidiedRecordings(catalogue):
+            if not show["filename"].lower().endswith(filetype.lower()):
+                # print(f"Skipping {show['filename']}")
                 continue
-            show = tidyRecording(rec)
-            tsrecs.append(rec)
+            tsrecs.append(show)
             if not show["filename"].startswith("/var/lib/tvheadend/radio"):
                 if show["title"] not in titles:
                     titles[show["title"]] = []
@@ -0,0 +1,223 @@
+"""transcoding on the media server for tstomkv
+
+When the media server has cores to spare, fetching the transport stream
+and sending the mkv back are two full copies over the network for nothing.
+In remote mode ffmpeg runs on the media server itself, over the usual ssh
+connection, reading the recording where it lies and writing the mkv to a
+work directory there. Its progress file is tailed over ssh and the output
+is checked with ffprobe on the media server, its duration and, unless
+verifywindows is 0, its streams and sampled windows (see verify), so only
+a few kilobytes cross the network. The upload stage then moves the mkv in
+beside the recording.
+
+Each host running tstomkv encodes where the encode key of its
+[host:<hostname>] section says, or else where the [mediaserver] one does:
+
+    [mediaserver]
+    # local or remote
+    encode = local
+    # where the media server keeps encodes in progress
+    workdir = /var/tmp/tstomkv
+    # encodes to run there at once
+    slots = 1
+    # cores to give x265 there, all of them if unset
+    cores = 4
+
+    [host:laptop]
+    encode = remote
+"""
+
+import shlex
+import socket
+import time
+from pathlib import Path
+
+from tstomkv import progressBar
+from tstomkv.cores import x265Params
+from tstomkv.ffmpeg import infoDuration, remoteFileInfo, transcodeCommand
+from tstomkv.files import mediaServer, pathManipulation
+from tstomkv.metrics import encodeFigures, measure
+from tstomkv.profiles import chooseProfile, copyDecision
+from tstomkv.progress import END, ProgressTail
+from tstomkv.stages import (
+    CopyError,
+    humanTime,
+    markState,
+    reached,
+    verificationReport,
+)
+from tstomkv.verify import verifyOutput
+from tstomkv.workers import Worker, jobName
+
+ENCODEMODES = ("local", "remote")
+WORKDIR = "/var/tmp/tstomkv"
+# seconds between polls of the remote encode's progress
+HEARTBEAT = 10
+# seconds without progress before the remote encode is given up on
+STALL = 600
+
+
+class RemoteEncodeError(Exception):
+    pass
+
+
+def encodeMode(cfg, hostname=None):
+    """"local" or "remote", where this host's encodes should run"""
+    hostname = socket.gethostname() if hostname is None else hostname
+    mode = "local"
+    if cfg.has_section("mediaserver"):
+        mode = cfg.get("mediaserver", "encode", fallback=mode)
+    for name in (hostname, hostname.split(".")[0]):
+        if cfg.has_section(f"host:{name}"):
+            mode = cfg.get(f"host:{name}", "encode", fallback=mode)
+            break
+    mode = mode.strip().lower()
+    if mode not in ENCODEMODES:
+        raise RemoteEncodeError(f"unknown encode mode {mode} for {hostname}")
+    return mode
+
+
+def mediaServerWorker(cfg):
+    """the media server as a workers.Worker"""
+    host, user, keyfn = mediaServer()
+    cores = cfg.get("mediaserver", "cores", fallback=None)
+    return Worker(
+        "mediaserver",
+        host,
+        user,
+        keyfn,
+        workdir=cfg.get("mediaserver", "workdir", fallback=WORKDIR),
+        slots=cfg.getint("mediaserver", "slots", fallback=1),
+        cores=None if cores is None else int(cores),
+    )
+
+
+def followRemote(worker, pid, rstats, duration, heartbeat=HEARTBEAT, stall=STALL):
+    """follow the progress of the worker's ffmpeg until it finishes
+
+    returns the END ProgressEvent, raises RemoteEncodeError if ffmpeg goes
+    away without finishing or stops making progress.
+    """
+    tail = ProgressTail(rstats)
+    lastchange = time.time()
+    while True:
+        running = worker.alive(pid)
+        data = worker.read(rstats, tail.offset)
+        tail.offset += len(data.encode())
+        events = tail.feed(data)
+        for event in events:
+            if duration and event.out_time is not None:
+                progressBar(event.out_time, duration)
+            if event.kind == END:
+                if duration:
+                    print()
+                return event
+        if len(events) > 0:
+            lastchange = time.time()
+        elif not running:
+            raise RemoteEncodeError(f"ffmpeg on {worker.host} exited without finishing")
+        elif time.time() - lastchange > stall:
+            worker.kill(pid)
+            raise RemoteEncodeError(f"ffmpeg on {worker.host} stopped making progress")
+        time.sleep(heartbeat)
+
+
+def remoteDuration(duration, rfn, threshold=0.9):
+    """stages.checkDuration, probing rfn on the media server"""
+    dur2 = infoDuration(remoteFileInfo(rfn))
+    print(f"Duration of {rfn} is {dur2} seconds")
+    return bool(duration and dur2 and dur2 >= duration * threshold)
+
+
+def remoteExists(worker, rfn):
+    out = worker.run(f"test -e {shlex.quote(rfn)} && echo yes || echo no")
+    return out.strip() == "yes"
+
+
+def remoteEncodeStage(
+    job, cfg=None, worker=None, heartbeat=HEARTBEAT, stall=STALL, verify=None
+):
+    """transcode the recording on the media server and check the result
+
+    worker is the media server, see mediaServerWorker. the mkv is left in
+    its workdir, as job["remotemkv"], for the upload stage to move into
+    place. verify is as for stages.encodeStage, the windows are decoded on
+    the media server.
+    """
+    fps = pathManipulation(job["src"], replace=job["replace"], mkdestdir=False)
+    job["fps"] = fps
+    if reached(job, "uploaded"):
+        job["uploaded"] = True
+        return job
+    # the same file name can turn up in two directories at once
+    name = jobName(fps["src"])
+    rdst = worker.path(Path(name).with_suffix(".mkv").name)
+    job["remotemkv"] = rdst
+    if reached(job, "verified") and remoteExists(worker, rdst):
+        print(f"{rdst} already transcoded and checked")
+        return job
+    with measure(job, "probe"):
+        finfo = remoteFileInfo(str(fps["src"]))
+    duration = infoDuration(finfo)
+    if duration is None and "rec" in job:
+        # no ffprobe on the media server, fall back to the tvh recording
+        duration = job["rec"].get("duration")
+    pname, profile = chooseProfile(finfo, job.get("rec"), cfg)
+    copyvideo, copyaudio, reason = copyDecision(finfo, profile)
+    profile.update(copyvideo=copyvideo, copyaudio=copyaudio)
+    job["profile"] = pname
+    job["copied"] = {"video": copyvideo, "audio": copyaudio}
+    print(f"Encoding {fps['src']} on the media server, {pname} profile: {reason}")
+    rstats = worker.path(f"{name}-transcode.stats")
+    rlog = worker.path(f"{name}.log")
+    worker.remove(rdst, rstats, rlog)
+    x265params = None
+    if worker.cores is not None and not copyvideo:
+        x265params = x265Params(worker.cores)
+    cmd = transcodeCommand(
+        str(fps["src"]), rdst, rstats, x265params=x265params, profile=profile
+    )
+    starttime = time.time()
+    pid = worker.start(cmd, rlog)
+    try:
+        with measure(job, "encode") as step:
+            job["progress"] = followRemote(
+                worker, pid, rstats, duration, heartbeat=heartbeat, stall=stall
+            )
+            step["bytes"] = job["progress"].total_size
+            encodeFigures(step, job["progress"])
+    except Exception:
+        print(worker.read(rlog, 0)[-2000:])
+        worker.remove(rdst)
+        raise
+    finally:
+        worker.remove(rstats, rlog)
+    markState(job, "encoded")
+    print(f"Duration of {fps['src']} is {duration} seconds")
+    with measure(job, "verify"):
+        checked = remoteDuration(duration, rdst)
+        report = None
+        if checked and verify is not None and verify["windows"] > 0:
+            report = verifyOutput(
+                str(fps["src"]),
+                rdst,
+                srcinfo=finfo,
+                run=worker.execute,
+                probe=remoteFileInfo,
+                **verify,
+            )
+    if not checked:
+        print("Duration check FAILED, not moving file or deleting source")
+        worker.remove(rdst)
+        raise CopyError(f"Duration check failed for {rdst}")
+    print("Duration check OK")
+    if report is not None:
+        try:
+            verificationReport(job, report, rdst)
+        except CopyError:
+            worker.remove(rdst)
+            raise
+    markState(job, "verified")
+    print(f"time taken to transcode: {humanTime(time.time() - starttime)}")
+    return job
+
@@ -0,0 +1,176 @@
+"""ordering of pending work for tstomkv
+
+Recordings are encoded in the order that reclaims the most storage for
+each hour of cpu spent: a huge mpeg2 film goes before a short recording
+that is already compact, and hevc recordings, which are only remuxed,
+cost next to nothing. The bytes saved and the cpu time are estimated from
+the recording's size, duration, codec and resolution, using the rates
+seen in earlier encodes (see ledger.Ledger.throughput) once there are
+some, and the rough figures below until then. The codec and resolution
+come from ffprobe run on the media server before the recordings are
+fetched, see probeJobs, probes are cached so each file is probed once.
+
+Titles can be given a [title:<name>] section of the config:
+
+    [title:Doctor Who]
+    # go before everything that isn't pinned, in the order pinned
+    pin = yes
+    # multiplies the title's score
+    priority = 2
+    # must be encoded within this many days of being recorded
+    deadline = 3
+
+Pinned titles come first, then recordings whose deadline falls within a
+day, soonest first, then the rest by score times priority.
+"""
+
+import sys
+import time
+
+from tstomkv import errorNotify, probecache
+from tstomkv.ffmpeg import remoteFileInfo
+
+# frame height: (output bytes per second of content, cpu seconds per second
+# of content) for an x265 medium encode, used until there is history
+RATES = {
+    576: (200_000, 6.0),
+    720: (375_000, 15.0),
+    1080: (600_000, 30.0),
+    2160: (2_000_000, 120.0),
+}
+
+# assumed bitrate, bytes/second, of a recording whose duration isn't known
+SOURCERATE = 600_000
+
+# recordings due within this many seconds go before the rest
+HORIZON = 24 * 60 * 60
+
+# cpu seconds per second of content of a remux
+COPYCOST = 0.05
+
+COPYCODECS = ("hevc", "av1")
+
+# recordings probed on the media server for scheduling in one run, those
+# not yet in the probe cache beyond this are scored without one
+PROBELIMIT = 200
+
+
+def heightClass(height):
+    """the RATES key for a frame height"""
+    if height is None:
+        return 576
+    for key in sorted(RATES):
+        if height <= key:
+            return key
+    return max(RATES)
+
+
+def titleSettings(cfg):
+    """{lower case title: {"pin", "priority", "deadline"}} from the config"""
+    titles = {}
+    if cfg is None:
+        return titles
+    for section in cfg.sections():
+        if not section.startswith("title:"):
+            continue
+        sect = cfg[section]
+        deadline = sect.get("deadline")
+        titles[section[len("title:") :].strip().lower()] = {  # noqa: E203
+            "pin": sect.getboolean("pin", fallback=False),
+            "priority": sect.getfloat("priority", fallback=1.0),
+            "deadline": None if deadline is None else float(deadline) * 86400,
+        }
+    return titles
+
+
+def jobDetails(job):
+    """(title, size, duration, height, codec, recorded) of a job, any of
+    which may be None"""
+    rec = job.get("rec") or {}
+    title = rec.get("title")
+    size = rec.get("filesize") or job.get("filesize")
+    duration = rec.get("duration")
+    recorded = rec.get("start_real") or rec.get("recorddate")
+    height = codec = None
+    info = job.get("srcinfo")
+    if info:
+        for stream in info.get("streams", []):
+            if stream.get("codec_type") == "video":
+                height, codec = stream.get("height"), stream.get("codec_name")
+                break
+    if height is None and "HD" in (rec.get("channelname") or "").split():
+        height = 1080
+    return title, size, duration, height, codec, recorded
+
+
+def probeJobs(jobs, limit=PROBELIMIT, probe=remoteFileInfo):
+    """give the jobs that have no "srcinfo" the ffprobe output of their
+    recording on the media server, from the probe cache or, for up to
+    limit of them, by probing it. returns jobs"""
+    probed = 0
+    for job in jobs:
+        size = jobDetails(job)[1]
+        if job.get("srcinfo") or not size:
+            continue
+        info = probecache.cache.getRemote(job["src"], size)
+        if info is None and probed < limit:
+            probed += 1
+            try:
+                info = probe(job["src"])
+            except Exception as e:
+                errorNotify(sys.exc_info()[2], e)
+            if info:
+                probecache.cache.putRemote(job["src"], size, info)
+        if info:
+            job["srcinfo"] = info
+    if probed > 0:
+        print(f"Probed {probed} recordings on the media server for scheduling")
+    return jobs
+
+
+def estimate(job, history=None):
+    """(bytes saved, cpu seconds) expected from encoding job
+
+    history is ledger.Ledger.throughput(), {height class: (output bytes per
+    second, cpu seconds per second)} from earlier encodes.
+    """
+    _, size, duration, height, codec, _ = jobDetails(job)
+    if not size:
+        return 0, 0
+    duration = duration or size / SOURCERATE
+    key = heightClass(height)
+    outrate, cpurate = (history or {}).get(key, RATES[key])
+    if codec in COPYCODECS:
+        return 0, duration * COPYCOST
+    return max(0, size - outrate * duration), duration * cpurate
+
+
+def score(job, history=None):
+    """bytes saved per cpu hour"""
+    saved, cpu = estimate(job, history)
+    return 0 if cpu <= 0 else saved / (cpu / 3600)
+
+
+def scheduleJobs(jobs, cfg=None, history=None, now=None):
+    """jobs in the order they should be done"""
+    now = time.time() if now is None else now
+    titles = titleSettings(cfg)
+    pinned, due, rest = [], [], []
+    pinorder = list(titles)
+    for job in jobs:
+        title, _, _, _, _, recorded = jobDetails(job)
+        settings = titles.get((title or "").strip().lower(), {})
+        if settings.get("pin"):
+            pinned.append((pinorder.index(title.strip().lower()), job))
+            continue
+        deadline = settings.get("deadline")
+        if deadline is not None and recorded:
+            dueby = recorded + deadline
+            if dueby - now <= HORIZON:
+                due.append((dueby, job))
+                continue
+        rest.append((score(job, history) * settings.get("priority", 1.0), job))
+    pinned.sort(key=lambda p: p[0])
+    due.sort(key=lambda d: d[0])
+    rest.sort(key=lambda r: r[0], reverse=True)
+    return [j for _, j in pinned] + [j for _, j in due] + [j for _, j in rest]
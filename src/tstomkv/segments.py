@@ -0,0 +1,179 @@
+"""segment-parallel encoding for tstomkv
+
+One x265 encode of a long recording doesn't keep a big machine busy, so
+the video is cut at keyframes into segments (a stream copy, so it only
+costs the disk reads), the segments are encoded at the same time, each
+by its own ffmpeg process with a share of the cores, and the encoded
+segments are joined with the concat demuxer. The audio and subtitles are
+taken from the whole recording in one pass, so there are no gaps or
+glitches at the joins, and muxed in with the joined video. The segments'
+timestamps start again at 0, so the joined video is put back at the
+video's start in the recording, keeping it in step with the audio.
+"""
+
+import math
+import os
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from tstomkv import errorRaise
+from tstomkv.ffmpeg import checkOutputFile, fileInfo, infoVideoStream
+from tstomkv.shell import shellCommand
+
+FFMPEG = ["ffmpeg", "-loglevel", "error", "-hide_banner", "-y"]
+
+
+class SegmentError(Exception):
+    pass
+
+
+def splitCommand(src, segdir, seconds):
+    """cut the video of src into segments of about seconds long at keyframes"""
+    return FFMPEG + [
+        "-i",
+        src,
+        "-map",
+        "0:v:0",
+        "-c",
+        "copy",
+        "-f",
+        "segment",
+        "-segment_time",
+        str(seconds),
+        "-reset_timestamps",
+        "1",
+        os.path.join(segdir, "seg%04d.ts"),
+    ]
+
+
+def segmentCommand(segment, output, x265params=None, profile=None):
+    """encode the video of one segment"""
+    profile = {} if profile is None else profile
+    cmd = FFMPEG + ["-i", segment, "-map", "0:v:0", "-c:v", "libx265"]
+    cmd.extend(["-preset", profile.get("preset") or "medium"])
+    if profile.get("crf") is not None:
+        cmd.extend(["-crf", str(profile["crf"])])
+    if x265params is not None:
+        cmd.extend(["-x265-params", x265params])
+    cmd.append(output)
+    return cmd
+
+
+def audioCommand(src, output, profile=None):
+    """take the audio and subtitles of the whole of src, without the video"""
+    profile = {} if profile is None else profile
+    cmd = FFMPEG + ["-i", src, "-map", "0:a?", "-map", "0:s?", "-vn"]
+    if profile.get("copyaudio"):
+        cmd.extend(["-c:a", "copy"])
+    else:
+        cmd.extend(["-c:a", profile.get("audiocodec") or "aac"])
+        cmd.extend(["-b:a", profile.get("audiobitrate") or "128k"])
+    cmd.extend(["-c:s", "copy", output])
+    return cmd
+
+
+def videoOffset(finfo):
+    """seconds from the start of the recording to the start of its video"""
+    stream = infoVideoStream(finfo) or {}
+    try:
+        start = float(finfo["format"]["start_time"])
+        return max(0.0, round(float(stream["start_time"]) - start, 6))
+    except (KeyError, TypeError, ValueError):
+        return 0.0
+
+
+def concatCommand(listfile, audio, output, offset=0.0):
+    """join the encoded video segments and mux in the audio and subtitles
+
+    the joined video starts at 0 and is moved offset seconds later, the
+    audio keeps the timestamps audioCommand gave it.
+    """
+    return FFMPEG + [
+        "-copyts",
+        "-itsoffset",
+        str(offset),
+        "-f",
+        "concat",
+        "-safe",
+        "0",
+        "-i",
+        listfile,
+        "-i",
+        audio,
+        "-map",
+        "0:v",
+        "-map",
+        "1",
+        "-c",
+        "copy",
+        output,
+    ]
+
+
+def writeConcatList(listfile, segments):
+    with open(listfile, "w") as fp:
+        for segment in segments:
+            # the concat demuxer wants single quotes escaped as '\''
+            escaped = str(segment).replace("'", "'\\''")
+            fp.write(f"file '{escaped}'\n")
+
+
+def segmentSeconds(duration, segments):
+    """how long to make each segment so there are about segments of them"""
+    return max(1, math.ceil(duration / segments))
+
+
+def segmentedEncode(
+    src,
+    dst,
+    duration,
+    segments=4,
+    x265params=None,
+    profile=None,
+    overwrite=False,
+    workdir=None,
+    srcinfo=None,
+):
+    """encode src to dst by encoding segments of it at the same time
+
+    x265params is given to each segment's encoder, so should be that
+    encoder's share of the cores. The segments are kept in workdir
+    (default dst.segments) which is removed once dst is written.
+    srcinfo is the ffprobe output of src, probed if None, for the start of
+    its video.
+    """
+    try:
+        checkOutputFile(dst, overwrite=overwrite)
+        workdir = f"{dst}.segments" if workdir is None else workdir
+        shutil.rmtree(workdir, ignore_errors=True)
+        Path(workdir).mkdir(mode=0o755, parents=True)
+        seconds = segmentSeconds(duration, segments)
+        print(f"Splitting {src} into {seconds} second segments")
+        shellCommand(splitCommand(src, workdir, seconds))
+        parts = sorted(Path(workdir).glob("seg*.ts"))
+        if len(parts) == 0:
+            raise SegmentError(f"no segments were cut from {src}")
+        encoded = [part.with_suffix(".mkv") for part in parts]
+        audio = os.path.join(workdir, "audio.mkv")
+
+        def encode(part, output):
+            shellCommand(segmentCommand(str(part), str(output), x265params, profile))
+            print(f"Encoded segment {part.name} of {len(parts)}")
+
+        with ThreadPoolExecutor(max_workers=segments + 1) as pool:
+            futures = [pool.submit(shellCommand, audioCommand(src, audio, profile))]
+            futures += [pool.submit(encode, p, o) for p, o in zip(parts, encoded)]
+            for future in futures:
+                # raises the first failure, the rest are left to finish
+                future.result()
+        listfile = os.path.join(workdir, "segments.txt")
+        writeConcatList(listfile, encoded)
+        srcinfo = fileInfo(src) if srcinfo is None else srcinfo
+        shellCommand(concatCommand(listfile, audio, dst, videoOffset(srcinfo)))
+        shutil.rmtree(workdir, ignore_errors=True)
+        print(f"Joined {len(parts)} segments into {dst}")
+        return True
+    except Exception as e:
+        errorRaise(sys.exc_info()[2], e)
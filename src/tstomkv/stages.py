@@ -0,0 +1,625 @@
+"""pipeline stages for tstomkv
+
+Each stage takes a job dict and returns it, updated, for the next stage.
+A job starts as {"src": remote path, "replace": path prefix to swap for
+the transcodedir, "tvh": True if tvheadend should be told of the move}.
+If the job has a "ledger" its progress is recorded there and any stage
+a previous run already completed is skipped. A tvh job may carry the
+"catalogue" of recordings, which is told when its file moves. Each
+stage times its steps for the metrics listener, see metrics.measure. Given a
+staging.StagingBudget, fetches wait for room in the transcodedir and the
+job's files there are removed once it has been uploaded.
+"""
+
+import os
+import subprocess
+import time
+from pathlib import Path
+from concurrent.futures import Future
+from concurrent.futures import wait as waitFor
+from threading import Lock, Thread
+
+from tstomkv import progressBar
+from tstomkv.cores import coreCount, x265Params
+from tstomkv.ffmpeg import (
+    checkDuration,
+    convert_stream_to_mkv,
+    convert_ts_to_mkv,
+    fileInfo,
+    infoDuration,
+    infoHeight,
+    remoteFileInfo,
+    removeFileIfExists,
+    videoDuration,
+    videoHeight,
+)
+from tstomkv.files import (
+    getFile,
+    pathManipulation,
+    remoteBlocks,
+    remoteCommand,
+    sendFile,
+)
+from tstomkv.metrics import encodeFigures, fileSize, measure
+from tstomkv.profiles import chooseProfile, copyDecision
+from tstomkv.progress import (
+    END,
+    EXITED,
+    NOSTATS,
+    PROGRESS,
+    STALLED,
+    progressEvents,
+)
+from tstomkv.segments import segmentedEncode
+from tstomkv.staging import removeStaged, stagingNeed
+from tstomkv.transfer import transferFile
+from tstomkv.tvh import fileMoved
+from tstomkv.upload import IncrementalUpload
+from tstomkv.verify import verifyOutput
+
+
+class CopyError(Exception):
+    pass
+
+
+def humanTime(seconds):
+    """convert seconds to human readable time"""
+    m, s = divmod(seconds, 60)
+    h, m = divmod(m, 60)
+    if h > 0:
+        return f"{int(h)}h {int(m)}m {int(s)}s"
+    elif m > 0:
+        return f"{int(m)}m {int(s)}s"
+    else:
+        return f"{int(s)}s"
+
+
+def transcodeFile(
+    src,
+    dst,
+    statsfile,
+    overwrite=False,
+    x265params=None,
+    profile=None,
+    started=None,
+):
+    """Initiate the transcoder for a given source file to a destination file"""
+    dirname = os.path.dirname(dst)
+    Path(dirname).mkdir(mode=0o755, exist_ok=True, parents=True)
+    return convert_ts_to_mkv(
+        src,
+        dst,
+        statsfile,
+        overwrite=overwrite,
+        x265params=x265params,
+        profile=profile,
+        started=started,
+    )
+
+
+def streamFile(
+    src,
+    dst,
+    statsfile,
+    overwrite=False,
+    x265params=None,
+    profile=None,
+    started=None,
+):
+    """Transcode a file on the media server, streaming it straight into ffmpeg"""
+    dirname = os.path.dirname(dst)
+    Path(dirname).mkdir(mode=0o755, exist_ok=True, parents=True)
+    with remoteBlocks(src) as blocks:
+        return convert_stream_to_mkv(
+            blocks,
+            dst,
+            statsfile,
+            overwrite=overwrite,
+            x265params=x265params,
+            profile=profile,
+            started=started,
+        )
+
+
+def stopProcess(proc, grace=10):
+    """terminate proc, killing it if it hasn't exited after grace seconds"""
+    if proc.poll() is not None:
+        return
+    proc.terminate()
+    try:
+        proc.wait(grace)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def startEncode(plan, kwargs):
+    """start the planned encode in a thread, returns a Future of its result"""
+    encoding = Future()
+
+    def run():
+        encoding.set_running_or_notify_cancel()
+        try:
+            encoding.set_result(plan["target"](*plan["args"], **kwargs))
+        except BaseException as e:
+            encoding.set_exception(e)
+
+    Thread(target=run).start()
+    return encoding
+
+
+def encodeResult(plan, result):
+    """raise CopyError if the planned encode returned False"""
+    if result is False:
+        raise CopyError(f"ffmpeg failed to encode {plan['args'][0]}")
+
+
+class EncoderHandle:
+    """The ffmpeg of an encode running in a thread, so it can be stopped.
+
+    started is given to transcodeFile or streamFile, stop() stops the ffmpeg
+    it was called with, or stops it as soon as it starts.
+    """
+
+    def __init__(self, grace=10):
+        self.grace = grace
+        self.stopped = False
+        self._procs = []
+        self._lock = Lock()
+
+    def started(self, proc):
+        with self._lock:
+            self._procs.append(proc)
+            stopped = self.stopped
+        if stopped:
+            stopProcess(proc, self.grace)
+
+    def stop(self):
+        with self._lock:
+            self.stopped = True
+            procs = list(self._procs)
+        for proc in procs:
+            stopProcess(proc, self.grace)
+
+
+def doStats(statsfile, duration, alive=None):
+    """Follow the encode's progress events and show a progress bar
+
+    alive is a callable that returns False once the encoder has exited.
+    returns the last ProgressEvent.
+    """
+    last = None
+    for event in progressEvents(statsfile, alive=alive):
+        last = event
+        if event.kind == PROGRESS and duration and event.out_time is not None:
+            progressBar(event.out_time, duration)
+    return progressSummary(last, statsfile, duration)
+
+
+def progressSummary(last, statsfile, duration):
+    """report how the encode's progress events ended, returns last"""
+    if duration:
+        print()  # newline after progress bar
+    else:
+        print("No duration info, cannot show progress")
+    if last.kind == END:
+        print("Transcoding complete")
+    elif last.kind == EXITED:
+        print("Transcoder exited without finishing")
+    elif last.kind == STALLED:
+        print(f"Transcoder has stopped making progress, see {statsfile}")
+    elif last.kind == NOSTATS:
+        print("No stats file after 1 minute, giving up")
+    return last
+
+
+def markState(job, state):
+    """record in the job's ledger, if it has one, that it has reached state"""
+    if job.get("ledger") is not None:
+        job["ledger"].advance(job["src"], state)
+
+
+def reached(job, state):
+    """True if the job's ledger says a previous run got as far as state"""
+    if job.get("ledger") is None:
+        return False
+    return job["ledger"].reached(job["src"], state)
+
+
+def kodiJob(src, cfg):
+    """make a job for a file in the kodi tv or film directories, or None"""
+    if cfg["mediaserver"].get("koditvdir") in src:
+        replace = cfg["mediaserver"]["koditvdir"]
+    elif cfg["mediaserver"].get("kodifilmdir") in src:
+        replace = cfg["mediaserver"]["kodifilmdir"]
+    else:
+        print(f"Skipping {src} as not in tvdir or filmdir")
+        return None
+    return {"src": src, "replace": replace, "tvh": False}
+
+
+def tvhJob(rec):
+    """make a job for a tidied tvheadend recording, or None"""
+    if not rec["filename"].lower().endswith(".ts"):
+        print(f"Skipping {rec['filename']}")
+        return None
+    return {
+        "src": rec["filename"],
+        "replace": "/var/lib/tvheadend",
+        "tvh": True,
+        "rec": rec,
+    }
+
+
+def fetchStage(job, streaminput=False, channels=1, verify=False, staging=None):
+    """copy the transport stream from the media server to the transcodedir
+
+    with streaminput the copy is skipped, the encode stage will read the
+    file directly from the media server, only its details are fetched.
+    with more than one channel the file is copied in resumable chunks.
+    """
+    fps = pathManipulation(job["src"], replace=job["replace"], mkdestdir=True)
+    job["fps"] = fps
+    if reached(job, "uploaded") or (
+        reached(job, "verified") and fps["destmkv"].exists()
+    ):
+        print(f"{fps['src']} already transcoded, not fetching it again")
+        return job
+    if staging is not None:
+        staging.admit(job, stagingNeed(job, streaminput))
+    if streaminput:
+        job["streaminput"] = True
+        if not job.get("srcinfo"):
+            # the scheduler may have probed it already, see schedule.probeJobs
+            with measure(job, "probe"):
+                job["srcinfo"] = remoteFileInfo(str(fps["src"]))
+        markState(job, "fetched")
+        return job
+    if reached(job, "fetched") and fps["dest"].exists():
+        print(f"{fps['dest']} already fetched")
+        return job
+    starttime = time.time()
+    with measure(job, "fetch") as step:
+        if channels > 1:
+            ok = transferFile(
+                str(fps["src"]),
+                str(fps["dest"]),
+                direction="get",
+                channels=channels,
+                verify=verify,
+                banner=True,
+            )
+        else:
+            ok = getFile(str(fps["src"]), str(fps["dest"]), banner=True)
+        step["bytes"] = fileSize(fps["dest"]) if ok else None
+    if not ok:
+        raise CopyError(f"Failed to copy {fps['src']} to {fps['dest']}")
+    markState(job, "fetched")
+    print(
+        f"Time taken to copy {fps['src']} to {fps['dest']}: {humanTime(time.time() - starttime)}"
+    )
+    return job
+
+
+def sourceDetails(job):
+    """the (duration, frame height) of the job's transport stream"""
+    fps = job["fps"]
+    if not job.get("streaminput"):
+        return videoDuration(fps["dest"]), videoHeight(fps["dest"])
+    duration = infoDuration(job.get("srcinfo"))
+    if duration is None and "rec" in job:
+        # no ffprobe on the media server, fall back to the tvh recording
+        duration = job["rec"].get("duration")
+    return duration, infoHeight(job.get("srcinfo"))
+
+
+def sourceInfo(job):
+    """the ffprobe output for the job's transport stream, or None"""
+    if job.get("streaminput"):
+        return job.get("srcinfo")
+    return fileInfo(str(job["fps"]["dest"]))
+
+
+def encodePlan(
+    job,
+    budget=None,
+    cfg=None,
+    segments=1,
+    segmentmin=3600,
+    coordinator=None,
+):
+    """decide how to encode the job, see encodeStage
+
+    returns None if an earlier run already encoded it, otherwise a dict
+    with the "mode" of the encode ("remote", "segmented", "stream" or
+    "file") and the "target", "args" and "kwargs" that run it.
+    """
+    fps = job["fps"]
+    if reached(job, "uploaded"):
+        job["uploaded"] = True
+        return None
+    if reached(job, "verified") and fps["destmkv"].exists():
+        print(f"{fps['destmkv']} already transcoded and checked")
+        return None
+    with measure(job, "probe"):
+        duration, height = sourceDetails(job)
+        finfo = sourceInfo(job)
+    pname, profile = chooseProfile(finfo, job.get("rec"), cfg)
+    copyvideo, copyaudio, reason = copyDecision(finfo, profile)
+    profile.update(copyvideo=copyvideo, copyaudio=copyaudio)
+    job["profile"] = pname
+    job["copied"] = {"video": copyvideo, "audio": copyaudio}
+    print(f"Encoding {fps['src']} with the {pname} profile: {reason}")
+    # a remux is quicker done here than sent to a worker
+    remote = coordinator is not None and not copyvideo and not job.get("streaminput")
+    # a remux needs next to no cpu so doesn't wait for a share of the cores
+    local = budget is not None and not copyvideo and not remote
+    threads = budget.share(height) if local else None
+    x265params = None if threads is None else x265Params(threads)
+    encodekw = {"overwrite": True, "x265params": x265params, "profile": profile}
+    statsfile = str(fps["dest"]) + "-transcode.stats"
+    segmented = (
+        not remote
+        and segments > 1
+        and not copyvideo
+        and not job.get("streaminput")
+        and duration is not None
+        and duration >= segmentmin
+    )
+    plan = {
+        "duration": duration,
+        "height": height,
+        "finfo": finfo,
+        "copyvideo": copyvideo,
+        "threads": threads,
+        "statsfile": statsfile,
+    }
+    if remote:
+        plan.update(
+            mode="remote",
+            target=coordinator.encode,
+            args=(str(fps["dest"]), str(fps["destmkv"]), duration),
+            kwargs={"profile": profile},
+        )
+    elif segmented:
+        # the encode's share of the cores is split between its segments
+        pershare = max(1, (threads or coreCount()) // segments)
+        encodekw["x265params"] = x265Params(pershare)
+        plan.update(
+            mode="segmented",
+            target=segmentedEncode,
+            args=(str(fps["dest"]), str(fps["destmkv"]), duration, segments),
+            kwargs=dict(encodekw, srcinfo=finfo),
+        )
+    elif job.get("streaminput"):
+        plan.update(
+            mode="stream",
+            target=streamFile,
+            args=(str(fps["src"]), str(fps["destmkv"]), statsfile),
+            kwargs=encodekw,
+        )
+    else:
+        plan.update(
+            mode="file",
+            target=transcodeFile,
+            args=(str(fps["dest"]), str(fps["destmkv"]), statsfile),
+            kwargs=encodekw,
+        )
+    return plan
+
+
+def encodeStage(
+    job,
+    budget=None,
+    streamoutput=False,
+    cfg=None,
+    segments=1,
+    segmentmin=3600,
+    coordinator=None,
+    verify=None,
+):
+    """transcode the transport stream and check the result
+
+    budget is a CoreBudget shared by all the encode workers, each encode
+    waits for its share of the cores before starting.
+    the encoding profile is chosen from the [profile:*] sections of cfg,
+    see profiles.chooseProfile.
+    with streamoutput the mkv is uploaded to the media server as it is
+    written and moved into place once it passes the duration check.
+    recordings of segmentmin seconds or more that have been fetched are
+    cut into segments that are encoded at the same time, see
+    segments.segmentedEncode.
+    with a coordinator fetched recordings are encoded on a worker host,
+    see workers.Coordinator.
+    verify is a dict of the settings for verify.verifyOutput, which samples
+    the output once it passes the duration check.
+    """
+    plan = encodePlan(
+        job,
+        budget=budget,
+        cfg=cfg,
+        segments=segments,
+        segmentmin=segmentmin,
+        coordinator=coordinator,
+    )
+    if plan is None:
+        return job
+    fps = job["fps"]
+    threads = plan["threads"]
+    encoder = EncoderHandle()
+    kwargs = plan["kwargs"]
+    if plan["mode"] in ("file", "stream"):
+        kwargs = dict(kwargs, started=encoder.started)
+    # a stats file left by an earlier run would look like a finished encode
+    removeFileIfExists(plan["statsfile"])
+    upload = None
+    if budget is not None:
+        budget.acquire(threads)
+    try:
+        plan["started"] = time.time()
+        if threads is not None:
+            print(f"Encoding {fps['src']} using {threads} cores")
+        if streamoutput:
+            upload = startUpload(job)
+        with measure(job, "encode") as step:
+            encoding = startEncode(plan, kwargs)
+            if plan["mode"] in ("segmented", "remote"):
+                # these report their own progress rather than in a stats file
+                job["progress"] = None
+            else:
+                job["progress"] = doStats(
+                    plan["statsfile"],
+                    plan["duration"],
+                    alive=lambda: not encoding.done(),
+                )
+                if job["progress"].kind in (STALLED, NOSTATS):
+                    encoder.stop()
+                    waitFor([encoding])
+                    raise CopyError(f"Gave up on the encode of {fps['src']}")
+            # raises what the encode raised, a WorkerError say
+            encodeResult(plan, encoding.result())
+            step["bytes"] = fileSize(fps["destmkv"])
+            encodeFigures(step, job["progress"])
+        markState(job, "encoded")
+        if upload is not None:
+            resent = upload.finish()
+            print(f"Upload of {fps['srcmkv']} caught up, {resent} bytes re-sent")
+    except Exception:
+        if upload is not None:
+            upload.abort()
+        raise
+    finally:
+        if budget is not None:
+            budget.release(threads)
+    return encodeFinish(job, plan, upload=upload, verify=verify)
+
+
+def startUpload(job):
+    """start uploading the job's mkv as it is written"""
+    fps = job["fps"]
+    # don't let the uploader pick up an mkv from an earlier run
+    removeFileIfExists(str(fps["destmkv"]))
+    upload = IncrementalUpload(str(fps["destmkv"]), str(fps["srcmkv"]))
+    upload.start()
+    return upload
+
+
+def verificationReport(job, report, fn):
+    """keep the sampled verification report of the encode fn in the job,
+    raises CopyError if it failed"""
+    job["verification"] = report
+    if not report["ok"]:
+        for problem in report["problems"]:
+            print(problem)
+        print("Sampled verification FAILED, not moving file or deleting source")
+        raise CopyError(f"Sampled verification failed for {fn}")
+    quality = "" if report["ssim"] is None else f", ssim {report['ssim']}"
+    print(f"Sampled verification OK, {report['windows']} windows{quality}")
+
+
+def encodeFinish(job, plan, upload=None, verify=None):
+    """check the finished encode of the job, see encodeStage"""
+    fps = job["fps"]
+    duration, finfo = plan["duration"], plan["finfo"]
+    print(f"Transcoding and stats monitoring complete for {Path(fps['destmkv']).name}")
+    print(f"Duration of {fps['src']} is {duration} seconds")
+    try:
+        with measure(job, "verify", fileSize(fps["destmkv"])):
+            checked = checkDuration(duration, fps["destmkv"])
+            report = None
+            if checked and verify is not None and verify["windows"] > 0:
+                src = None if job.get("streaminput") else str(fps["dest"])
+                report = verifyOutput(
+                    src, str(fps["destmkv"]), srcinfo=finfo, **verify
+                )
+        if not checked:
+            print("Duration check FAILED, not moving file or deleting source")
+            raise CopyError(f"Duration check failed for {fps['destmkv']}")
+        print("Duration check OK")
+        if report is not None:
+            verificationReport(job, report, fps["destmkv"])
+    except Exception:
+        # don't leave the .partial file, or its connection, behind
+        if upload is not None:
+            upload.abort()
+        raise
+    markState(job, "verified")
+    if not plan["copyvideo"] and plan["mode"] != "remote" and duration:
+        # what this encode cost and saved, for scheduling later ones
+        srcfile = fps["dest"]
+        job["encoded"] = {
+            "height": plan["height"],
+            "duration": duration,
+            "cores": plan["threads"] or coreCount(),
+            "srcbytes": srcfile.stat().st_size if srcfile.exists() else None,
+            "dstbytes": fps["destmkv"].stat().st_size,
+        }
+    if upload is not None:
+        upload.commit()
+        job["uploaded"] = True
+        markState(job, "uploaded")
+    print(f"time taken to transcode: {humanTime(time.time() - plan['started'])}")
+    return job
+
+
+def uploadStage(job, channels=1, verify=False, staging=None):
+    """send the mkv back to the media server and remove the source
+
+    an mkv encoded on the media server is moved into place there.
+    """
+    fps = job["fps"]
+    starttime = time.time()
+    if job.get("uploaded"):
+        print(f"{fps['srcmkv']} has already been uploaded")
+    elif job.get("remotemkv"):
+        # encoded on the media server, see remote.remoteEncodeStage
+        with measure(job, "upload"):
+            rmkv, srcmkv = job["remotemkv"], fps["srcmkv"]
+            # a mv that went through before the connection dropped is done
+            moved = remoteCommand(
+                f'mv "{rmkv}" "{srcmkv}" && echo moved'
+                f' || {{ test ! -e "{rmkv}" && test -e "{srcmkv}" && echo moved; }}',
+                banner=True,
+                retry=False,
+            )
+        if moved != "moved":
+            raise CopyError(f"Failed to move {job['remotemkv']} to {fps['srcmkv']}")
+        markState(job, "uploaded")
+    else:
+        with measure(job, "upload", fileSize(fps["destmkv"])):
+            if channels > 1:
+                ok = transferFile(
+                    str(fps["destmkv"]),
+                    str(fps["srcmkv"]),
+                    direction="put",
+                    channels=channels,
+                    verify=verify,
+                    banner=True,
+                )
+            else:
+                ok = sendFile(str(fps["destmkv"]), str(fps["srcmkv"]), banner=True)
+        if not ok:
+            raise CopyError(f"Failed to send {fps['destmkv']} to {fps['srcmkv']}")
+        markState(job, "uploaded")
+    if job["tvh"]:
+        with measure(job, "tvh"):
+            fileMoved(str(fps["src"]), str(fps["srcmkv"]))
+            if job.get("catalogue") is not None:
+                job["catalogue"].moved(str(fps["src"]), str(fps["srcmkv"]))
+    with measure(job, "delete"):
+        # gone already counts, it may have been removed before a dropped
+        # connection or a crash
+        removed = remoteCommand(
+            f"rm -f \"{fps['src']}\" && test ! -e \"{fps['src']}\" && echo removed",
+            banner=True,
+            retry=False,
+        )
+    if removed != "removed":
+        raise CopyError(f"Failed to remove {fps['src']}")
+    markState(job, "removed")
+    if staging is not None:
+        freed = removeStaged(job)
+        staging.release(job)
+        print(f"Removed {freed} bytes of staged files for {fps['src']}")
+    print(f"time taken to upload: {humanTime(time.time() - starttime)}")
+    return job
@@ -0,0 +1,162 @@
+"""disk space admission control for the transcodedir
+
+Before a recording is fetched it is admitted to the transcodedir, which
+waits until there is room for it: the bytes staged for jobs in flight must
+stay under a cap, and the disk must keep a reserve free after allowing for
+what the jobs in flight have still to write. Once a job has been uploaded
+its staged files are removed and its room is given back.
+"""
+
+import os
+import re
+import shutil
+import sys
+import threading
+
+from tstomkv import errorNotify
+from tstomkv.files import remoteCommand
+
+UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+# seconds between looks at the free space whilst waiting for room
+POLL = 30
+
+
+class StagingError(Exception):
+    pass
+
+
+def parseSize(value):
+    """bytes from a size like 500M or 20G, None for None or 0"""
+    if value is None:
+        return None
+    match = re.fullmatch(r"\s*([0-9.]+)\s*([KMGT]?)B?\s*", str(value).upper())
+    if match is None:
+        raise ValueError(f"not a size: {value}")
+    size = int(float(match.group(1)) * UNITS[match.group(2)])
+    return size if size > 0 else None
+
+
+def sourceSize(job):
+    """the size of the job's recording on the media server, or None"""
+    size = (job.get("rec") or {}).get("filesize") or job.get("filesize")
+    if size:
+        return int(size)
+    out = remoteCommand(f"stat -c %s \"{job['src']}\"")
+    try:
+        return int(out)
+    except (TypeError, ValueError):
+        return None
+
+
+def stagingNeed(job, streaminput=False):
+    """the bytes job will stage: the fetched recording and an mkv that
+    is, at worst, as large"""
+    size = sourceSize(job)
+    if size is None:
+        return 0
+    return size if streaminput else size * 2
+
+
+def stagedFiles(job):
+    """the files a job puts in the transcodedir"""
+    fps = job["fps"]
+    dest = str(fps["dest"])
+    return [
+        dest,
+        f"{dest}.partial",
+        f"{dest}.manifest",
+        str(fps["destmkv"]),
+        f"{fps['destmkv']}.upload-manifest",
+        f"{dest}-transcode.stats",
+    ]
+
+
+def stagedBytes(job):
+    total = 0
+    for fn in stagedFiles(job):
+        try:
+            total += os.path.getsize(fn)
+        except OSError:
+            pass
+    return total
+
+
+def removeStaged(job):
+    """delete the job's files from the transcodedir, returns bytes freed"""
+    freed = 0
+    for fn in stagedFiles(job):
+        try:
+            freed += os.path.getsize(fn)
+            os.remove(fn)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
+    shutil.rmtree(f"{job['fps']['destmkv']}.segments", ignore_errors=True)
+    return freed
+
+
+class StagingBudget:
+    """Admits jobs to the transcodedir at path while there is room.
+
+    maxbytes caps the bytes reserved by the jobs in flight (None for no
+    cap), reserve is kept free on the disk. A job that can never fit
+    raises StagingError rather than waiting for ever.
+    """
+
+    def __init__(self, path, maxbytes=None, reserve=5 * 1024**3, poll=POLL):
+        self.path = path
+        self.maxbytes = maxbytes
+        self.reserve = reserve
+        self.poll = poll
+        # src -> (job, bytes reserved)
+        self.inflight = {}
+        self._cond = threading.Condition()
+
+    def reserved(self):
+        return sum(n for _, n in self.inflight.values())
+
+    def outstanding(self):
+        """bytes the jobs in flight have still to write"""
+        return sum(max(0, n - stagedBytes(job)) for job, n in self.inflight.values())
+
+    def admit(self, job, need):
+        """wait until there is room for need bytes more of job's files"""
+        with self._cond:
+            if job["src"] in self.inflight:
+                return
+            while True:
+                written = stagedBytes(job)
+                free = shutil.disk_usage(self.path).free
+                room = free - self.reserve - self.outstanding()
+                capped = (
+                    self.maxbytes is not None
+                    and self.reserved() + need > self.maxbytes
+                )
+                if room >= need - written and not capped:
+                    break
+                if len(self.inflight) == 0:
+                    # nothing will finish and make room
+                    if capped and room >= need - written:
+                        break
+                    raise StagingError(
+                        f"not enough space in {self.path} for {job['src']},"
+                        f" {need - written} bytes needed, {room} available"
+                    )
+                print(f"Waiting for room in {self.path} for {job['src']}")
+                self._cond.wait(timeout=self.poll)
+            self.inflight[job["src"]] = (job, need)
+
+    def release(self, job):
+        with self._cond:
+            self.inflight.pop(job["src"], None)
+            self._cond.notify_all()
+
+    # pipeline listener interface, a failed job gives back its room
+
+    def stageDone(self, job, stagename, started, finished):
+        pass
+
+    def stageFailed(self, job, stagename, started, finished, error):
+        self.release(job)
@@ -0,0 +1,263 @@
+"""parallel, resumable, checksummed file transfers to and from the media server
+
+A file is split into chunks which are transferred over several sftp
+channels at once (all sharing the one pooled ssh transport). A manifest
+beside the local file records the sha256 of each chunk as it completes, so
+an interrupted transfer carries on from where it stopped, and the digests
+can be compared with the other side's without reading the file again.
+"""
+
+import hashlib
+import json
+import os
+import sys
+import threading
+
+from tstomkv import errorNotify
+from tstomkv.connections import pool
+from tstomkv.files import BLOCKSIZE, WINDOW, mediaServer, remoteCommand
+
+CHUNKSIZE = 64 * 1024 * 1024
+
+
+class TransferError(Exception):
+    pass
+
+
+def chunkList(size, chunksize=CHUNKSIZE):
+    """[(offset, length), ...] covering a file of size bytes"""
+    return [(off, min(chunksize, size - off)) for off in range(0, size, chunksize)]
+
+
+def fileDigest(chunkdigests):
+    """a digest for the whole file from its ordered chunk digests"""
+    return hashlib.sha256("".join(chunkdigests).encode()).hexdigest()
+
+
+class Manifest:
+    """The chunks of a transfer completed so far, saved as json in path."""
+
+    def __init__(self, path, size, mtime, chunksize):
+        self.path = path
+        self.key = {"size": size, "mtime": mtime, "chunksize": chunksize}
+        self.chunks = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """pick up a previous attempt at the same file, True if there was one"""
+        try:
+            with open(self.path) as fp:
+                data = json.load(fp)
+            if data.get("key") == self.key:
+                self.chunks = {int(k): v for k, v in data["chunks"].items()}
+                return True
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
+        return False
+
+    def done(self, index, digest):
+        with self._lock:
+            self.chunks[index] = digest
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w") as fp:
+                json.dump({"key": self.key, "chunks": self.chunks}, fp)
+            os.replace(tmp, self.path)
+
+    def digests(self):
+        return [self.chunks[i] for i in sorted(self.chunks)]
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class ChunkedTransfer:
+    """Move one file to (put) or from (get) the media server in chunks.
+
+    For a get the data goes to dst.partial locally, which is renamed to dst
+    when every chunk has arrived. For a put it goes to dst.partial on the
+    media server and is renamed there. The manifest always lives locally.
+    server and sftppool default to the media server and the shared pool.
+    """
+
+    def __init__(
+        self,
+        src,
+        dst,
+        direction="get",
+        channels=4,
+        chunksize=CHUNKSIZE,
+        server=None,
+        sftppool=None,
+    ):
+        if direction not in ("get", "put"):
+            raise ValueError(f"direction must be get or put, not {direction}")
+        self.src = src
+        self.dst = dst
+        self.direction = direction
+        self.channels = max(1, channels)
+        self.chunksize = chunksize
+        self.partial = f"{dst}.partial"
+        self.server = mediaServer() if server is None else server
+        self.pool = pool if sftppool is None else sftppool
+        self.digests = []
+        self.digest = None
+        self._errors = []
+
+    def _manifestPath(self):
+        if self.direction == "get":
+            return f"{self.dst}.manifest"
+        return f"{self.src}.upload-manifest"
+
+    def _prepare(self, sftp):
+        """the manifest and the chunks still to send, creating the partial"""
+        if self.direction == "get":
+            st = sftp.stat(self.src)
+            size, mtime = st.st_size, int(st.st_mtime)
+        else:
+            st = os.stat(self.src)
+            size, mtime = st.st_size, int(st.st_mtime)
+        manifest = Manifest(self._manifestPath(), size, mtime, self.chunksize)
+        resume = manifest.load() and self._partialExists(sftp)
+        if not resume:
+            manifest.chunks = {}
+            self._createPartial(sftp, size)
+        elif len(manifest.chunks) > 0:
+            print(f"Resuming {self.src}, {len(manifest.chunks)} chunks already done")
+        chunks = chunkList(size, self.chunksize)
+        todo = [(i, c) for i, c in enumerate(chunks) if i not in manifest.chunks]
+        return manifest, chunks, todo
+
+    def _partialExists(self, sftp):
+        if self.direction == "get":
+            return os.path.exists(self.partial)
+        try:
+            sftp.stat(self.partial)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _createPartial(self, sftp, size):
+        if self.direction == "get":
+            with open(self.partial, "wb") as fp:
+                fp.truncate(size)
+        else:
+            with sftp.open(self.partial, "wb") as rf:
+                rf.truncate(size)
+
+    def _getChunk(self, sftp, offset, length):
+        h = hashlib.sha256()
+        blocks = [
+            (off, min(BLOCKSIZE, offset + length - off))
+            for off in range(offset, offset + length, BLOCKSIZE)
+        ]
+        fd = os.open(self.partial, os.O_WRONLY)
+        try:
+            with sftp.open(self.src, "rb") as rf:
+                for start in range(0, len(blocks), WINDOW):
+                    window = blocks[start : start + WINDOW]  # noqa: E203
+                    for (off, _), data in zip(window, rf.readv(window)):
+                        os.pwrite(fd, data, off)
+                        h.update(data)
+        finally:
+            os.close(fd)
+        return h.hexdigest()
+
+    def _putChunk(self, sftp, offset, length):
+        h = hashlib.sha256()
+        with open(self.src, "rb") as fp, sftp.open(self.partial, "r+") as rf:
+            rf.set_pipelined(True)
+            fp.seek(offset)
+            rf.seek(offset)
+            remaining = length
+            while remaining > 0:
+                data = fp.read(min(BLOCKSIZE, remaining))
+                if not data:
+                    raise TransferError(f"{self.src} is shorter than expected")
+                rf.write(data)
+                h.update(data)
+                remaining -= len(data)
+        return h.hexdigest()
+
+    def _worker(self, todo, manifest, lock):
+        try:
+            with self.pool.sftp(*self.server) as sftp:
+                while True:
+                    with lock:
+                        if len(todo) == 0 or len(self._errors) > 0:
+                            return
+                        index, (offset, length) = todo.pop(0)
+                    if self.direction == "get":
+                        digest = self._getChunk(sftp, offset, length)
+                    else:
+                        digest = self._putChunk(sftp, offset, length)
+                    manifest.done(index, digest)
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
+            with lock:
+                self._errors.append(e)
+
+    def run(self):
+        """transfer the file, returns its digest (see fileDigest)"""
+        with self.pool.sftp(*self.server) as sftp:
+            manifest, chunks, todo = self._prepare(sftp)
+            lock = threading.Lock()
+            threads = [
+                threading.Thread(target=self._worker, args=(todo, manifest, lock))
+                for _ in range(min(self.channels, max(1, len(todo))))
+            ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            if len(self._errors) > 0:
+                missing = len(chunks) - len(manifest.chunks)
+                raise TransferError(
+                    f"{missing} of {len(chunks)} chunks of {self.src} not"
+                    f" transferred, run again to resume: {self._errors[0]}"
+                )
+            if self.direction == "get":
+                os.replace(self.partial, self.dst)
+            else:
+                sftp.posix_rename(self.partial, self.dst)
+        self.digests = manifest.digests()
+        self.digest = fileDigest(self.digests)
+        manifest.remove()
+        return self.digest
+
+
+def remoteChunkDigests(path, size, chunksize=CHUNKSIZE):
+    """the sha256 of each chunk of a file, computed on the media server"""
+    count = len(chunkList(size, chunksize))
+    mb = chunksize // (1024 * 1024)
+    cmd = (
+        f"for i in $(seq 0 {count - 1}); do"
+        f' dd if="{path}" bs={mb}M skip=$i count=1 iflag=fullblock 2>/dev/null'
+        " | sha256sum | cut -d' ' -f1; done"
+    )
+    return remoteCommand(cmd).split()
+
+
+def transferFile(src, dst, direction="get", channels=4, verify=False, banner=False):
+    """get or put a file in parallel chunks, True if it arrived intact"""
+    try:
+        if banner:
+            print(f"{direction} {src} to {dst} over {channels} channels", flush=True)
+        xfer = ChunkedTransfer(src, dst, direction=direction, channels=channels)
+        digest = xfer.run()
+        if verify:
+            remotepath = src if direction == "get" else dst
+            size = os.path.getsize(dst if direction == "get" else src)
+            remote = remoteChunkDigests(remotepath, size, xfer.chunksize)
+            if remote != xfer.digests:
+                raise TransferError(f"checksums of {src} and {dst} do not match")
+        if banner:
+            print(f"{dst} digest {digest}")
+        return True
+    except Exception as e:
+        errorNotify(sys.exc_info()[2], e)
+        return False
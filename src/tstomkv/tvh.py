@@ -1,43 +1,142 @@
-"""tvh module for tstomkv"""
+"""tvh module for tstomkv
+
+All requests go through one TvhClient, which keeps its connections to
+tvheadend open between calls, retries with a backoff when tvheadend is
+busy or the network blips, and fetches long lists a page at a time.
+"""
 
 import json
+import re
 import sys
+import threading
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from tstomkv import errorNotify, errorRaise
-from tstomkv.config import readConfig
+from tstomkv.config import defaultSettings
+
+# entries asked for in each request for a list
+PAGESIZE = 200
+
+# control characters tvheadend passes through from the epg, they are not
+# allowed unescaped in json strings. tab, newline and return are left alone.
+CONTROLCHARS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]")
 
 
 class TVHError(Exception):
     pass
 
 
+def sanitize(text):
+    """text with the control characters that break json replaced by spaces"""
+    return CONTROLCHARS.sub(" ", text)
+
+
+class TvhClient:
+    """A keep-alive connection to the tvheadend api at host.
+
+    Failed requests (connection errors, timeouts and 5xx responses) are
+    tried retries more times, backoff seconds apart, doubling each time.
+    """
+
+    def __init__(
+        self,
+        host,
+        user=None,
+        password=None,
+        retries=3,
+        backoff=1,
+        pagesize=PAGESIZE,
+        timeout=60,
+    ):
+        self.baseurl = f"http://{host}/api"
+        self.retries = retries
+        self.backoff = backoff
+        self.pagesize = pagesize
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = (user, password)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self.session.mount("http://", adapter)
+
+    def close(self):
+        self.session.close()
+
+    def _request(self, route, data):
+        url = f"{self.baseurl}/{route}"
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                r = self.session.get(url, params=data, timeout=self.timeout)
+                if r.status_code < 500:
+                    return r
+                error = TVHError(f"error communicating with tvh: {r}")
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            if attempt < self.retries:
+                print(f"tvh request {route} failed ({error}), retry in {delay}s")
+                time.sleep(delay)
+                delay *= 2
+        raise error
+
+    def get(self, route, data=None):
+        """the decoded json response to a request to route"""
+        r = self._request(route, data)
+        if r.status_code != 200:
+            raise TVHError(f"error communicating with tvh: {r}")
+        return json.loads(sanitize(r.text))
+
+    def entries(self, route, data=None):
+        """yields the entries of a grid route, fetched a page at a time"""
+        start = 0
+        while True:
+            params = dict(data or {}, start=start, limit=self.pagesize)
+            page = self.get(route, params)
+            entries = page.get("entries", [])
+            yield from entries
+            start += len(entries)
+            if len(entries) == 0 or start >= page.get("total", 0):
+                return
+
+
+_client = None
+_clientlock = threading.Lock()
+
+
+def tvhClient():
+    """the shared TvhClient, made again if the config changes"""
+    global _client
+    ds = defaultSettings()
+    with _clientlock:
+        if _client is None or _client[0] is not ds:
+            if _client is not None:
+                _client[1].close()
+            client = TvhClient(ds.tvhipaddr, ds.tvhuser, ds.tvhpass)
+            _client = (ds, client)
+        return _client[1]
+
+
 def sendToTvh(route, data=None):
     """Send a request to tvheadend"""
     try:
-        cfg = readConfig()
-        auth = (cfg["DEFAULT"]["tvhuser"], cfg["DEFAULT"]["tvhpass"])
-        url = f"http://{cfg['DEFAULT']['tvhipaddr']}/api/{route}"
-        r = requests.get(url, params=data, auth=auth)
-        if r.status_code != 200:
-            raise TVHError(f"error communicating with tvh: {r}")
-        return r.json()
+        return tvhClient().get(route, data)
     except Exception as e:
-        try:
-            print(f"Error decoding json from tvh, trying again\n{e}")
-            txt = r.text.replace(chr(25), " ")
-            return json.loads(txt)
-        except Exception as e:
-            errorRaise(sys.exc_info()[2], e)
+        errorRaise(sys.exc_info()[2], e)
+
+
+def finishedRecordings():
+    """yields the finished recordings, a page at a time"""
+    # a stable order so recordings finishing mid-fetch don't shift the pages
+    data = {"sort": "start_real", "dir": "ASC"}
+    yield from tvhClient().entries("dvr/entry/grid_finished", data)
 
 
 def allRecordings():
     try:
-        route = "dvr/entry/grid_finished"
-        data = {"limit": 9999}
-        jdat = sendToTvh(route, data=data)
-        return jdat["entries"], jdat["total"]
+        entries = list(finishedRecordings())
+        return entries, len(entries)
     except Exception as e:
         errorNotify(sys.exc_info()[2], e)
 
@@ -0,0 +1,128 @@
+"""upload an mkv to the media server whilst ffmpeg is still writing it
+
+Completed blocks of the output are sent to a temporary remote file as the
+encode progresses. The matroska muxer goes back and rewrites parts of the
+file when it finishes (segment size, seek head, durations, cues) so once
+ffmpeg exits every block sent is compared against the final file and any
+that changed are sent again. Only when the output passes its checks is the
+temporary file renamed over the real name.
+"""
+
+import hashlib
+import os
+import sys
+import threading
+from contextlib import ExitStack
+
+from tstomkv import errorNotify
+from tstomkv.connections import pool
+from tstomkv.files import BLOCKSIZE, mediaServer
+
+
+def blockDigest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class IncrementalUpload:
+    """Send src to dst on the media server as src grows.
+
+    start() before the encode, finish() once it has ended, then commit()
+    to move the upload into place or abort() to throw it away.
+    """
+
+    def __init__(self, src, dst, blocksize=BLOCKSIZE, interval=5):
+        self.src = src
+        self.dst = dst
+        self.tmpdst = f"{dst}.partial"
+        self.blocksize = blocksize
+        self.interval = interval
+        self.sent = 0
+        self.digests = []
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._stack = ExitStack()
+        self._sftp = None
+        self._rfile = None
+
+    def start(self):
+        self._sftp = self._stack.enter_context(pool.sftp(*mediaServer()))
+        self._rfile = self._stack.enter_context(self._sftp.open(self.tmpdst, "wb"))
+        self._rfile.set_pipelined(True)
+        self._thread = threading.Thread(
+            target=self._run, name=f"upload-{os.path.basename(self.src)}"
+        )
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while not self._stop.wait(self.interval):
+                self._sendBlocks()
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
+            self.error = e
+
+    def _sendBlocks(self, final=False):
+        """send the blocks written since the last call. Whilst the encode
+        is running only whole blocks are sent, the last one is still growing.
+        """
+        if not os.path.exists(self.src):
+            return
+        size = os.path.getsize(self.src)
+        with open(self.src, "rb") as f:
+            f.seek(self.sent)
+            while True:
+                remaining = size - self.sent
+                if remaining <= 0 or (not final and remaining < self.blocksize):
+                    break
+                data = f.read(min(self.blocksize, remaining))
+                self._rfile.seek(self.sent)
+                self._rfile.write(data)
+                self.digests.append(blockDigest(data))
+                self.sent += len(data)
+
+    def finish(self):
+        """wait for the upload to catch up with the finished file.
+
+        returns the number of bytes that were sent again because the muxer
+        changed them after they were first sent.
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.error is not None:
+            raise self.error
+        resent = 0
+        with open(self.src, "rb") as f:
+            for index, digest in enumerate(self.digests):
+                offset = index * self.blocksize
+                f.seek(offset)
+                data = f.read(self.blocksize)
+                if blockDigest(data) != digest:
+                    self._rfile.seek(offset)
+                    self._rfile.write(data)
+                    self.digests[index] = blockDigest(data)
+                    resent += len(data)
+        self._sendBlocks(final=True)
+        self._rfile.truncate(os.path.getsize(self.src))
+        self._rfile.close()
+        return resent
+
+    def commit(self):
+        """move the finished upload into place"""
+        try:
+            self._sftp.posix_rename(self.tmpdst, self.dst)
+        finally:
+            self._stack.close()
+
+    def abort(self):
+        """stop uploading and remove the temporary remote file"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            self._sftp.remove(self.tmpdst)
+        except Exception as e:
+            errorNotify(sys.exc_info()[2], e)
+        finally:
+            self._stack.close()
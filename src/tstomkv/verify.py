@@ -0,0 +1,232 @@
+"""sampled verification of encodes for tstomkv
+
+The duration check passes an encode that stops decoding half way or has
+lost its audio. Decoding the whole output would cost as much again as the
+encode, so instead a few short windows spread across the output are
+decoded at the same time and their frames checked against the source:
+enough frames for the source's frame rate, timestamps that only go
+forward without gaps, and the same kinds of streams. Optionally the SSIM
+and PSNR of some windows against the source are measured too, for as long
+as the time budget allows. The commands can be run elsewhere, the media
+server say, by giving verifyOutput a run and a probe function.
+"""
+
+import json
+import re
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tstomkv.ffmpeg import fileInfo, infoDuration, infoVideoStream
+
+# the least of the expected frames a window must decode to
+FRAMETHRESHOLD = 0.9
+
+# the largest step forward between frame timestamps, in frames
+MAXGAP = 10
+
+
+def sampleWindows(duration, windows=4, length=10):
+    """[(start, length), ...] spread evenly across duration seconds"""
+    if not duration or windows < 1:
+        return []
+    length = min(length, duration)
+    span = max(0, duration - length - 1)
+    if windows == 1:
+        return [(round(span / 2, 3), length)]
+    return [(round(span * i / (windows - 1), 3), length) for i in range(windows)]
+
+
+def frameRate(finfo):
+    """the frame rate of the first video stream, or None"""
+    stream = infoVideoStream(finfo) or {}
+    for key in ("avg_frame_rate", "r_frame_rate"):
+        num, _, den = str(stream.get(key, "0/0")).partition("/")
+        try:
+            rate = float(num) / float(den or 1)
+        except (ValueError, ZeroDivisionError):
+            continue
+        if rate > 0:
+            return rate
+    return None
+
+
+def streamKinds(finfo):
+    """{codec_type: count} of the streams in ffprobe output"""
+    kinds = {}
+    for stream in (finfo or {}).get("streams", []):
+        kind = stream.get("codec_type")
+        kinds[kind] = kinds.get(kind, 0) + 1
+    return kinds
+
+
+def checkStreams(srcinfo, dstinfo):
+    """problems with the kinds of stream in the output, a list of strings"""
+    src, dst = streamKinds(srcinfo), streamKinds(dstinfo)
+    problems = []
+    for kind in ("video", "audio", "subtitle"):
+        # the encode keeps at least one of each kind the source has
+        if src.get(kind, 0) > 0 and dst.get(kind, 0) == 0:
+            problems.append(f"no {kind} stream in the output")
+    return problems
+
+
+def windowCommand(fn, start, length):
+    """decode the video frames of one window, listing their timestamps"""
+    return [
+        "ffprobe",
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-read_intervals",
+        f"{start}%+{length}",
+        "-show_entries",
+        "frame=best_effort_timestamp_time",
+        "-of",
+        "json",
+        fn,
+    ]
+
+
+def checkFrames(timestamps, start, length, rate):
+    """problems with one window's frame timestamps, a list of strings"""
+    problems = []
+    expected = length * rate
+    if len(timestamps) < expected * FRAMETHRESHOLD:
+        problems.append(
+            f"window at {start}s decoded {len(timestamps)} frames,"
+            f" expected {int(expected)}"
+        )
+    gap = MAXGAP / rate
+    for prev, cur in zip(timestamps, timestamps[1:]):
+        if cur <= prev:
+            problems.append(f"window at {start}s timestamps go back at {cur}s")
+            break
+        if cur - prev > gap:
+            problems.append(
+                f"window at {start}s has a {cur - prev:.2f}s gap at {prev}s"
+            )
+            break
+    return problems
+
+
+def runLocal(cmd):
+    """run the command list cmd here, returns (returncode, stdout, stderr)"""
+    proc = subprocess.run(cmd, capture_output=True)
+    return proc.returncode, proc.stdout.decode(), proc.stderr.decode()
+
+
+def checkWindow(fn, start, length, rate, run=runLocal):
+    """decode a window of fn, returns its problems"""
+    returncode, stdout, stderr = run(windowCommand(fn, start, length))
+    if returncode != 0:
+        return [f"window at {start}s failed to decode: {stderr.strip()}"]
+    frames = json.loads(stdout or "{}").get("frames", [])
+    timestamps = []
+    for frame in frames:
+        try:
+            timestamps.append(float(frame["best_effort_timestamp_time"]))
+        except (KeyError, TypeError, ValueError):
+            continue
+    if rate is None:
+        return [] if len(timestamps) > 0 else [f"window at {start}s has no frames"]
+    return checkFrames(timestamps, start, length, rate)
+
+
+def qualityCommand(src, dst, start, length):
+    """compare a window of dst with src, printing ssim and psnr"""
+    window = ["-ss", str(start), "-t", str(length)]
+    return (
+        ["ffmpeg", "-hide_banner", "-nostats"]
+        + window
+        + ["-i", dst]
+        + window
+        + ["-i", src]
+        + [
+            "-filter_complex",
+            "[0:v]split[d0][d1];[1:v]split[s0][s1];"
+            "[d0][s0]ssim;[d1][s1]psnr",
+            "-f",
+            "null",
+            "-",
+        ]
+    )
+
+
+def parseQuality(text):
+    """(ssim, psnr) from the ffmpeg ssim and psnr filters' output"""
+    ssim = re.search(r"SSIM .*All:([0-9.]+)", text)
+    psnr = re.search(r"PSNR .*average:([0-9.]+|inf)", text)
+    return (
+        None if ssim is None else float(ssim.group(1)),
+        None if psnr is None else float(psnr.group(1)),
+    )
+
+
+def measureWindow(src, dst, start, length, run=runLocal):
+    _, _, stderr = run(qualityCommand(src, dst, start, length))
+    return parseQuality(stderr)
+
+
+def verifyOutput(
+    src,
+    dst,
+    srcinfo=None,
+    windows=4,
+    length=10,
+    workers=4,
+    quality=False,
+    budget=120,
+    minssim=0.9,
+    run=runLocal,
+    probe=None,
+):
+    """check the encode dst of src by sampling windows of it
+
+    src is only read to measure the quality, so may be None if srcinfo,
+    its ffprobe output, is given. quality windows are only started whilst
+    there are budget seconds left. the ffprobe and ffmpeg commands are run
+    by run, see runLocal, and the files probed by probe, fileInfo if None.
+    returns a report dict, "ok" is False if any problems were found.
+    """
+    started = time.time()
+    probe = fileInfo if probe is None else probe
+    if srcinfo is None and src is not None:
+        srcinfo = probe(src)
+    dstinfo = probe(dst)
+    report = {"ok": True, "problems": [], "windows": 0, "ssim": None, "psnr": None}
+    report["problems"].extend(checkStreams(srcinfo, dstinfo))
+    duration = infoDuration(dstinfo)
+    samples = sampleWindows(duration, windows, length)
+    rate = frameRate(srcinfo)
+
+    def measure(start, length):
+        if time.time() - started > budget:
+            return None
+        return measureWindow(src, dst, start, length, run=run)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        checks = [pool.submit(checkWindow, dst, s, n, rate, run) for s, n in samples]
+        measures = []
+        if quality and src is not None:
+            measures = [pool.submit(measure, s, n) for s, n in samples]
+        for check in checks:
+            report["problems"].extend(check.result())
+        report["windows"] = len(checks)
+        scores = [m.result() for m in measures]
+    scores = [s for s in scores if s is not None]
+    ssims = [s[0] for s in scores if s[0] is not None]
+    psnrs = [s[1] for s in scores if s[1] is not None]
+    if len(ssims) > 0:
+        report["ssim"] = round(min(ssims), 4)
+        if report["ssim"] < minssim:
+            report["problems"].append(
+                f"ssim {report['ssim']} is below the minimum of {minssim}"
+            )
+    if len(psnrs) > 0:
+        report["psnr"] = round(min(psnrs), 2)
+    report["measured"] = len(scores)
+    report["seconds"] = round(time.time() - started, 2)
+    report["ok"] = len(report["problems"]) == 0
+    return report
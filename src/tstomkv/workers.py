@@ -0,0 +1,279 @@
+"""distributed encoding on worker hosts for tstomkv
+
+Idle machines can take encodes off the host running tvhmkv or kodimkv.
+Each is described by a [worker:<name>] section of the config:
+
+    [worker:attic]
+    host = attic.local
+    user = chris
+    keyfn = id_ed25519
+    workdir = /var/tmp/tstomkv
+    slots = 1
+    cores = 8
+
+The coordinator hands a fetched transport stream and its encode profile to
+a free worker slot over ssh, starts ffmpeg there and tails its progress
+file. Each new progress block is a heartbeat that renews the job's lease.
+If the lease runs out, or ffmpeg goes away without finishing, the job is
+taken back and given to another worker and the failed one is rested for a
+lease period. The mkv is collected back for the usual verify and upload.
+
+A worker with host = local runs on this machine without ssh, so several
+of them can stand in for real nodes when testing.
+"""
+
+import hashlib
+import shlex
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+from tstomkv import errorNotify, progressBar
+from tstomkv.connections import pool
+from tstomkv.cores import x265Params
+from tstomkv.ffmpeg import transcodeCommand
+from tstomkv.progress import END, ProgressTail
+
+# seconds without a heartbeat before a job is taken back from its worker
+LEASE = 300
+# seconds between polls of a worker's progress
+HEARTBEAT = 10
+
+
+class WorkerError(Exception):
+    pass
+
+
+def jobName(src):
+    """the file name of src prefixed with a short hash of its full path, so
+    jobs for files of the same name don't share files in a workdir"""
+    digest = hashlib.blake2b(str(src).encode(), digest_size=4).hexdigest()
+    return f"{digest}-{Path(src).name}"
+
+
+class Worker:
+    """A host that encodes over ssh, see config.WorkerSettings."""
+
+    def __init__(
+        self,
+        name,
+        host,
+        user=None,
+        keyfn=None,
+        workdir="/var/tmp/tstomkv",
+        slots=1,
+        cores=None,
+    ):
+        self.name = name
+        self.host = host
+        self.user = user
+        self.keyfn = keyfn
+        self.workdir = workdir
+        self.slots = slots
+        self.cores = cores
+
+    def run(self, cmd, retry=True):
+        """run the shell command cmd on the worker, returns its stdout"""
+        return pool.run(self.host, self.user, self.keyfn, cmd, retry=retry).stdout
+
+    def execute(self, cmd):
+        """run the command list cmd on the worker, returns (returncode,
+        stdout, stderr) whether it succeeds or not"""
+        result = pool.run(self.host, self.user, self.keyfn, shlex.join(cmd), warn=True)
+        return result.exited, result.stdout, result.stderr
+
+    def put(self, local, remote):
+        with pool.sftp(self.host, self.user, self.keyfn) as sftp:
+            sftp.put(local, remote)
+
+    def get(self, remote, local):
+        with pool.sftp(self.host, self.user, self.keyfn) as sftp:
+            sftp.get(remote, local)
+
+    def path(self, name):
+        return f"{self.workdir}/{name}"
+
+    def start(self, cmd, log):
+        """start cmd in the background on the worker, returns its pid"""
+        out = self.run(
+            f"mkdir -p {shlex.quote(self.workdir)} && nohup {shlex.join(cmd)}"
+            f" > {shlex.quote(log)} 2>&1 < /dev/null & echo $!",
+            # a second ffmpeg would write over the first's output
+            retry=False,
+        )
+        return int(out.strip().split()[-1])
+
+    def alive(self, pid):
+        out = self.run(f"kill -0 {pid} 2>/dev/null && echo yes || echo no")
+        return out.strip() == "yes"
+
+    def kill(self, pid):
+        self.run(f"kill {pid} 2>/dev/null; true")
+
+    def read(self, path, offset):
+        """the contents of the worker's file path from offset onwards"""
+        path = shlex.quote(path)
+        return self.run(f"tail -c +{offset + 1} {path} 2>/dev/null; true")
+
+    def remove(self, *paths):
+        self.run(f"rm -f {' '.join(shlex.quote(p) for p in paths)}")
+
+
+class LocalWorker(Worker):
+    """A worker on this machine, standing in for a remote one."""
+
+    def run(self, cmd, retry=True):
+        return subprocess.run(
+            cmd, shell=True, capture_output=True, text=True, check=True
+        ).stdout
+
+    def execute(self, cmd):
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        return proc.returncode, proc.stdout, proc.stderr
+
+    def put(self, local, remote):
+        Path(remote).parent.mkdir(parents=True, exist_ok=True)
+        subprocess.run(["cp", local, remote], check=True)
+
+    def get(self, remote, local):
+        subprocess.run(["cp", remote, local], check=True)
+
+
+def makeWorkers(settings):
+    """Workers from a tuple of config.WorkerSettings"""
+    workers = []
+    for ws in settings:
+        cls = LocalWorker if ws.host == "local" else Worker
+        workers.append(
+            cls(ws.name, ws.host, ws.user, ws.keyfn, ws.workdir, ws.slots, ws.cores)
+        )
+    return workers
+
+
+class Coordinator:
+    """Hands encodes out to the workers' slots, tracking a lease for each.
+
+    A job is tried on up to attempts workers before giving up on it.
+    """
+
+    def __init__(self, workers, lease=LEASE, heartbeat=HEARTBEAT, attempts=2):
+        if len(workers) == 0:
+            raise WorkerError("no workers configured")
+        self.workers = {w.name: w for w in workers}
+        self.lease = lease
+        self.heartbeat = heartbeat
+        self.attempts = attempts
+        self.free = {w.name: w.slots for w in workers}
+        self.resting = {}
+        # src -> {"worker": name, "started": time, "expires": time}
+        self.leases = {}
+        self._cond = threading.Condition()
+
+    def slots(self):
+        return sum(w.slots for w in self.workers.values())
+
+    def _available(self, exclude):
+        now = time.time()
+        for name, free in self.free.items():
+            if free > 0 and name not in exclude and self.resting.get(name, 0) <= now:
+                return name
+        return None
+
+    def acquire(self, src, exclude=()):
+        """wait for a free slot on a worker, and lease it for src"""
+        with self._cond:
+            while True:
+                name = self._available(exclude)
+                if name is None and len(exclude) > 0:
+                    # rather a worker that failed this job than none at all
+                    name = self._available(())
+                if name is not None:
+                    break
+                self._cond.wait(timeout=self.heartbeat)
+            self.free[name] -= 1
+            now = time.time()
+            self.leases[src] = {
+                "worker": name,
+                "started": now,
+                "expires": now + self.lease,
+            }
+            return self.workers[name]
+
+    def renew(self, src):
+        with self._cond:
+            if src in self.leases:
+                self.leases[src]["expires"] = time.time() + self.lease
+
+    def expired(self, src):
+        with self._cond:
+            return src in self.leases and self.leases[src]["expires"] < time.time()
+
+    def release(self, src, ok=True):
+        """end src's lease, resting its worker for a lease period if it failed"""
+        with self._cond:
+            lease = self.leases.pop(src, None)
+            if lease is not None:
+                self.free[lease["worker"]] += 1
+                if not ok:
+                    self.resting[lease["worker"]] = time.time() + self.lease
+            self._cond.notify_all()
+
+    def encode(self, src, dst, duration=None, profile=None):
+        """encode the local file src to the local file dst on a worker"""
+        tried = []
+        for _ in range(self.attempts):
+            worker = self.acquire(src, exclude=tried)
+            tried.append(worker.name)
+            try:
+                print(f"Encoding {src} on {worker.name}")
+                self._encodeOn(worker, src, dst, duration, profile)
+                self.release(src)
+                return True
+            except Exception as e:
+                errorNotify(sys.exc_info()[2], e)
+                self.release(src, ok=False)
+        raise WorkerError(f"{src} failed on workers {', '.join(tried)}")
+
+    def _encodeOn(self, worker, src, dst, duration, profile):
+        name = jobName(src)
+        rsrc = worker.path(name)
+        rdst = worker.path(Path(name).with_suffix(".mkv").name)
+        rstats = worker.path(f"{name}-transcode.stats")
+        rlog = worker.path(f"{name}.log")
+        worker.run(f"mkdir -p {shlex.quote(worker.workdir)}")
+        worker.remove(rdst, rstats, rlog)
+        worker.put(src, rsrc)
+        x265params = None if worker.cores is None else x265Params(worker.cores)
+        cmd = transcodeCommand(
+            rsrc, rdst, rstats, x265params=x265params, profile=profile
+        )
+        pid = worker.start(cmd, rlog)
+        try:
+            self._watch(worker, pid, src, rstats, duration)
+            worker.get(rdst, dst)
+        finally:
+            worker.remove(rsrc, rdst, rstats, rlog)
+
+    def _watch(self, worker, pid, src, rstats, duration):
+        """follow the worker's progress until ffmpeg finishes"""
+        tail = ProgressTail(rstats)
+        while True:
+            running = worker.alive(pid)
+            data = worker.read(rstats, tail.offset)
+            tail.offset += len(data.encode())
+            for event in tail.feed(data):
+                self.renew(src)
+                if duration and event.out_time is not None:
+                    progressBar(event.out_time, duration)
+                if event.kind == END:
+                    if duration:
+                        print()
+                    return
+            if not running:
+                raise WorkerError(f"ffmpeg on {worker.name} exited without finishing")
+            if self.expired(src):
+                worker.kill(pid)
+                raise WorkerError(f"lease on {worker.name} expired, no progress")
+            time.sleep(self.heartbeat)
@@ -0,0 +1,11 @@
+import pytest
+
+from tstomkv import probecache
+
+
+@pytest.fixture(autouse=True)
+def isolatedProbeCache(tmp_path, monkeypatch):
+    """keep the tests' ffprobe results out of the real cache"""
+    monkeypatch.setattr(
+        probecache, "cache", probecache.ProbeCache(str(tmp_path / "probe.db"))
+    )
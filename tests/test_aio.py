@@ -0,0 +1,168 @@
+import asyncio
+import os
+import sys
+import time
+from unittest import mock
+
+import pytest
+
+from tstomkv import aio
+from tstomkv.cores import CoreBudget
+from tstomkv.progress import END, EXITED, STALLED, ProgressEvent
+from tstomkv.stages import CopyError
+
+# stands in for ffmpeg: copies src to dst, writing -progress blocks
+FAKEFFMPEG = """
+import shutil, sys, time
+src, dst, stats = sys.argv[1:4]
+with open(stats, "w") as fp:
+    for n in range(3):
+        fp.write(f"out_time_us={n * 1000000}\\nprogress=continue\\n")
+        fp.flush()
+        time.sleep(0.05)
+    shutil.copyfile(src, dst)
+    fp.write("out_time_us=3000000\\nprogress=end\\n")
+"""
+
+
+def fakeCommand(script):
+    def command(src, dst, stats, x265params=None, profile=None):
+        return [sys.executable, "-c", script, src, dst, stats]
+
+    return command
+
+
+def test_runProcess():
+    cmd = [sys.executable, "-c", "import sys; print('out'); sys.exit(3)"]
+    returncode, stdout, _ = asyncio.run(aio.runProcess(cmd))
+    assert returncode == 3
+    assert stdout.decode().strip() == "out"
+
+
+def test_runProcess_cancelled_kills_the_process(tmp_path):
+    pidfile = tmp_path / "pid"
+    script = f"import os, time; open({str(pidfile)!r}, 'w').write(str(os.getpid()));"
+    script += " time.sleep(30)"
+
+    async def run():
+        task = asyncio.create_task(aio.runProcess([sys.executable, "-c", script]))
+        while not pidfile.exists() or pidfile.read_text() == "":
+            await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    started = time.time()
+    asyncio.run(run())
+    assert time.time() - started < 10
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pidfile.read_text()), 0)
+
+
+def test_progressEvents_exited_without_stats(tmp_path):
+    async def run():
+        stats = str(tmp_path / "none.stats")
+        return [e async for e in aio.progressEvents(stats, alive=lambda: False)]
+
+    events = asyncio.run(run())
+    assert [e.kind for e in events] == [EXITED]
+
+
+def test_runEncode_follows_progress(tmp_path):
+    src = tmp_path / "rec.ts"
+    src.write_bytes(b"transport stream")
+    dst, stats = str(tmp_path / "out" / "rec.mkv"), str(tmp_path / "rec.ts.stats")
+    plan = {
+        "mode": "file",
+        "args": (str(src), dst, stats),
+        "kwargs": {"overwrite": True},
+        "statsfile": stats,
+        "duration": 3,
+    }
+    job = {}
+    with mock.patch("tstomkv.aio.transcodeCommand", fakeCommand(FAKEFFMPEG)):
+        asyncio.run(aio.runEncode(job, plan, interval=0.05))
+    assert job["progress"].kind == END
+    assert open(dst, "rb").read() == b"transport stream"
+
+
+def test_runEncode_kills_a_stalled_ffmpeg(tmp_path):
+    src = tmp_path / "rec.ts"
+    src.write_bytes(b"transport stream")
+    dst, stats = str(tmp_path / "rec.mkv"), str(tmp_path / "rec.ts.stats")
+    plan = {
+        "mode": "file",
+        "args": (str(src), dst, stats),
+        "kwargs": {"overwrite": True},
+        "statsfile": stats,
+        "duration": 3,
+    }
+
+    async def stalled(*args, **kwargs):
+        await asyncio.sleep(0.2)
+        return ProgressEvent(kind=STALLED)
+
+    started = time.time()
+    hang = fakeCommand("import time; time.sleep(30)")
+    with (
+        mock.patch("tstomkv.aio.transcodeCommand", hang),
+        mock.patch("tstomkv.aio.doStats", stalled),
+    ):
+        with pytest.raises(CopyError):
+            asyncio.run(aio.runEncode({}, plan))
+    assert time.time() - started < 10
+
+
+def test_runEncode_raises_when_ffmpeg_fails(tmp_path):
+    src = tmp_path / "rec.ts"
+    src.write_bytes(b"transport stream")
+    dst, stats = str(tmp_path / "rec.mkv"), str(tmp_path / "rec.ts.stats")
+    plan = {
+        "mode": "file",
+        "args": (str(src), dst, stats),
+        "kwargs": {"overwrite": True},
+        "statsfile": stats,
+        "duration": 3,
+    }
+    fail = fakeCommand("raise SystemExit(1)")
+    with mock.patch("tstomkv.aio.transcodeCommand", fail):
+        with pytest.raises(CopyError):
+            asyncio.run(aio.runEncode({}, plan, interval=0.05))
+
+
+def test_runEncode_runs_other_modes_in_a_thread():
+    target = mock.Mock()
+    plan = {"mode": "segmented", "target": target, "args": (1, 2), "kwargs": {}}
+    job = {}
+    asyncio.run(aio.runEncode(job, plan))
+    target.assert_called_once_with(1, 2)
+    assert job["progress"] is None
+
+
+def test_transcodeFile_needs_a_transport_stream(tmp_path):
+    with pytest.raises(ValueError):
+        asyncio.run(aio.transcodeFile("a.mp4", str(tmp_path / "a.mkv"), "stats"))
+
+
+def test_acquireCores_gives_back_cores_when_cancelled():
+    budget = CoreBudget(cores=4, jobs=2)
+    budget.acquire(4)
+
+    async def run():
+        task = asyncio.create_task(aio.acquireCores(budget, 4))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # the thread still waiting on the budget gets the cores once they
+        # are free, and hands them straight back
+        budget.release(4)
+        for _ in range(100):
+            if release.call_count == 2:
+                break
+            await asyncio.sleep(0.05)
+
+    with mock.patch.object(budget, "release", wraps=budget.release) as release:
+        asyncio.run(run())
+    assert release.call_count == 2
+    assert budget.free == 4
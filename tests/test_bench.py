@@ -0,0 +1,74 @@
+import os
+
+from tstomkv import bench
+
+
+def test_sampleCommand_maps_every_audio_track():
+    cmd = bench.sampleCommand("out.ts", 576, 30, "mpeg2video", "mp2", 3)
+    assert "testsrc2=size=720x576:rate=25:duration=30" in cmd
+    assert cmd.count("-map") == 4
+    assert cmd[-3:] == ["-f", "mpegts", "out.ts"]
+    cmd = bench.sampleCommand("out.ts", 1080, 30, "h264", "aac", 1)
+    assert "testsrc2=size=1920x1080:rate=25:duration=30" in cmd
+    assert "libx264" in cmd
+
+
+def test_loopbackTransfer(tmp_path, monkeypatch):
+    monkeypatch.setattr(bench, "CHUNKSIZE", 100)
+    data = os.urandom(1000)
+    src = tmp_path / "src.ts"
+    src.write_bytes(data)
+    for direction in ("get", "put"):
+        dst = tmp_path / f"{direction}.ts"
+        assert bench.loopbackTransfer(str(src), str(dst), direction, 3)
+        assert dst.read_bytes() == data
+
+
+def test_timed():
+    result, rec = bench.timed("s", "probe", lambda x: x * 2, 2)
+    assert result == 4
+    assert rec["sample"] == "s" and rec["stage"] == "probe" and rec["ok"]
+    _, rec = bench.timed("s", "verify", lambda: False)
+    assert rec["ok"] is False
+
+
+def test_compareResults():
+    old = {
+        "results": [
+            {"sample": "a", "stage": "encode", "seconds": 10.0},
+            {"sample": "a", "stage": "probe", "seconds": 0.01},
+            {"sample": "a", "stage": "upload", "seconds": 2.0},
+        ]
+    }
+    new = {
+        "results": [
+            {"sample": "a", "stage": "encode", "seconds": 12.0},
+            {"sample": "a", "stage": "probe", "seconds": 0.05},
+            {"sample": "a", "stage": "upload", "seconds": 2.1},
+            {"sample": "b", "stage": "encode", "seconds": 5.0},
+        ]
+    }
+    regressions = bench.compareResults(old, new, threshold=0.1)
+    assert [(r["sample"], r["stage"]) for r in regressions] == [("a", "encode")]
+    assert regressions[0]["change"] == 0.2
+
+
+def test_benchSample_failed_encode_is_not_ok(tmp_path, monkeypatch):
+    finfo = {
+        "format": {"duration": "30"},
+        "streams": [{"codec_type": "video", "codec_name": "mpeg2video"}],
+    }
+
+    def partial(src, mkv, statsfile, **kwargs):
+        with open(mkv, "wb") as fp:
+            fp.write(b"half an mkv")
+        return False
+
+    monkeypatch.setattr(bench, "makeSample", lambda src, spec: open(src, "wb").close())
+    monkeypatch.setattr(bench, "fileInfo", lambda fn: finfo)
+    monkeypatch.setattr(bench, "convert_ts_to_mkv", partial)
+    monkeypatch.setattr(bench, "checkDuration", lambda duration, fn: True)
+    spec = bench.SAMPLES["sd-30s"]
+    records = bench.benchSample("sd-30s", spec, str(tmp_path), channels=1)
+    encode = [r for r in records if r["stage"] == "encode"][0]
+    assert encode["ok"] is False
@@ -0,0 +1,77 @@
+import json
+
+import pytest
+
+from tstomkv import catalogue
+
+
+def entry(n, stop):
+    return {
+        "uuid": f"u{n}",
+        "filename": f"/var/lib/tvheadend/rec{n}.ts",
+        "disp_title": f"Show {n}",
+        "start_real": stop - 3600,
+        "stop_real": stop,
+    }
+
+
+class FakeTvh:
+    """tvheadend's grid_finished over a list of entries"""
+
+    def __init__(self, entries):
+        self.entries_ = list(entries)
+        self.requests = []
+
+    def get(self, route, data=None):
+        return {"entries": self.entries_[:1], "total": len(self.entries_)}
+
+    def entries(self, route, data=None):
+        self.requests.append(data)
+        entries = self.entries_
+        if "filter" in data:
+            since = json.loads(data["filter"])[0]["value"]
+            entries = [e for e in entries if e["stop_real"] > since]
+        return iter(entries)
+
+
+@pytest.fixture
+def cat(tmp_path):
+    tvh = FakeTvh([entry(1, 10000), entry(2, 20000)])
+    cat = catalogue.Catalogue(str(tmp_path / "cat.db"), client=tvh)
+    yield cat
+    cat.close()
+
+
+def test_first_sync_is_full(cat):
+    assert cat.sync() == (2, 0)
+    assert "filter" not in cat.client.requests[0]
+    assert [r["uuid"] for r in cat.recordings()] == ["u1", "u2"]
+    assert cat.recordings()[0]["title"] == "Show 1"
+
+
+def test_sync_only_fetches_new_recordings(cat):
+    cat.sync()
+    cat.client.entries_.append(entry(3, 30000))
+    # the newest already catalogued is within the slack so comes again
+    assert cat.sync() == (2, 0)
+    since = json.loads(cat.client.requests[-1]["filter"])[0]["value"]
+    assert since == 20000 - catalogue.SLACK
+    assert cat.count() == 3
+
+
+def test_sync_reconciles_deletions(cat):
+    cat.sync()
+    cat.client.entries_.pop(0)
+    cat.client.entries_.append(entry(3, 30000))
+    changed, removed = cat.sync()
+    assert removed == 1
+    assert [r["uuid"] for r in cat.recordings()] == ["u2", "u3"]
+
+
+def test_moved(cat):
+    cat.sync()
+    cat.moved("/var/lib/tvheadend/rec1.ts", "/var/lib/tvheadend/rec1.mkv")
+    assert cat.recordings()[0]["filename"] == "/var/lib/tvheadend/rec1.mkv"
+    # the move survives the next incremental sync
+    cat.sync()
+    assert cat.recordings()[0]["filename"] == "/var/lib/tvheadend/rec1.mkv"
@@ -1,6 +1,8 @@
 import os
 from unittest import mock
 
+import pytest
+
 # sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
 from tstomkv import config  # noqa: E402
 
@@ -46,3 +48,74 @@ def test_writeConfig_writes_file(tmp_path, monkeypatch):
     with mock.patch("tstomkv.config.__appname__", "testapp"):
         config.writeConfig(DummyCfg())
         assert cfgfile.read_text() == "written!"
+
+
+def cachedConfig(tmp_path, monkeypatch, text):
+    cfgfile = tmp_path / "cached.cfg"
+    cfgfile.write_text(text)
+    monkeypatch.setattr("tstomkv.config.expandPath", lambda p: str(cfgfile))
+    monkeypatch.setattr("tstomkv.config._cache", {})
+    return cfgfile
+
+
+def test_getConfig_parses_once(tmp_path, monkeypatch):
+    cachedConfig(tmp_path, monkeypatch, "[section]\nkey=val\n")
+    with mock.patch("tstomkv.config.readConfig", wraps=config.readConfig) as rc:
+        c1 = config.getConfig()
+        c2 = config.getConfig()
+        assert c1 is c2
+        assert rc.call_count == 1
+
+
+def test_getConfig_reloads_when_file_changes(tmp_path, monkeypatch):
+    cfgfile = cachedConfig(tmp_path, monkeypatch, "[section]\nkey=val\n")
+    assert config.getConfig().get("section", "key") == "val"
+    cfgfile.write_text("[section]\nkey=changed\n")
+    st = os.stat(cfgfile)
+    os.utime(cfgfile, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    assert config.getConfig().get("section", "key") == "changed"
+
+
+def test_getConfig_missing_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        "tstomkv.config.expandPath", lambda p: str(tmp_path / "nope.cfg")
+    )
+    with pytest.raises(config.ConfigFileNotFound):
+        config.getConfig()
+
+
+def test_typed_settings(tmp_path, monkeypatch):
+    cachedConfig(
+        tmp_path,
+        monkeypatch,
+        "[DEFAULT]\ntranscodedir=/t\ntvhipaddr=1.2.3.4\n"
+        "[mediaserver]\nhost=media\nuser=chris\nkeyfn=id_ed25519\n"
+        "[youtube]\nfilenumber=7\n",
+    )
+    assert config.defaultSettings().transcodedir == "/t"
+    ms = config.mediaServerSettings()
+    assert ms.host == "media"
+    assert ms.keyfn.endswith("cached.cfg")  # expandPath is patched
+    assert ms.koditvdir is None
+    assert config.youtubeSettings().filenumber == 7
+    assert config.mediaServerSettings() is ms
+
+
+def test_workerSettings(tmp_path, monkeypatch):
+    cachedConfig(
+        tmp_path,
+        monkeypatch,
+        "[worker:attic]\nuser=chris\nslots=2\ncores=8\n"
+        "[worker:test]\nhost=local\nworkdir=/tmp/w\n",
+    )
+    attic, test = config.workerSettings()
+    assert attic.host == "attic" and attic.slots == 2 and attic.cores == 8
+    assert test.host == "local" and test.workdir == "/tmp/w"
+    assert test.slots == 1 and test.cores is None
+
+
+def test_writeConfig_invalidates_cache(tmp_path, monkeypatch):
+    cachedConfig(tmp_path, monkeypatch, "[section]\nkey=val\n")
+    cfg = config.getConfig()
+    config.writeConfig(cfg)
+    assert config._cache == {}
@@ -0,0 +1,93 @@
+from unittest import mock
+
+import pytest
+
+from tstomkv import connections
+
+
+def fakeConnection(active=True):
+    c = mock.Mock()
+    c.is_connected = active
+    c.transport.is_active.return_value = active
+    return c
+
+
+def test_connection_is_reused():
+    pool = connections.ConnectionPool()
+    with mock.patch("tstomkv.connections.Connection") as mconn:
+        mconn.return_value = fakeConnection()
+        c1 = pool.connection("host", "user", "key")
+        c2 = pool.connection("host", "user", "key")
+        assert c1 is c2
+        assert mconn.call_count == 1
+        c1.transport.set_keepalive.assert_called_with(pool.keepalive)
+
+
+def test_dead_connection_is_replaced():
+    pool = connections.ConnectionPool()
+    dead = fakeConnection(active=False)
+    live = fakeConnection()
+    with mock.patch("tstomkv.connections.Connection", side_effect=[dead, live]):
+        assert pool.connection("host", "user", "key") is dead
+        assert pool.connection("host", "user", "key") is live
+        dead.close.assert_called_once()
+
+
+def test_run_reconnects_once_on_failure():
+    pool = connections.ConnectionPool()
+    broken = fakeConnection()
+    broken.run.side_effect = EOFError("gone")
+    good = fakeConnection()
+    good.run.return_value = "result"
+    with mock.patch("tstomkv.connections.Connection", side_effect=[broken, good]):
+        assert pool.run("host", "user", "key", "ls") == "result"
+
+
+def test_run_gives_up_after_one_retry():
+    pool = connections.ConnectionPool()
+    broken = fakeConnection()
+    broken.run.side_effect = EOFError("gone")
+    with mock.patch("tstomkv.connections.Connection", return_value=broken):
+        with pytest.raises(EOFError):
+            pool.run("host", "user", "key", "ls")
+
+
+def test_run_does_not_repeat_a_command_that_was_started():
+    pool = connections.ConnectionPool()
+    broken = fakeConnection()
+    broken.run.side_effect = EOFError("gone")
+    good = fakeConnection()
+    with mock.patch("tstomkv.connections.Connection", side_effect=[broken, good]):
+        with pytest.raises(EOFError):
+            pool.run("host", "user", "key", "mv a b", retry=False)
+        good.run.assert_not_called()
+        # the dead connection isn't used again
+        assert pool.connection("host", "user", "key") is good
+
+
+def test_run_retries_a_command_that_never_started():
+    pool = connections.ConnectionPool()
+    unreachable = fakeConnection()
+    unreachable.open.side_effect = OSError("no route to host")
+    good = fakeConnection()
+    good.run.return_value = "moved"
+    with mock.patch(
+        "tstomkv.connections.Connection", side_effect=[unreachable, good]
+    ):
+        assert pool.run("host", "user", "key", "mv a b", retry=False) == "moved"
+
+
+def test_sftp_opens_channel_on_shared_transport():
+    pool = connections.ConnectionPool()
+    c = fakeConnection()
+    with (
+        mock.patch("tstomkv.connections.Connection", return_value=c),
+        mock.patch("tstomkv.connections.SFTPClient") as msftp,
+    ):
+        with pool.sftp("host", "user", "key") as s1:
+            pass
+        with pool.sftp("host", "user", "key"):
+            pass
+        assert msftp.from_transport.call_count == 2
+        msftp.from_transport.assert_called_with(c.transport)
+        s1.close.assert_called()
@@ -0,0 +1,48 @@
+import threading
+
+from tstomkv import cores
+
+
+def test_coresPerJob_by_height():
+    assert cores.coresPerJob(None) == 4
+    assert cores.coresPerJob(576) == 4
+    assert cores.coresPerJob(720) == 6
+    assert cores.coresPerJob(1080) == 8
+    assert cores.coresPerJob(2160) == cores.UHDCORES
+
+
+def test_encodeJobs_scales_with_host():
+    assert cores.encodeJobs(4) == 1
+    assert cores.encodeJobs(24) == 6
+    assert cores.encodeJobs(24, 1080) == 3
+    assert cores.encodeJobs(2, 1080) == 1
+
+
+def test_x265Params():
+    assert cores.x265Params(4) == "pools=4:frame-threads=2"
+    assert cores.x265Params(8) == "pools=8:frame-threads=3"
+    assert cores.x265Params(2) == "pools=2:frame-threads=1"
+
+
+def test_CoreBudget_single_job_uses_all_cores():
+    budget = cores.CoreBudget(cores=8, jobs=1)
+    assert budget.share(1080) is None
+
+
+def test_CoreBudget_blocks_until_cores_free():
+    budget = cores.CoreBudget(cores=8, jobs=2)
+    assert budget.share(1080) == 8
+    budget.acquire(8)
+    got = threading.Event()
+
+    def second():
+        budget.acquire(4)
+        got.set()
+
+    t = threading.Thread(target=second)
+    t.start()
+    assert got.wait(0.1) is False
+    budget.release(8)
+    assert got.wait(1) is True
+    t.join()
+    assert budget.free == 4
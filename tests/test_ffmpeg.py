@@ -8,18 +8,27 @@ import tstomkv.ffmpeg as ffmpeg
 
 
 def test_convert_ts_to_mkv_valid(capsys):
-    with mock.patch("subprocess.run") as mrun:
-        mrun.return_value = types.SimpleNamespace(
-            returncode=0, raise_for_status=lambda: None, stdout="ok", stderr=""
-        )
-        ffmpeg.convert_ts_to_mkv("input.ts", "output.mkv", "stats.txt")
+    with mock.patch("subprocess.Popen") as mpopen:
+        mpopen.return_value.returncode = 0
+        ok = ffmpeg.convert_ts_to_mkv("input.ts", "output.mkv", "stats.txt")
         out = capsys.readouterr().out
         assert "Transcoding input.ts to output.mkv" in out
-        mrun.assert_called()
-        args = mrun.call_args[0][0]
+        assert ok is True
+        args = mpopen.call_args[0][0]
         assert "-progress" in args and "stats.txt" in args
 
 
+def test_convert_ts_to_mkv_hands_over_ffmpeg():
+    started = mock.Mock()
+    with mock.patch("subprocess.Popen") as mpopen:
+        mpopen.return_value.returncode = 1
+        ok = ffmpeg.convert_ts_to_mkv(
+            "input.ts", "output.mkv", "stats.txt", started=started
+        )
+    assert ok is False
+    started.assert_called_once_with(mpopen.return_value)
+
+
 def test_convert_ts_to_mkv_invalid_input():
     with mock.patch(
         "tstomkv.errorRaise",
@@ -112,3 +121,96 @@ def test_takeSnapshot_no_file(tmp_path):
     src = tmp_path / "nofile.ts"
     outjpg = tmp_path / "snap.jpg"
     assert ffmpeg.takeSnapshot(str(src), str(outjpg)) is None
+
+
+def test_convert_ts_to_mkv_x265params():
+    with mock.patch("subprocess.Popen") as mpopen:
+        mpopen.return_value.returncode = 0
+        ffmpeg.convert_ts_to_mkv(
+            "input.ts", "output.mkv", "stats.txt", x265params="pools=4"
+        )
+        args = mpopen.call_args[0][0]
+        assert args[args.index("-x265-params") + 1] == "pools=4"
+
+
+def test_videoHeight(tmp_path):
+    info = {"streams": [{"codec_type": "audio"}, {"codec_type": "video", "height": 576}]}
+    with mock.patch("tstomkv.ffmpeg.fileInfo", return_value=info):
+        assert ffmpeg.videoHeight("x.ts") == 576
+    with mock.patch("tstomkv.ffmpeg.fileInfo", return_value=None):
+        assert ffmpeg.videoHeight("x.ts") is None
+
+
+def test_convert_stream_to_mkv_feeds_stdin(tmp_path):
+    out = tmp_path / "out.mkv"
+    with mock.patch("subprocess.Popen") as mpopen:
+        proc = mpopen.return_value
+        proc.wait.return_value = 0
+        ok = ffmpeg.convert_stream_to_mkv([b"ab", b"cd"], str(out), "stats.txt")
+        assert ok is True
+        args = mpopen.call_args[0][0]
+        assert args[args.index("-i") + 1] == "pipe:0"
+        assert args[args.index("-f") + 1] == "mpegts"
+        proc.stdin.write.assert_has_calls([mock.call(b"ab"), mock.call(b"cd")])
+        proc.stdin.close.assert_called()
+
+
+def test_convert_stream_to_mkv_ffmpeg_dies(tmp_path):
+    out = tmp_path / "out.mkv"
+    with mock.patch("subprocess.Popen") as mpopen:
+        proc = mpopen.return_value
+        proc.stdin.write.side_effect = BrokenPipeError()
+        proc.wait.return_value = 1
+        assert ffmpeg.convert_stream_to_mkv([b"ab"], str(out), "s") is False
+
+
+def test_checkDuration():
+    with mock.patch("tstomkv.ffmpeg.videoDuration", return_value=95):
+        assert ffmpeg.checkDuration(100, "out.mkv") is True
+        assert ffmpeg.checkDuration(200, "out.mkv") is False
+        assert ffmpeg.checkDuration(None, "out.mkv") is False
+
+
+def test_remoteFileInfo():
+    with mock.patch("tstomkv.ffmpeg.remoteCommand", return_value='{"streams": []}'):
+        assert ffmpeg.remoteFileInfo("/r/a.ts") == {"streams": []}
+    with mock.patch("tstomkv.ffmpeg.remoteCommand", return_value=""):
+        assert ffmpeg.remoteFileInfo("/r/a.ts") is None
+
+
+def test_fileInfo_probes_once(tmp_path):
+    fakefile = tmp_path / "video.ts"
+    fakefile.write_text("dummy")
+    with mock.patch("subprocess.run") as mrun:
+        mrun.return_value = types.SimpleNamespace(
+            returncode=0, stdout=b'{"streams": [], "format": {"duration": "12.5"}}'
+        )
+        assert ffmpeg.videoDuration(str(fakefile)) == 12
+        assert ffmpeg.fileInfo(str(fakefile))["format"]["duration"] == "12.5"
+        assert mrun.call_count == 1
+        args = mrun.call_args[0][0]
+        assert "-show_streams" in args and "-show_format" in args
+
+
+def test_transcodeCommand_profile():
+    profile = {
+        "preset": "slow",
+        "crf": "22",
+        "audiocodec": "aac",
+        "audiobitrate": "96k",
+    }
+    cmd = ffmpeg.transcodeCommand("in.ts", "out.mkv", "stats", profile=profile)
+    assert cmd[cmd.index("-preset") + 1] == "slow"
+    assert cmd[cmd.index("-crf") + 1] == "22"
+    assert cmd[cmd.index("-b:a") + 1] == "96k"
+    assert "-crf" not in ffmpeg.transcodeCommand("in.ts", "out.mkv", "stats")
+
+
+def test_transcodeCommand_copies_streams():
+    profile = {"copyvideo": True, "copyaudio": True, "crf": "22"}
+    cmd = ffmpeg.transcodeCommand(
+        "in.ts", "out.mkv", "stats", x265params="pools=4", profile=profile
+    )
+    assert cmd[cmd.index("-c:v") + 1] == "copy"
+    assert cmd[cmd.index("-c:a") + 1] == "copy"
+    assert "-crf" not in cmd and "-x265-params" not in cmd and "-b:a" not in cmd
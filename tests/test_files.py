@@ -86,3 +86,51 @@ def test_dirFileList_none(tmp_path):
     (tmp_path / "a.txt").write_text("x")
     files_list = files.dirFileList(str(tmp_path))
     assert "a.txt" in files_list
+
+
+def test_getFile_uses_pooled_sftp():
+    with (
+        mock.patch("tstomkv.files.mediaServer", return_value=("h", "u", "k")),
+        mock.patch("tstomkv.files.pool") as mpool,
+    ):
+        assert files.getFile("/remote/a.ts", "/local/a.ts") is True
+        mpool.sftp.assert_called_with("h", "u", "k")
+        sftp = mpool.sftp.return_value.__enter__.return_value
+        sftp.get.assert_called_with("/remote/a.ts", "/local/a.ts")
+
+
+def test_remoteCommand_uses_pool():
+    with (
+        mock.patch("tstomkv.files.mediaServer", return_value=("h", "u", "k")),
+        mock.patch("tstomkv.files.pool") as mpool,
+    ):
+        mpool.run.return_value = mock.Mock(stdout=" done\n")
+        assert files.remoteCommand("ls") == "done"
+        mpool.run.assert_called_with("h", "u", "k", "ls", retry=True)
+
+
+def test_remoteBlocks_reads_in_windows():
+    with (
+        mock.patch("tstomkv.files.mediaServer", return_value=("h", "u", "k")),
+        mock.patch("tstomkv.files.pool") as mpool,
+    ):
+        sftp = mpool.sftp.return_value.__enter__.return_value
+        sftp.stat.return_value = mock.Mock(st_size=10)
+        rfile = sftp.open.return_value.__enter__.return_value
+        rfile.readv.side_effect = lambda chunks: [b"x" * n for _, n in chunks]
+        with files.remoteBlocks("/r/a.ts", blocksize=3, window=2) as blocks:
+            data = b"".join(blocks)
+        assert data == b"x" * 10
+        assert rfile.readv.call_args_list[0] == mock.call([(0, 3), (3, 3)])
+        assert rfile.readv.call_args_list[1] == mock.call([(6, 3), (9, 1)])
+
+
+def test_remoteFileSizes():
+    ms = mock.Mock(koditvdir="/tv", kodifilmdir="/films")
+    with (
+        mock.patch("tstomkv.files.mediaServerSettings", return_value=ms),
+        mock.patch("tstomkv.files.mediaServer", return_value=("h", "u", "k")),
+        mock.patch("tstomkv.files.pool") as mpool,
+    ):
+        mpool.run.return_value = mock.Mock(stdout="10 /tv/a b.ts\n2000 /films/c.ts\n")
+        assert files.remoteFileSizes() == {"/tv/a b.ts": 10, "/films/c.ts": 2000}
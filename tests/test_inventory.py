@@ -0,0 +1,88 @@
+import shutil
+import subprocess
+
+import pytest
+
+from tstomkv import inventory
+
+
+class LocalRun:
+    """runs the inventory's commands here rather than on the media server"""
+
+    def __init__(self):
+        self.commands = []
+
+    def __call__(self, cmd):
+        self.commands.append(cmd)
+        return subprocess.run(
+            cmd, shell=True, capture_output=True, text=True, check=True
+        ).stdout
+
+
+@pytest.fixture
+def library(tmp_path):
+    tv, films = tmp_path / "tv", tmp_path / "films"
+    (tv / "Show A").mkdir(parents=True)
+    (tv / "Show B").mkdir(parents=True)
+    films.mkdir()
+    (tv / "Show A" / "e1.ts").write_bytes(b"x" * 10)
+    (tv / "Show B" / "e 2.ts").write_bytes(b"x" * 20)
+    (tv / "Show B" / "e2.nfo").write_bytes(b"x")
+    (films / "film.ts").write_bytes(b"x" * 30)
+    return tv, films
+
+
+@pytest.fixture
+def inv(tmp_path):
+    run = LocalRun()
+    inv = inventory.Inventory(str(tmp_path / "inv.db"), run=run)
+    yield inv
+    inv.close()
+
+
+def test_parseFiles():
+    out = "10 1700000000.5 /tv/a b.ts\n\n20 1700000001.0 /films/c.ts\n"
+    assert inventory.parseFiles(out) == [
+        ("/tv/a b.ts", 10, 1700000000.5),
+        ("/films/c.ts", 20, 1700000001.0),
+    ]
+    assert inventory.parseDirs("1.5 /tv/x y\n") == {"/tv/x y": 1.5}
+
+
+def test_first_scan_lists_everything(library, inv):
+    tv, films = library
+    assert inv.scan([str(tv), str(films)]) == (4, 0)
+    assert inv.sizes() == {
+        str(films / "film.ts"): 30,
+        str(tv / "Show A" / "e1.ts"): 10,
+        str(tv / "Show B" / "e 2.ts"): 20,
+    }
+
+
+def test_later_scans_only_look_in_changed_dirs(library, inv):
+    tv, films = library
+    roots = [str(tv), str(films)]
+    inv.scan(roots)
+    inv.run.commands.clear()
+    assert inv.scan(roots) == (0, 0)
+    # just the directory listing
+    assert len(inv.run.commands) == 1
+    (tv / "Show A" / "e3.ts").write_bytes(b"x" * 5)
+    shutil.rmtree(tv / "Show B")
+    inv.run.commands.clear()
+    # Show A gained a file and tv lost Show B
+    assert inv.scan(roots) == (2, 1)
+    assert len(inv.run.commands) == 2
+    assert "-maxdepth 1" in inv.run.commands[1]
+    assert inv.sizes() == {
+        str(films / "film.ts"): 30,
+        str(tv / "Show A" / "e1.ts"): 10,
+        str(tv / "Show A" / "e3.ts"): 5,
+    }
+
+
+def test_full_scan_when_the_roots_change(library, inv):
+    tv, films = library
+    inv.scan([str(tv)])
+    assert inv.scan([str(tv), str(films)]) == (4, 0)
+    assert str(films / "film.ts") in inv.sizes()
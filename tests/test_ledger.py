@@ -0,0 +1,79 @@
+import pytest
+
+from tstomkv import ledger
+
+
+@pytest.fixture
+def jobs(tmp_path):
+    led = ledger.Ledger(str(tmp_path / "jobs.db"), maxattempts=3, backoff=10)
+    yield led
+    led.close()
+
+
+def test_listed_and_advance(jobs):
+    jobs.listed("/r/a.ts")
+    assert jobs.state("/r/a.ts") == "listed"
+    jobs.advance("/r/a.ts", "encoded")
+    jobs.listed("/r/a.ts")  # listing again doesn't reset it
+    assert jobs.state("/r/a.ts") == "encoded"
+    assert jobs.reached("/r/a.ts", "fetched") is True
+    assert jobs.reached("/r/a.ts", "uploaded") is False
+    assert jobs.reached("/r/b.ts", "listed") is False
+
+
+def test_advance_unknown_state(jobs):
+    jobs.listed("/r/a.ts")
+    with pytest.raises(ValueError):
+        jobs.advance("/r/a.ts", "nonsense")
+
+
+def test_failures_back_off_and_give_up(jobs):
+    jobs.listed("/r/a.ts")
+    assert jobs.ready("/r/a.ts") is True
+    jobs.failed("/r/a.ts", "boom")
+    row = jobs.job("/r/a.ts")
+    assert row["attempts"] == 1 and row["lasterror"] == "boom"
+    assert jobs.ready("/r/a.ts") is False
+    assert jobs.ready("/r/a.ts", now=row["nextattempt"]) is True
+    jobs.failed("/r/a.ts", "boom")
+    second = jobs.job("/r/a.ts")["nextattempt"]
+    assert second - row["nextattempt"] >= 10  # the wait doubled
+    jobs.failed("/r/a.ts", "boom")
+    assert jobs.ready("/r/a.ts", now=second + 10_000) is False
+
+
+def test_finished_jobs_are_not_ready(jobs):
+    jobs.listed("/r/a.ts")
+    jobs.advance("/r/a.ts", "removed")
+    assert jobs.ready("/r/a.ts") is False
+
+
+def test_ledger_persists(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    led = ledger.Ledger(path)
+    led.listed("/r/a.ts")
+    led.advance("/r/a.ts", "fetched")
+    led.stageDone({"src": "/r/a.ts"}, "fetch", 1.0, 3.0)
+    led.close()
+    led = ledger.Ledger(path)
+    assert led.state("/r/a.ts") == "fetched"
+    assert led.timings("/r/a.ts")[0]["stage"] == "fetch"
+    led.close()
+
+
+def test_ledger_records_encode_throughput(jobs):
+    job = {
+        "src": "/r/a.ts",
+        "encoded": {
+            "height": 576,
+            "duration": 100,
+            "cores": 4,
+            "srcbytes": 5000,
+            "dstbytes": 1000,
+        },
+    }
+    jobs.listed("/r/a.ts")
+    jobs.stageDone(job, "encode", 0, 50)
+    jobs.encoded("/r/b.ts", 1080, 100, 1000, None, 3000)
+    assert jobs.throughput() == {576: (10, 2), 1080: (30, 10)}
+    assert jobs.throughput(lambda h: "all") == {"all": (20, 6)}
@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+from tstomkv import metrics
+from tstomkv.progress import END, ProgressEvent
+
+
+def test_measure_records_seconds_bytes_and_rate():
+    job = {}
+    with metrics.measure(job, "fetch") as step:
+        step["bytes"] = 5_000_000
+    (record,) = job["steps"]
+    assert record["step"] == "fetch"
+    assert record["seconds"] >= 0
+    assert record["bytes"] == 5_000_000
+
+
+def test_measure_records_failed_steps():
+    job = {}
+    with pytest.raises(OSError):
+        with metrics.measure(job, "upload", 10):
+            raise OSError("gone")
+    assert job["steps"][0]["step"] == "upload"
+
+
+def test_encodeFigures():
+    record = {}
+    metrics.encodeFigures(record, ProgressEvent(kind=END, fps=50.0, speed=2.0))
+    assert record == {"fps": 50.0, "speed": 2.0}
+    metrics.encodeFigures(record, None)
+    assert record == {"fps": 50.0, "speed": 2.0}
+
+
+def test_metrics_listener_writes_json_lines_and_promfile(tmp_path):
+    log, prom = tmp_path / "m.jsonl", tmp_path / "m.prom"
+    m = metrics.Metrics(str(log), promfile=str(prom), host="box")
+    job = {"src": "/r/a.ts"}
+    with metrics.measure(job, "encode", 1000) as step:
+        step.update(fps=25.0, speed=1.5)
+    m.stageDone(job, "encode", 0, 10)
+    m.stageFailed({"src": "/r/b.ts"}, "upload", 0, 1, OSError("gone"))
+    lines = [json.loads(line) for line in log.read_text().splitlines()]
+    assert lines[0]["stage"] == "encode" and lines[0]["ok"] is True
+    assert lines[0]["steps"][0]["fps"] == 25.0
+    assert lines[1]["ok"] is False and lines[1]["error"] == "gone"
+    assert "steps" not in job
+    text = prom.read_text()
+    labels = 'host="box",stage="encode",step="encode"'
+    assert f"tstomkv_step_bytes_total{{{labels}}} 1000" in text
+    assert 'tstomkv_stage_failures_total{host="box",stage="upload"} 1' in text
+    assert 'tstomkv_encode_speed{host="box",step="encode"} 1.5' in text
+
+
+def test_metrics_drops_steps_of_earlier_attempts():
+    m = metrics.Metrics(host="box")
+    job = {"steps": [{"step": "fetch", "started": 1, "seconds": 1, "bytes": 1}]}
+    m.stageDone(job, "fetch", 5, 6)
+    assert m.totals == {}
@@ -0,0 +1,193 @@
+import asyncio
+import configparser
+import threading
+import time
+
+from tstomkv import pipeline
+
+
+def test_pipeline_runs_jobs_through_all_stages():
+    seen = []
+
+    def double(job):
+        job["n"] *= 2
+        return job
+
+    def record(job):
+        seen.append(job["n"])
+        return job
+
+    stages = [pipeline.Stage("a", double), pipeline.Stage("b", record, workers=2)]
+    pipe = pipeline.Pipeline(stages, queuedepth=1)
+    completed, failed = pipe.run({"n": n} for n in range(5))
+    assert sorted(seen) == [0, 2, 4, 6, 8]
+    assert len(completed) == 5
+    assert failed == []
+
+
+def test_pipeline_overlaps_stages():
+    running = set()
+    overlap = threading.Event()
+    lock = threading.Lock()
+
+    def stage(name):
+        def func(job):
+            with lock:
+                running.add(name)
+                if len(running) > 1:
+                    overlap.set()
+            time.sleep(0.05)
+            with lock:
+                running.discard(name)
+            return job
+
+        return func
+
+    stages = [pipeline.Stage("a", stage("a")), pipeline.Stage("b", stage("b"))]
+    pipeline.Pipeline(stages).run({"n": n} for n in range(4))
+    assert overlap.is_set()
+
+
+def test_pipeline_drops_none_jobs():
+    stages = [pipeline.Stage("a", lambda job: None if job["n"] % 2 else job)]
+    completed, _ = pipeline.Pipeline(stages).run({"n": n} for n in range(4))
+    assert [j["n"] for j in completed] == [0, 2]
+
+
+def test_pipeline_failure_stops_feeding():
+    def fail(job):
+        raise ValueError("bad")
+
+    stages = [pipeline.Stage("a", fail)]
+    pipe = pipeline.Pipeline(stages)
+    fed = []
+
+    def jobs():
+        for n in range(100):
+            fed.append(n)
+            yield {"n": n}
+
+    completed, failed = pipe.run(jobs())
+    assert completed == []
+    assert failed[0][1] == "a"
+    assert isinstance(failed[0][2], ValueError)
+    assert len(fed) < 100
+
+
+def test_pipeline_stopcheck():
+    stages = [pipeline.Stage("a", lambda job: job)]
+    pipe = pipeline.Pipeline(stages, stopcheck=lambda: True)
+    completed, failed = pipe.run({"n": n} for n in range(3))
+    assert completed == [] and failed == []
+    assert pipe.stopped is True
+
+
+def test_pipelineSettings_defaults_and_overrides():
+    cfg = configparser.ConfigParser()
+    assert pipeline.pipelineSettings(cfg)["queuedepth"] == 1
+    cfg.read_string("[pipeline]\nencodeworkers = 3\nqueuedepth = 2\n")
+    ps = pipeline.pipelineSettings(cfg)
+    assert ps["encodeworkers"] == 3
+    assert ps["queuedepth"] == 2
+    assert ps["fetchworkers"] == 1
+
+
+def test_pipeline_retries_then_notifies_listeners():
+    calls = []
+
+    def flaky(job):
+        calls.append(job["n"])
+        if len(calls) < 2:
+            raise OSError("blip")
+        return job
+
+    class Listener:
+        def __init__(self):
+            self.done = []
+            self.failed = []
+
+        def stageDone(self, job, stagename, started, finished):
+            self.done.append(stagename)
+
+        def stageFailed(self, job, stagename, started, finished, e):
+            self.failed.append(stagename)
+
+    listener = Listener()
+    stages = [pipeline.Stage("a", flaky, retries=1, backoff=0)]
+    pipe = pipeline.Pipeline(stages, listeners=[listener])
+    completed, failed = pipe.run([{"n": 1}])
+    assert len(completed) == 1 and failed == []
+    assert calls == [1, 1]
+    assert listener.done == ["a"]
+
+
+def test_pipeline_carries_on_after_failure():
+    def fail_odd(job):
+        if job["n"] % 2:
+            raise ValueError("odd")
+        return job
+
+    stages = [pipeline.Stage("a", fail_odd)]
+    pipe = pipeline.Pipeline(stages, abortonerror=False)
+    completed, failed = pipe.run({"n": n} for n in range(6))
+    assert len(completed) == 3 and len(failed) == 3
+
+
+def test_asyncpipeline_runs_coroutine_and_blocking_stages():
+    async def double(job):
+        await asyncio.sleep(0.01)
+        job["n"] *= 2
+        return job
+
+    def inc(job):
+        job["n"] += 1
+        return job
+
+    stages = [pipeline.Stage("a", double, workers=3), pipeline.Stage("b", inc)]
+    pipe = pipeline.AsyncPipeline(stages)
+    completed, failed = pipe.run({"n": n} for n in range(5))
+    assert sorted(j["n"] for j in completed) == [1, 3, 5, 7, 9]
+    assert failed == []
+
+
+def test_asyncpipeline_retries_and_fails():
+    calls = []
+
+    async def fail(job):
+        calls.append(job["n"])
+        raise ValueError("boom")
+
+    stages = [pipeline.Stage("a", fail, retries=1, backoff=0)]
+    pipe = pipeline.AsyncPipeline(stages)
+    completed, failed = pipe.run([{"n": 1}])
+    assert completed == []
+    assert calls == [1, 1]
+    assert isinstance(failed[0][2], ValueError)
+
+
+def test_asyncpipeline_stopcheck():
+    stages = [pipeline.Stage("a", lambda job: job)]
+    pipe = pipeline.AsyncPipeline(stages, stopcheck=lambda: True)
+    completed, failed = pipe.run({"n": n} for n in range(3))
+    assert completed == [] and failed == []
+    assert pipe.stopped is True
+
+
+def test_asyncpipeline_cancel_stops_jobs_in_flight():
+    started = []
+
+    async def slow(job):
+        started.append(job["n"])
+        if len(started) == 2:
+            pipe.cancel()
+        await asyncio.sleep(30)
+        return job
+
+    stages = [pipeline.Stage("a", slow, workers=2)]
+    pipe = pipeline.AsyncPipeline(stages)
+    t0 = time.time()
+    completed, failed = pipe.run({"n": n} for n in range(5))
+    assert time.time() - t0 < 10
+    assert completed == [] and failed == []
+    assert pipe.stopped is True
+    assert started == [0, 1]
@@ -0,0 +1,60 @@
+import os
+
+from tstomkv import probecache
+
+
+def test_cache_roundtrip_and_persists(tmp_path):
+    media = tmp_path / "a.ts"
+    media.write_text("x")
+    path = str(tmp_path / "cache" / "probe.db")
+    cache = probecache.ProbeCache(path)
+    assert cache.get(str(media)) is None
+    cache.put(str(media), {"streams": [1]})
+    assert cache.get(str(media)) == {"streams": [1]}
+    assert probecache.ProbeCache(path).get(str(media)) == {"streams": [1]}
+
+
+def test_cache_misses_when_file_changes(tmp_path):
+    media = tmp_path / "a.ts"
+    media.write_text("x")
+    cache = probecache.ProbeCache(str(tmp_path / "probe.db"))
+    cache.put(str(media), {"streams": []})
+    media.write_text("longer")
+    assert cache.get(str(media)) is None
+
+
+def test_cache_drops_least_recently_used(tmp_path):
+    cache = probecache.ProbeCache(str(tmp_path / "probe.db"), maxentries=2)
+    names = []
+    for n in range(3):
+        media = tmp_path / f"{n}.ts"
+        media.write_text("x")
+        names.append(str(media))
+        cache.put(str(media), {"n": n})
+    assert cache.get(names[0]) is None
+    assert cache.get(names[2]) == {"n": 2}
+
+
+def test_cachePath_uses_xdg(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    assert probecache.cachePath() == os.path.join(str(tmp_path), "tstomkv", "probe.db")
+
+
+def test_cache_keeps_use_times_across_runs(tmp_path):
+    path = str(tmp_path / "probe.db")
+    cache = probecache.ProbeCache(path, maxentries=2)
+    names = []
+    for n in range(2):
+        media = tmp_path / f"{n}.ts"
+        media.write_text("x")
+        names.append(str(media))
+        cache.put(str(media), {"n": n})
+    # 0 is used again in this run, so 1 is the least recently used next run
+    assert cache.get(names[0]) == {"n": 0}
+    cache.close()
+    cache = probecache.ProbeCache(path, maxentries=2)
+    media = tmp_path / "2.ts"
+    media.write_text("x")
+    cache.put(str(media), {"n": 2})
+    assert cache.get(names[0]) == {"n": 0}
+    assert cache.get(names[1]) is None
@@ -0,0 +1,102 @@
+import configparser
+
+import pytest
+
+from tstomkv import profiles
+
+
+def probe(height=1080, codec="h264", fieldorder="progressive", duration="3600"):
+    return {
+        "streams": [
+            {"codec_type": "audio", "codec_name": "mp2"},
+            {
+                "codec_type": "video",
+                "codec_name": codec,
+                "height": height,
+                "field_order": fieldorder,
+            },
+        ],
+        "format": {"duration": duration},
+    }
+
+
+def test_chooseProfile_default():
+    name, settings = profiles.chooseProfile(probe())
+    assert name == "default"
+    assert settings == profiles.DEFAULTPROFILE
+
+
+def test_chooseProfile_readme_rules():
+    # the example sections in the README
+    cfg = configparser.ConfigParser()
+    cfg.read_string(
+        "[profile:news]\ncategory = news, current affairs, weather\n"
+        "preset = faster\ncrf = 28\naudiobitrate = 96k\n"
+        "[profile:film-hd]\ncategory = movie, film\nminheight = 720\n"
+        "preset = slow\ncrf = 22\n"
+    )
+    name, settings = profiles.chooseProfile(probe(), {"category": ["News"]}, cfg)
+    assert name == "news"
+    assert settings["preset"] == "faster"
+    assert settings["audiocodec"] == "aac"
+    film = {"category": ["Movie / Drama"]}
+    name, _ = profiles.chooseProfile(probe(), film, cfg)
+    assert name == "film-hd"
+    name, _ = profiles.chooseProfile(probe(576), film, cfg)
+    assert name == "default"
+
+
+def test_chooseProfile_without_rules_is_unchanged():
+    for rec in ({"category": ["News"]}, {"category": ["Movie / Drama"]}):
+        assert profiles.chooseProfile(probe(), rec) == (
+            "default",
+            profiles.DEFAULTPROFILE,
+        )
+
+
+def test_chooseProfile_config_rules_come_first():
+    cfg = configparser.ConfigParser()
+    cfg.read_string(
+        "[DEFAULT]\nuser = me\n"
+        "[profile:sd-interlaced]\nmaxheight = 576\nfieldorder = interlaced\n"
+        "preset = fast\n"
+        "[profile:bbc-news]\nchannelname = BBC News, BBC One\n"
+        "category = news\ncrf = 26\n"
+    )
+    rec = {"category": ["News"], "channelname": "BBC News"}
+    name, settings = profiles.chooseProfile(probe(), rec, cfg)
+    assert name == "bbc-news"
+    assert settings["crf"] == "26"
+    assert settings["preset"] == "medium"
+    name, settings = profiles.chooseProfile(probe(576, fieldorder="tt"), None, cfg)
+    assert name == "sd-interlaced"
+    assert settings["preset"] == "fast"
+
+
+def test_ruleMatches_durations_and_unknown_keys():
+    details = profiles.recordingDetails(probe(duration="600"))
+    assert profiles.ruleMatches({"maxduration": "900"}, details)
+    assert not profiles.ruleMatches({"minduration": "900"}, details)
+    with pytest.raises(ValueError):
+        profiles.ruleMatches({"colour": "red"}, details)
+
+
+def test_copyDecision():
+    finfo = probe(codec="hevc")
+    finfo["streams"][0]["codec_name"] = "aac"
+    assert profiles.copyDecision(finfo)[:2] == (True, True)
+    assert profiles.copyDecision(probe())[:2] == (False, False)
+    settings = {**profiles.DEFAULTPROFILE, "copy": "no"}
+    assert profiles.copyDecision(finfo, settings)[:2] == (False, False)
+    assert profiles.copyDecision(None)[:2] == (False, False)
+
+
+def test_configRules_reports_a_bad_section():
+    cfg = configparser.ConfigParser()
+    cfg.read_string("[profile:kids]\nchanel = CBBC\npreset = fast\n")
+    with pytest.raises(profiles.ProfileError, match=r"chanel in \[profile:kids\]"):
+        profiles.configRules(cfg)
+    cfg = configparser.ConfigParser()
+    cfg.read_string("[profile:long]\nminduration = an hour\n")
+    with pytest.raises(profiles.ProfileError, match="not a number"):
+        profiles.configRules(cfg)
@@ -0,0 +1,98 @@
+import asyncio
+import json
+import subprocess
+import sys
+import threading
+import tracemalloc
+
+import pytest
+
+from tstomkv import profiling
+
+
+@pytest.fixture(autouse=True)
+def stopTracing():
+    yield
+    tracemalloc.stop()
+
+
+def busy(job):
+    total = sum(range(100_000))
+    subprocess.run([sys.executable, "-c", "pass"], check=True)
+    job["total"] = total
+    return job
+
+
+def test_wrap_profiles_each_call(tmp_path):
+    prof = profiling.Profiler(str(tmp_path / "bundle"), top=5)
+    stage = prof.wrap("fetch", busy)
+    assert stage({"src": "/r/a.ts"})["total"] == sum(range(100_000))
+    stage({"src": "/r/b.ts"})
+    assert not any(c["overlapped"] for c in prof.calls)
+    totals = prof.totals()["fetch"]
+    assert totals["calls"] == 2
+    assert totals["subprocesses"] == 2
+    assert totals["wall"] >= totals["cpu"] >= 0
+    assert "busy" in prof.hotSpots("fetch")
+
+
+def test_wrap_keeps_coroutine_stages_async(tmp_path):
+    prof = profiling.Profiler(str(tmp_path / "bundle"))
+
+    async def encode(job):
+        await asyncio.sleep(0.01)
+        return job
+
+    stage = prof.wrap("encode", encode)
+    assert asyncio.iscoroutinefunction(stage)
+    assert asyncio.run(stage({"src": "/r/a.ts"})) == {"src": "/r/a.ts"}
+    assert prof.calls[0]["waiting"] > 0
+
+
+def test_section_records_failed_calls(tmp_path):
+    prof = profiling.Profiler(str(tmp_path / "bundle"))
+    try:
+        with prof.section("upload", "/r/a.ts"):
+            raise OSError("gone")
+    except OSError:
+        pass
+    assert prof.calls[0]["ok"] is False
+
+
+def test_write_bundle(tmp_path):
+    outdir = tmp_path / "bundle"
+    prof = profiling.Profiler(str(outdir))
+    prof.wrap("fetch", busy)({"src": "/r/a.ts"})
+    summary = prof.write()
+    assert "hot spots of the fetch stage" in summary
+    assert (outdir / "fetch.prof").exists()
+    assert (outdir / "summary.txt").read_text().startswith("run of")
+    call = json.loads((outdir / "calls.jsonl").read_text().splitlines()[0])
+    assert call["stage"] == "fetch" and call["src"] == "/r/a.ts"
+
+
+def test_sections_run_at_once(tmp_path):
+    prof = profiling.Profiler(str(tmp_path / "bundle"), top=5)
+    inside = threading.Barrier(2, timeout=5)
+
+    def call(name):
+        with prof.section(name, f"/r/{name}.ts"):
+            inside.wait()
+            sum(range(100_000))
+            inside.wait()
+
+    threads = [threading.Thread(target=call, args=(n,)) for n in ("fetch", "upload")]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(c["stage"] for c in prof.calls) == ["fetch", "upload"]
+    assert all(c["ok"] for c in prof.calls)
+    # only one call at a time can be under cProfile
+    assert sum(c["profiled"] for c in prof.calls) == 1
+    totals = prof.totals()
+    assert totals["fetch"]["profiled"] + totals["upload"]["profiled"] == 1
+    # so their child cpu can't be told apart
+    assert all(c["overlapped"] for c in prof.calls)
+    assert "2 of 2 calls overlapped others" in prof.summary()
+    assert "hot spots of the" in prof.write()
@@ -0,0 +1,83 @@
+import os
+
+from tstomkv import progress
+
+EXAMPLE = os.path.join(os.path.dirname(__file__), "../data/stats-output.example")
+
+
+def test_parseBlock_handles_na():
+    ev = progress.parseBlock(
+        {"frame": "10", "bitrate": "N/A", "out_time_us": "N/A", "progress": "continue"}
+    )
+    assert ev.kind == progress.PROGRESS
+    assert ev.frame == 10
+    assert ev.bitrate is None and ev.out_time is None
+
+
+def test_tail_example_stats_file():
+    tail = progress.ProgressTail(EXAMPLE)
+    events = tail.read()
+    assert len(events) == 3
+    last = events[-1]
+    assert last.kind == progress.END
+    assert last.bitrate == 749.3
+    assert last.speed == 0.629
+    assert last.out_time == 3825.92
+    assert last.total_size == 358328290
+    assert tail.read() == []
+
+
+def test_tail_only_reads_new_blocks(tmp_path):
+    stats = tmp_path / "stats"
+    stats.write_text("frame=1\nprogress=continue\nframe=2\nprog")
+    tail = progress.ProgressTail(str(stats))
+    assert [e.frame for e in tail.read()] == [1]
+    with open(stats, "a") as fp:
+        fp.write("ress=continue\n")
+    assert [e.frame for e in tail.read()] == [2]
+
+
+def test_progressEvents_ends(tmp_path):
+    stats = tmp_path / "stats"
+    stats.write_text("frame=1\nprogress=continue\nframe=2\nprogress=end\n")
+    events = list(progress.progressEvents(str(stats), interval=0))
+    assert [e.kind for e in events] == [progress.PROGRESS, progress.END]
+    assert events[-1].finished
+
+
+def test_progressEvents_detects_exit(tmp_path):
+    stats = tmp_path / "stats"
+    stats.write_text("frame=1\nprogress=continue\n")
+    events = list(progress.progressEvents(str(stats), alive=lambda: False, interval=0))
+    assert events[-1].kind == progress.EXITED
+
+
+def test_progressEvents_detects_stall(tmp_path):
+    stats = tmp_path / "stats"
+    stats.write_text("frame=1\nprogress=continue\n")
+    events = list(
+        progress.progressEvents(str(stats), alive=lambda: True, interval=0, stall=0)
+    )
+    assert events[-1].kind == progress.STALLED
+
+
+def test_progressEvents_no_stats_file(tmp_path):
+    events = list(
+        progress.progressEvents(str(tmp_path / "none"), alive=lambda: True, startup=-1)
+    )
+    assert events == [progress.ProgressEvent(kind=progress.NOSTATS)]
+
+
+def test_watch_leaves_the_waiting_to_the_caller(tmp_path):
+    stats = tmp_path / "stats"
+    watch = progress.ProgressWatch(str(stats), alive=lambda: True, interval=5)
+    # a short wait whilst ffmpeg starts up
+    assert watch.poll() == ([], 1)
+    stats.write_text("frame=1\nprogress=continue\n")
+    events, wait = watch.poll()
+    assert [e.kind for e in events] == [progress.PROGRESS] and wait == 5
+    assert watch.poll() == ([], 5)
+    with open(stats, "a") as fp:
+        fp.write("frame=2\nprogress=end\nframe=3\nprogress=continue\n")
+    events, wait = watch.poll()
+    assert [e.kind for e in events] == [progress.END] and wait is None
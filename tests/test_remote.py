@@ -0,0 +1,124 @@
+import configparser
+import sys
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from tstomkv import remote
+from tstomkv.stages import CopyError
+from tstomkv.workers import LocalWorker, jobName
+
+# stands in for ffmpeg: copies src to dst, writing -progress blocks
+FAKEFFMPEG = """
+import shutil, sys, time
+src, dst, stats = sys.argv[1:4]
+with open(stats, "w") as fp:
+    for n in range(3):
+        fp.write(f"out_time_us={n * 1000000}\\nprogress=continue\\n")
+        fp.flush()
+        time.sleep(0.05)
+    shutil.copyfile(src, dst)
+    fp.write("out_time_us=3000000\\nprogress=end\\n")
+"""
+
+
+def fakeCommand(script):
+    def command(src, dst, stats, x265params=None, profile=None):
+        return [sys.executable, "-c", script, src, dst, stats]
+
+    return command
+
+
+def config(text):
+    cfg = configparser.ConfigParser()
+    cfg.read_string(text)
+    return cfg
+
+
+def test_encodeMode():
+    assert remote.encodeMode(config(""), "box") == "local"
+    cfg = config("[mediaserver]\nencode = remote\n[host:desk]\nencode = local\n")
+    assert remote.encodeMode(cfg, "box") == "remote"
+    assert remote.encodeMode(cfg, "desk") == "local"
+    assert remote.encodeMode(cfg, "desk.lan") == "local"
+    with pytest.raises(remote.RemoteEncodeError):
+        remote.encodeMode(config("[host:box]\nencode = maybe\n"), "box")
+
+
+@pytest.fixture
+def server(tmp_path):
+    return LocalWorker("mediaserver", "local", workdir=str(tmp_path / "work"))
+
+
+@pytest.fixture
+def recording(tmp_path):
+    src = tmp_path / "rec.ts"
+    src.write_bytes(b"transport stream")
+    return src
+
+
+def fpsFor(src):
+    return {"src": src, "srcmkv": src.with_suffix(".mkv")}
+
+
+def runStage(src, server, duration=3, verify=None):
+    finfo = {"format": {"duration": str(duration)}, "streams": []}
+    with (
+        mock.patch("tstomkv.remote.pathManipulation", return_value=fpsFor(src)),
+        mock.patch("tstomkv.remote.remoteFileInfo", return_value=finfo),
+        mock.patch("tstomkv.remote.transcodeCommand", fakeCommand(FAKEFFMPEG)),
+    ):
+        job = {"src": str(src), "replace": str(src.parent), "tvh": False}
+        return remote.remoteEncodeStage(
+            job, worker=server, heartbeat=0.05, verify=verify
+        )
+
+
+def remoteMkv(src):
+    return Path(jobName(src)).with_suffix(".mkv").name
+
+
+def test_remoteEncodeStage_leaves_mkv_in_workdir(recording, server):
+    job = runStage(recording, server)
+    assert job["remotemkv"] == server.path(remoteMkv(recording))
+    assert Path(job["remotemkv"]).read_bytes() == b"transport stream"
+    names = [p.name for p in Path(server.workdir).iterdir()]
+    assert names == [remoteMkv(recording)]
+
+
+def test_remoteEncodeStage_keeps_same_named_recordings_apart(tmp_path, server):
+    jobs = []
+    for n in range(2):
+        (tmp_path / f"d{n}").mkdir()
+        src = tmp_path / f"d{n}" / "rec.ts"
+        src.write_bytes(f"recording {n}".encode())
+        jobs.append(runStage(src, server))
+    assert jobs[0]["remotemkv"] != jobs[1]["remotemkv"]
+    for n, job in enumerate(jobs):
+        assert Path(job["remotemkv"]).read_bytes() == f"recording {n}".encode()
+
+
+def test_remoteEncodeStage_fails_the_duration_check(recording, server):
+    with mock.patch("tstomkv.remote.remoteDuration", return_value=False):
+        with pytest.raises(CopyError):
+            runStage(recording, server)
+    assert not Path(server.path(remoteMkv(recording))).exists()
+
+
+def test_remoteEncodeStage_runs_the_sampled_checks_there(recording, server):
+    verify = {"windows": 2, "length": 1}
+    report = {"ok": False, "problems": ["no audio stream in the output"]}
+    with mock.patch("tstomkv.remote.verifyOutput", return_value=report) as vo:
+        with pytest.raises(CopyError):
+            runStage(recording, server, verify=verify)
+    args, kwargs = vo.call_args
+    assert args == (str(recording), server.path(remoteMkv(recording)))
+    assert kwargs["run"] == server.execute and kwargs["windows"] == 2
+    assert not Path(server.path(remoteMkv(recording))).exists()
+
+
+def test_followRemote_raises_when_ffmpeg_exits(tmp_path, server):
+    pid = server.start([sys.executable, "-c", "pass"], server.path("log"))
+    with pytest.raises(remote.RemoteEncodeError):
+        remote.followRemote(server, pid, server.path("none.stats"), 3, heartbeat=0.05)
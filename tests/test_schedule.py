@@ -0,0 +1,93 @@
+import configparser
+from unittest import mock
+
+from tstomkv import schedule
+
+
+def job(title, size, duration=3600, channel="BBC One", recorded=0, codec=None):
+    j = {
+        "src": f"/r/{title}.ts",
+        "rec": {
+            "title": title,
+            "filesize": size,
+            "duration": duration,
+            "channelname": channel,
+            "start_real": recorded,
+        },
+    }
+    if codec is not None:
+        j["srcinfo"] = {"streams": [{"codec_type": "video", "codec_name": codec}]}
+    return j
+
+
+def test_heightClass():
+    assert schedule.heightClass(None) == 576
+    assert schedule.heightClass(540) == 576
+    assert schedule.heightClass(1080) == 1080
+    assert schedule.heightClass(4320) == 2160
+
+
+def test_estimate():
+    saved, cpu = schedule.estimate(job("a", 3_000_000_000))
+    assert saved == 3_000_000_000 - 200_000 * 3600
+    assert cpu == 6.0 * 3600
+    # hd channels cost more to encode
+    assert schedule.estimate(job("a", 3_000_000_000, channel="BBC One HD"))[1] > cpu
+    # hevc is only remuxed
+    assert schedule.estimate(job("a", 3_000_000_000, codec="hevc"))[0] == 0
+    # history beats the built in rates
+    history = {576: (100_000, 3.0)}
+    assert schedule.estimate(job("a", 3_000_000_000), history)[1] == 3.0 * 3600
+
+
+def test_scheduleJobs_biggest_saving_first():
+    jobs = [job("small", 500_000_000), job("big", 6_000_000_000, 7200)]
+    assert [j["rec"]["title"] for j in schedule.scheduleJobs(jobs)] == [
+        "big",
+        "small",
+    ]
+
+
+def test_scheduleJobs_pins_deadlines_and_priorities():
+    cfg = configparser.ConfigParser()
+    cfg.read_string(
+        "[title:Pinned]\npin = yes\n"
+        "[title:Urgent]\ndeadline = 2\n"
+        "[title:Favourite]\npriority = 100\n"
+    )
+    day = 86400
+    jobs = [
+        job("big", 6_000_000_000),
+        job("Favourite", 1_500_000_000),
+        job("Urgent", 500_000_000, recorded=10 * day),
+        job("pinned", 100_000_000),
+    ]
+    order = schedule.scheduleJobs(jobs, cfg, now=11.5 * day)
+    titles = [j["rec"]["title"] for j in order]
+    assert titles == ["pinned", "Urgent", "Favourite", "big"]
+    # a deadline that is still a long way off doesn't jump the queue
+    order = schedule.scheduleJobs(jobs, cfg, now=10 * day)
+    assert [j["rec"]["title"] for j in order][1] != "Urgent"
+
+
+def test_probeJobs_scores_jobs_fetched_later_by_codec():
+    hevc = {"streams": [{"codec_type": "video", "codec_name": "hevc", "height": 1080}]}
+    mpeg2 = {"streams": [{"codec_type": "video", "codec_name": "mpeg2video"}]}
+    probes = {"/r/remux.ts": hevc, "/r/encode.ts": mpeg2}
+    probe = mock.Mock(side_effect=lambda src: probes[src])
+    jobs = [job("remux", 3_000_000_000), job("encode", 3_000_000_000)]
+    assert "srcinfo" not in jobs[0]
+    order = schedule.scheduleJobs(schedule.probeJobs(jobs, probe=probe))
+    assert [j["rec"]["title"] for j in order] == ["encode", "remux"]
+    assert order[1]["srcinfo"] == hevc
+    # the probes are cached, the next run doesn't probe again
+    probe.reset_mock()
+    schedule.probeJobs([job("remux", 3_000_000_000)], probe=probe)
+    probe.assert_not_called()
+
+
+def test_probeJobs_keeps_to_its_limit():
+    probe = mock.Mock(return_value=None)
+    jobs = [job(str(n), 1_000_000_000) for n in range(3)]
+    schedule.probeJobs(jobs, limit=2, probe=probe)
+    assert probe.call_count == 2
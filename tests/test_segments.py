@@ -0,0 +1,129 @@
+from pathlib import Path
+from unittest import mock
+
+import json
+import shutil
+import subprocess
+
+import pytest
+
+from tstomkv import segments
+
+
+def test_segmentSeconds():
+    assert segments.segmentSeconds(10800, 8) == 1350
+    assert segments.segmentSeconds(0.5, 4) == 1
+
+
+def test_segmentCommand_profile():
+    profile = {"preset": "slow", "crf": "22"}
+    cmd = segments.segmentCommand("s.ts", "s.mkv", "pools=2", profile)
+    assert cmd[cmd.index("-preset") + 1] == "slow"
+    assert cmd[cmd.index("-crf") + 1] == "22"
+    assert cmd[cmd.index("-x265-params") + 1] == "pools=2"
+    assert cmd[-1] == "s.mkv"
+
+
+def test_audioCommand_copies_aac():
+    cmd = segments.audioCommand("a.ts", "a.mkv", {"copyaudio": True})
+    assert cmd[cmd.index("-c:a") + 1] == "copy"
+    assert "-vn" in cmd and "0:s?" in cmd
+
+
+def test_writeConcatList_escapes_quotes(tmp_path):
+    listfile = tmp_path / "list.txt"
+    segments.writeConcatList(str(listfile), ["/a/seg0.mkv", "/b/it's.mkv"])
+    assert listfile.read_text() == "file '/a/seg0.mkv'\nfile '/b/it'\\''s.mkv'\n"
+
+
+def fakeffmpeg(cmd, canfail=False):
+    """makes the files the ffmpeg commands would"""
+    if "segment" in cmd:
+        segdir = Path(cmd[-1]).parent
+        for n in range(3):
+            (segdir / f"seg{n:04d}.ts").write_bytes(b"ts")
+    else:
+        Path(cmd[-1]).write_bytes(b"mkv")
+    return ("", "")
+
+
+def test_segmentedEncode(tmp_path):
+    dst = tmp_path / "out.mkv"
+    with mock.patch("tstomkv.segments.shellCommand", side_effect=fakeffmpeg) as sc:
+        assert segments.segmentedEncode("in.ts", str(dst), 9000, segments=3)
+    cmds = [c.args[0] for c in sc.call_args_list]
+    # split, audio, three segments then the join
+    assert len(cmds) == 6
+    assert "segment" in cmds[0]
+    assert "concat" in cmds[-1]
+    assert dst.exists()
+    assert not (tmp_path / "out.mkv.segments").exists()
+
+
+def test_segmentedEncode_no_segments(tmp_path):
+    dst = tmp_path / "out.mkv"
+    with mock.patch("tstomkv.segments.shellCommand", return_value=("", "")):
+        with pytest.raises(segments.SegmentError):
+            segments.segmentedEncode("in.ts", str(dst), 9000)
+
+
+def test_videoOffset():
+    finfo = {
+        "format": {"start_time": "1.400000"},
+        "streams": [
+            {"codec_type": "audio", "start_time": "1.400000"},
+            {"codec_type": "video", "start_time": "1.880000"},
+        ],
+    }
+    assert segments.videoOffset(finfo) == pytest.approx(0.48)
+    assert segments.videoOffset(None) == 0.0
+    assert segments.videoOffset({"streams": [{"codec_type": "video"}]}) == 0.0
+
+
+def test_segmentedEncode_keeps_the_video_start(tmp_path):
+    dst = tmp_path / "out.mkv"
+    srcinfo = {
+        "format": {"start_time": "1.4"},
+        "streams": [{"codec_type": "video", "start_time": "2.0"}],
+    }
+    with mock.patch("tstomkv.segments.shellCommand", side_effect=fakeffmpeg) as sc:
+        segments.segmentedEncode(
+            "in.ts", str(dst), 9000, segments=3, srcinfo=srcinfo
+        )
+    join = sc.call_args_list[-1].args[0]
+    assert "-copyts" in join
+    offset = join.index("-itsoffset")
+    assert float(join[offset + 1]) == pytest.approx(0.6)
+    # the offset applies to the joined video, not the audio
+    assert join[offset + 2 : offset + 4] == ["-f", "concat"]  # noqa: E203
+
+
+def startTimes(fn):
+    out = subprocess.run(
+        ["ffprobe", "-v", "error", "-of", "json", "-show_streams", str(fn)],
+        capture_output=True,
+        check=True,
+    ).stdout
+    return {
+        s["codec_type"]: float(s["start_time"]) for s in json.loads(out)["streams"]
+    }
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+def test_segmentedEncode_keeps_the_av_offset(tmp_path):
+    src = tmp_path / "in.ts"
+    # audio starting a second after the video, as in a dvb recording
+    subprocess.run(
+        ["ffmpeg", "-loglevel", "error", "-f", "lavfi", "-i"]
+        + ["testsrc=duration=6:size=320x240:rate=25"]
+        + ["-itsoffset", "1", "-f", "lavfi", "-i", "sine=duration=5"]
+        + ["-c:v", "mpeg2video", "-g", "25", "-c:a", "mp2", str(src)],
+        check=True,
+    )
+    before = startTimes(src)
+    dst = tmp_path / "out.mkv"
+    assert segments.segmentedEncode(str(src), str(dst), 6, segments=3)
+    after = startTimes(dst)
+    assert after["audio"] - after["video"] == pytest.approx(
+        before["audio"] - before["video"], abs=0.05
+    )
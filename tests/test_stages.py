@@ -0,0 +1,298 @@
+import threading
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+from tstomkv import stages, workers
+from tstomkv.progress import END, STALLED, ProgressEvent
+
+
+def test_humanTime():
+    assert stages.humanTime(5) == "5s"
+    assert stages.humanTime(65) == "1m 5s"
+    assert stages.humanTime(3725) == "1h 2m 5s"
+
+
+def test_kodiJob():
+    cfg = {"mediaserver": {"koditvdir": "/tv", "kodifilmdir": "/films"}}
+    assert stages.kodiJob("/tv/a.ts", cfg)["replace"] == "/tv"
+    assert stages.kodiJob("/films/b.ts", cfg)["replace"] == "/films"
+    assert stages.kodiJob("/other/c.ts", cfg) is None
+
+
+def test_tvhJob():
+    job = stages.tvhJob({"filename": "/var/lib/tvheadend/a.ts"})
+    assert job["tvh"] is True
+    assert job["replace"] == "/var/lib/tvheadend"
+    assert stages.tvhJob({"filename": "/var/lib/tvheadend/a.mkv"}) is None
+
+
+def test_fetchStage_raises_on_copy_failure():
+    fps = {"src": Path("/r/a.ts"), "dest": Path("/l/a.ts")}
+    with (
+        mock.patch("tstomkv.stages.pathManipulation", return_value=fps),
+        mock.patch("tstomkv.stages.getFile", return_value=False),
+    ):
+        with pytest.raises(stages.CopyError):
+            stages.fetchStage({"src": "/r/a.ts", "replace": "/r"})
+
+
+def test_uploadStage_tells_tvh_and_removes_source():
+    fps = {
+        "src": Path("/r/a.ts"),
+        "srcmkv": Path("/r/a.mkv"),
+        "destmkv": Path("/l/a.mkv"),
+    }
+    with (
+        mock.patch("tstomkv.stages.sendFile", return_value=True),
+        mock.patch("tstomkv.stages.fileMoved") as moved,
+        mock.patch("tstomkv.stages.remoteCommand", return_value="removed") as rcmd,
+    ):
+        stages.uploadStage({"fps": fps, "tvh": True})
+        moved.assert_called_with("/r/a.ts", "/r/a.mkv")
+        rcmd.assert_called_with(
+            'rm -f "/r/a.ts" && test ! -e "/r/a.ts" && echo removed',
+            banner=True,
+            retry=False,
+        )
+
+
+def test_uploadStage_keeps_source_on_send_failure():
+    fps = {
+        "src": Path("/r/a.ts"),
+        "srcmkv": Path("/r/a.mkv"),
+        "destmkv": Path("/l/a.mkv"),
+    }
+    with (
+        mock.patch("tstomkv.stages.sendFile", return_value=False),
+        mock.patch("tstomkv.stages.remoteCommand") as rcmd,
+    ):
+        with pytest.raises(stages.CopyError):
+            stages.uploadStage({"fps": fps, "tvh": False})
+        rcmd.assert_not_called()
+
+
+def test_fetchStage_streaminput_skips_copy():
+    fps = {"src": Path("/r/a.ts"), "dest": Path("/l/a.ts")}
+    with (
+        mock.patch("tstomkv.stages.pathManipulation", return_value=fps),
+        mock.patch("tstomkv.stages.getFile") as gf,
+        mock.patch("tstomkv.stages.remoteFileInfo", return_value={"streams": []}),
+    ):
+        job = stages.fetchStage({"src": "/r/a.ts", "replace": "/r"}, streaminput=True)
+        gf.assert_not_called()
+        assert job["streaminput"] is True
+
+
+def test_sourceDetails_falls_back_to_recording_duration():
+    job = {
+        "fps": {"dest": Path("/l/a.ts")},
+        "streaminput": True,
+        "srcinfo": None,
+        "rec": {"duration": 3600},
+    }
+    assert stages.sourceDetails(job) == (3600, None)
+
+
+def test_fetchStage_skips_completed_fetch(tmp_path):
+    dest = tmp_path / "a.ts"
+    dest.write_text("x")
+    fps = {"src": Path("/r/a.ts"), "dest": dest, "destmkv": tmp_path / "a.mkv"}
+    ledger = mock.Mock()
+    ledger.reached.side_effect = lambda src, state: state == "fetched"
+    with (
+        mock.patch("tstomkv.stages.pathManipulation", return_value=fps),
+        mock.patch("tstomkv.stages.getFile") as gf,
+    ):
+        stages.fetchStage({"src": "/r/a.ts", "replace": "/r", "ledger": ledger})
+        gf.assert_not_called()
+
+
+def test_uploadStage_records_progress():
+    fps = {
+        "src": Path("/r/a.ts"),
+        "srcmkv": Path("/r/a.mkv"),
+        "destmkv": Path("/l/a.mkv"),
+    }
+    ledger = mock.Mock()
+    with (
+        mock.patch("tstomkv.stages.sendFile", return_value=True),
+        mock.patch("tstomkv.stages.remoteCommand", return_value="removed"),
+    ):
+        stages.uploadStage(
+            {"src": "/r/a.ts", "fps": fps, "tvh": False, "ledger": ledger}
+        )
+    ledger.advance.assert_has_calls(
+        [mock.call("/r/a.ts", "uploaded"), mock.call("/r/a.ts", "removed")]
+    )
+
+
+def test_uploadStage_removes_staged_files(tmp_path):
+    fps = {
+        "src": Path("/r/a.ts"),
+        "srcmkv": Path("/r/a.mkv"),
+        "dest": tmp_path / "a.ts",
+        "destmkv": tmp_path / "a.mkv",
+    }
+    fps["dest"].write_bytes(b"ts")
+    fps["destmkv"].write_bytes(b"mkv")
+    budget = mock.Mock()
+    job = {"src": "/r/a.ts", "fps": fps, "tvh": False}
+    with (
+        mock.patch("tstomkv.stages.sendFile", return_value=True),
+        mock.patch("tstomkv.stages.remoteCommand", return_value="removed"),
+    ):
+        stages.uploadStage(job, staging=budget)
+    assert list(tmp_path.iterdir()) == []
+    budget.release.assert_called_with(job)
+
+
+def test_uploadStage_moves_a_remote_encode_into_place():
+    fps = {"src": Path("/r/a.ts"), "srcmkv": Path("/r/a.mkv")}
+    job = {"src": "/r/a.ts", "fps": fps, "tvh": False, "remotemkv": "/w/a.mkv"}
+    with (
+        mock.patch("tstomkv.stages.sendFile") as sf,
+        mock.patch(
+            "tstomkv.stages.remoteCommand", side_effect=["moved", "removed"]
+        ) as rcmd,
+    ):
+        stages.uploadStage(job)
+    sf.assert_not_called()
+    assert rcmd.call_args_list[0].args[0].startswith('mv "/w/a.mkv" "/r/a.mkv"')
+
+
+def test_encodeFinish_aborts_upload_when_a_check_raises(tmp_path):
+    fps = {
+        "src": Path("/r/a.ts"),
+        "dest": tmp_path / "a.ts",
+        "destmkv": tmp_path / "a.mkv",
+    }
+    plan = {"duration": 60, "finfo": None, "copyvideo": False, "mode": "file"}
+    upload = mock.Mock()
+    with mock.patch("tstomkv.stages.checkDuration", side_effect=OSError("gone")):
+        with pytest.raises(OSError):
+            stages.encodeFinish({"src": "/r/a.ts", "fps": fps}, plan, upload=upload)
+    upload.abort.assert_called_once()
+    upload.commit.assert_not_called()
+
+
+class HungFfmpeg:
+    """a Popen stand in that only exits when it is terminated"""
+
+    def __init__(self):
+        self.exited = threading.Event()
+        self.terminated = False
+
+    def poll(self):
+        return 0 if self.exited.is_set() else None
+
+    def terminate(self):
+        self.terminated = True
+        self.exited.set()
+
+    def wait(self, timeout=None):
+        self.exited.wait(timeout)
+
+
+def test_encodeStage_stops_a_stalled_ffmpeg(tmp_path):
+    fps = {
+        "src": Path("/r/a.ts"),
+        "dest": tmp_path / "a.ts",
+        "destmkv": tmp_path / "a.mkv",
+    }
+    proc = HungFfmpeg()
+
+    def encode(src, dst, statsfile, started=None):
+        started(proc)
+        proc.wait()
+
+    plan = {
+        "mode": "file",
+        "target": encode,
+        "args": ("a.ts", "a.mkv", "a.stats"),
+        "kwargs": {},
+        "threads": None,
+        "statsfile": str(tmp_path / "a.stats"),
+        "duration": 60,
+    }
+    stalled = ProgressEvent(kind=STALLED)
+    with (
+        mock.patch("tstomkv.stages.encodePlan", return_value=plan),
+        mock.patch("tstomkv.stages.doStats", return_value=stalled),
+    ):
+        with pytest.raises(stages.CopyError):
+            stages.encodeStage({"src": "/r/a.ts", "fps": fps})
+    assert proc.terminated
+
+
+def quickPlan(tmp_path, mode, target):
+    return {
+        "mode": mode,
+        "target": target,
+        "args": ("a.ts", "a.mkv", "a.stats"),
+        "kwargs": {},
+        "threads": None,
+        "statsfile": str(tmp_path / "a.stats"),
+        "duration": 60,
+    }
+
+
+def test_encodeStage_raises_what_the_encode_raised(tmp_path):
+    fps = {"src": Path("/r/a.ts"), "dest": tmp_path / "a.ts"}
+    fps["destmkv"] = tmp_path / "a.mkv"
+
+    def encode(*args, **kwargs):
+        raise workers.WorkerError("a.ts failed on workers w0, w1")
+
+    plan = quickPlan(tmp_path, "remote", encode)
+    with (
+        mock.patch("tstomkv.stages.encodePlan", return_value=plan),
+        mock.patch("tstomkv.stages.encodeFinish") as finish,
+    ):
+        with pytest.raises(workers.WorkerError):
+            stages.encodeStage({"src": "/r/a.ts", "fps": fps})
+    finish.assert_not_called()
+
+
+def test_encodeStage_raises_when_ffmpeg_fails(tmp_path):
+    fps = {"src": Path("/r/a.ts"), "dest": tmp_path / "a.ts"}
+    fps["destmkv"] = tmp_path / "a.mkv"
+    plan = quickPlan(tmp_path, "file", lambda *args, **kwargs: False)
+    with (
+        mock.patch("tstomkv.stages.encodePlan", return_value=plan),
+        mock.patch("tstomkv.stages.doStats", return_value=ProgressEvent(kind=END)),
+        mock.patch("tstomkv.stages.encodeFinish") as finish,
+    ):
+        with pytest.raises(stages.CopyError, match="ffmpeg failed"):
+            stages.encodeStage({"src": "/r/a.ts", "fps": fps})
+    finish.assert_not_called()
+
+
+def test_uploadStage_move_is_not_repeated():
+    fps = {"src": Path("/r/a.ts"), "srcmkv": Path("/r/a.mkv")}
+    job = {"src": "/r/a.ts", "fps": fps, "tvh": False, "remotemkv": "/w/a.mkv"}
+    with mock.patch(
+        "tstomkv.stages.remoteCommand", side_effect=["moved", "removed"]
+    ) as rcmd:
+        stages.uploadStage(job)
+    mv = rcmd.call_args_list[0]
+    assert mv.kwargs["retry"] is False
+    # a move that was done before the connection dropped still counts
+    assert 'test ! -e "/w/a.mkv" && test -e "/r/a.mkv"' in mv.args[0]
+
+
+def test_uploadStage_keeps_state_when_the_delete_fails():
+    fps = {"src": Path("/r/a.ts"), "srcmkv": Path("/r/a.mkv")}
+    fps["destmkv"] = Path("/l/a.mkv")
+    ledger = mock.Mock()
+    with (
+        mock.patch("tstomkv.stages.sendFile", return_value=True),
+        # remoteCommand gives "" when the command fails
+        mock.patch("tstomkv.stages.remoteCommand", return_value=""),
+    ):
+        with pytest.raises(stages.CopyError, match="Failed to remove /r/a.ts"):
+            stages.uploadStage(
+                {"src": "/r/a.ts", "fps": fps, "tvh": False, "ledger": ledger}
+            )
+    ledger.advance.assert_called_once_with("/r/a.ts", "uploaded")
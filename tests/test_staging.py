@@ -0,0 +1,106 @@
+import threading
+import time
+from collections import namedtuple
+from unittest import mock
+
+import pytest
+
+from tstomkv import staging
+
+Usage = namedtuple("Usage", "total used free")
+
+GB = 1024**3
+
+
+def makeJob(tmp_path, name, size=GB):
+    return {
+        "src": f"/r/{name}.ts",
+        "filesize": size,
+        "fps": {"dest": tmp_path / f"{name}.ts", "destmkv": tmp_path / f"{name}.mkv"},
+    }
+
+
+def test_parseSize():
+    assert staging.parseSize("500M") == 500 * 1024**2
+    assert staging.parseSize("1.5g") == int(1.5 * GB)
+    assert staging.parseSize("20GB") == 20 * GB
+    assert staging.parseSize("4096") == 4096
+    assert staging.parseSize("0") is None
+    assert staging.parseSize(None) is None
+    with pytest.raises(ValueError):
+        staging.parseSize("lots")
+
+
+def test_stagingNeed(tmp_path):
+    job = makeJob(tmp_path, "a")
+    assert staging.stagingNeed(job) == 2 * GB
+    assert staging.stagingNeed(job, streaminput=True) == GB
+    job = {"src": "/r/b.ts"}
+    with mock.patch("tstomkv.staging.remoteCommand", return_value="1000"):
+        assert staging.stagingNeed(job) == 2000
+    with mock.patch("tstomkv.staging.remoteCommand", return_value=None):
+        assert staging.stagingNeed(job) == 0
+
+
+def test_removeStaged(tmp_path):
+    job = makeJob(tmp_path, "a")
+    (tmp_path / "a.ts").write_bytes(b"x" * 10)
+    (tmp_path / "a.mkv").write_bytes(b"x" * 5)
+    (tmp_path / "a.ts-transcode.stats").write_bytes(b"x")
+    (tmp_path / "a.mkv.segments").mkdir()
+    (tmp_path / "b.ts").write_bytes(b"x")
+    assert staging.removeStaged(job) == 16
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["b.ts"]
+
+
+def test_admit_within_space(tmp_path):
+    budget = staging.StagingBudget(str(tmp_path), reserve=GB)
+    with mock.patch("shutil.disk_usage", return_value=Usage(0, 0, 10 * GB)):
+        budget.admit(makeJob(tmp_path, "a"), 2 * GB)
+        budget.admit(makeJob(tmp_path, "b"), 2 * GB)
+    assert budget.reserved() == 4 * GB
+
+
+def test_admit_raises_when_it_can_never_fit(tmp_path):
+    budget = staging.StagingBudget(str(tmp_path), reserve=GB)
+    with mock.patch("shutil.disk_usage", return_value=Usage(0, 0, 2 * GB)):
+        with pytest.raises(staging.StagingError):
+            budget.admit(makeJob(tmp_path, "a"), 2 * GB)
+
+
+def test_admit_over_the_cap_when_nothing_is_in_flight(tmp_path):
+    budget = staging.StagingBudget(str(tmp_path), maxbytes=GB, reserve=0)
+    with mock.patch("shutil.disk_usage", return_value=Usage(0, 0, 10 * GB)):
+        budget.admit(makeJob(tmp_path, "a"), 2 * GB)
+    assert budget.reserved() == 2 * GB
+
+
+def test_admit_waits_for_release(tmp_path):
+    budget = staging.StagingBudget(str(tmp_path), maxbytes=3 * GB, reserve=0, poll=5)
+    first, second = makeJob(tmp_path, "a"), makeJob(tmp_path, "b")
+    admitted = threading.Event()
+    with mock.patch("shutil.disk_usage", return_value=Usage(0, 0, 10 * GB)):
+        budget.admit(first, 2 * GB)
+
+        def admitSecond():
+            budget.admit(second, 2 * GB)
+            admitted.set()
+
+        t = threading.Thread(target=admitSecond)
+        t.start()
+        time.sleep(0.2)
+        assert not admitted.is_set()
+        budget.stageFailed(first, "encode", 0, 1, Exception("boom"))
+        assert admitted.wait(timeout=2)
+        t.join()
+    assert list(budget.inflight) == ["/r/b.ts"]
+
+
+def test_outstanding_counts_unwritten_bytes(tmp_path):
+    budget = staging.StagingBudget(str(tmp_path), reserve=0)
+    job = makeJob(tmp_path, "a", size=100)
+    with mock.patch("shutil.disk_usage", return_value=Usage(0, 0, 1000)):
+        budget.admit(job, 200)
+    assert budget.outstanding() == 200
+    (tmp_path / "a.ts").write_bytes(b"x" * 100)
+    assert budget.outstanding() == 100
@@ -0,0 +1,81 @@
+import hashlib
+import os
+from contextlib import contextmanager
+from unittest import mock
+
+import pytest
+
+from tstomkv import transfer
+from tstomkv.bench import LoopbackSFTP
+
+
+@pytest.fixture
+def fakesftp():
+    sftp = LoopbackSFTP()
+
+    @contextmanager
+    def opensftp(*args):
+        yield sftp
+
+    with (
+        mock.patch("tstomkv.transfer.mediaServer", return_value=("h", "u", "k")),
+        mock.patch("tstomkv.transfer.pool") as mpool,
+        mock.patch("tstomkv.transfer.BLOCKSIZE", 3),
+        mock.patch("tstomkv.transfer.WINDOW", 2),
+    ):
+        mpool.sftp.side_effect = opensftp
+        yield sftp
+
+
+def test_chunkList():
+    assert transfer.chunkList(10, 4) == [(0, 4), (4, 4), (8, 2)]
+    assert transfer.chunkList(0, 4) == []
+
+
+@pytest.mark.parametrize("direction", ["get", "put"])
+def test_transfer_copies_and_digests(tmp_path, fakesftp, direction):
+    data = os.urandom(1000)
+    src = tmp_path / "src.ts"
+    src.write_bytes(data)
+    dst = tmp_path / "dst.ts"
+    xfer = transfer.ChunkedTransfer(
+        str(src), str(dst), direction=direction, channels=3, chunksize=64
+    )
+    digest = xfer.run()
+    assert dst.read_bytes() == data
+    expected = [
+        hashlib.sha256(data[off : off + n]).hexdigest()  # noqa: E203
+        for off, n in transfer.chunkList(1000, 64)
+    ]
+    assert xfer.digests == expected
+    assert digest == transfer.fileDigest(expected)
+    assert not (tmp_path / "dst.ts.partial").exists()
+    assert not os.path.exists(xfer._manifestPath())
+
+
+def test_transfer_resumes_from_manifest(tmp_path, fakesftp):
+    data = os.urandom(300)
+    src = tmp_path / "src.ts"
+    src.write_bytes(data)
+    dst = tmp_path / "dst.ts"
+    fakesftp.failon = 3  # the link drops whilst opening the third chunk
+    xfer = transfer.ChunkedTransfer(str(src), str(dst), channels=1, chunksize=100)
+    with pytest.raises(transfer.TransferError):
+        xfer.run()
+    assert not dst.exists()
+    fakesftp.failon = None
+    fakesftp.opens = 0
+    xfer = transfer.ChunkedTransfer(str(src), str(dst), channels=1, chunksize=100)
+    xfer.run()
+    assert dst.read_bytes() == data
+    # only the one chunk left needed opening
+    assert fakesftp.opens == 1
+
+
+def test_transferFile_verify_mismatch(tmp_path, fakesftp):
+    src = tmp_path / "src.ts"
+    src.write_bytes(b"abc")
+    with mock.patch("tstomkv.transfer.remoteChunkDigests", return_value=["nope"]):
+        assert (
+            transfer.transferFile(str(src), str(tmp_path / "d"), verify=True) is False
+        )
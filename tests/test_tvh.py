@@ -1,5 +1,9 @@
+import json
 from unittest import mock
 
+import pytest
+import requests
+
 from tstomkv import tvh
 
 # def test_sendToTvh_success():
@@ -30,26 +34,59 @@ from tstomkv import tvh
 #             en.assert_called()
 
 
-def test_sendToTvh_json_decode_error():
-    cfg = {"DEFAULT": {"tvhuser": "user", "tvhpass": "pass", "tvhipaddr": "127.0.0.1"}}
-    with (
-        mock.patch("tstomkv.config.readConfig", return_value=cfg),
-        mock.patch("requests.get") as mget,
-    ):
-        mget.return_value = mock.Mock(
-            status_code=200,
-            text="bad\x19json",
-            json=mock.Mock(side_effect=Exception("fail")),
-        )
-        with mock.patch("json.loads", return_value={"fixed": True}):
-            result = tvh.sendToTvh("route")
-            assert result == {"fixed": True}
+def response(status=200, payload=None, text=None):
+    text = json.dumps(payload) if text is None else text
+    return mock.Mock(status_code=status, text=text)
+
+
+def client(*responses):
+    tc = tvh.TvhClient("127.0.0.1", "user", "pass", backoff=0, pagesize=2)
+    tc.session = mock.Mock()
+    tc.session.get.side_effect = list(responses)
+    return tc
+
+
+def test_TvhClient_sanitizes_control_characters():
+    tc = client(response(text='{"title": "bad\x19json"}'))
+    assert tc.get("route") == {"title": "bad json"}
+
+
+def test_TvhClient_retries_with_backoff():
+    tc = client(
+        requests.ConnectionError("reset"),
+        response(status=503, text=""),
+        response(payload={"ok": True}),
+    )
+    assert tc.get("route", {"a": 1}) == {"ok": True}
+    assert tc.session.get.call_count == 3
+    tc.session.get.assert_called_with(
+        "http://127.0.0.1/api/route", params={"a": 1}, timeout=60
+    )
+
+
+def test_TvhClient_gives_up():
+    tc = client(*[requests.Timeout("slow")] * 4)
+    with pytest.raises(requests.Timeout):
+        tc.get("route")
+    tc = client(response(status=403, text="denied"))
+    with pytest.raises(tvh.TVHError):
+        tc.get("route")
+
+
+def test_TvhClient_entries_pages():
+    tc = client(
+        response(payload={"entries": [1, 2], "total": 5}),
+        response(payload={"entries": [3, 4], "total": 5}),
+        response(payload={"entries": [5], "total": 5}),
+    )
+    assert list(tc.entries("grid", {"sort": "start"})) == [1, 2, 3, 4, 5]
+    starts = [c.kwargs["params"]["start"] for c in tc.session.get.call_args_list]
+    assert starts == [0, 2, 4]
+    assert tc.session.get.call_args.kwargs["params"]["sort"] == "start"
 
 
 def test_allRecordings_success():
-    with mock.patch(
-        "tstomkv.tvh.sendToTvh", return_value={"entries": [1, 2], "total": 2}
-    ):
+    with mock.patch("tstomkv.tvh.finishedRecordings", return_value=iter([1, 2])):
         entries, total = tvh.allRecordings()
         assert entries == [1, 2]
         assert total == 2
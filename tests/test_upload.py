@@ -0,0 +1,74 @@
+import io
+from unittest import mock
+
+import pytest
+
+from tstomkv import upload
+
+
+class FakeRemoteFile(io.BytesIO):
+    def set_pipelined(self, pipelined):
+        pass
+
+    def close(self):
+        self.final = self.getvalue()
+
+
+@pytest.fixture
+def remote():
+    rfile = FakeRemoteFile()
+    with (
+        mock.patch("tstomkv.upload.mediaServer", return_value=("h", "u", "k")),
+        mock.patch("tstomkv.upload.pool") as mpool,
+    ):
+        sftp = mpool.sftp.return_value.__enter__.return_value
+        sftp.open.return_value.__enter__.return_value = rfile
+        yield sftp, rfile
+
+
+def test_only_whole_blocks_sent_whilst_writing(tmp_path, remote):
+    _, rfile = remote
+    src = tmp_path / "out.mkv"
+    src.write_bytes(b"a" * 10)
+    up = upload.IncrementalUpload(str(src), "/r/out.mkv", blocksize=4, interval=60)
+    up.start()
+    up._sendBlocks()
+    assert up.sent == 8
+    assert rfile.getvalue() == b"a" * 8
+    up.finish()
+    assert rfile.final == b"a" * 10
+
+
+def test_finish_resends_rewritten_blocks(tmp_path, remote):
+    _, rfile = remote
+    src = tmp_path / "out.mkv"
+    src.write_bytes(b"a" * 12)
+    up = upload.IncrementalUpload(str(src), "/r/out.mkv", blocksize=4, interval=60)
+    up.start()
+    up._sendBlocks()
+    # the muxer goes back and rewrites the header, then adds the cues
+    src.write_bytes(b"HEAD" + b"a" * 8 + b"cues")
+    resent = up.finish()
+    assert resent == 4
+    assert rfile.final == b"HEAD" + b"a" * 8 + b"cues"
+
+
+def test_commit_renames_into_place(tmp_path, remote):
+    sftp, _ = remote
+    src = tmp_path / "out.mkv"
+    src.write_bytes(b"abc")
+    up = upload.IncrementalUpload(str(src), "/r/out.mkv", interval=60)
+    up.start()
+    up.finish()
+    up.commit()
+    sftp.open.assert_called_with("/r/out.mkv.partial", "wb")
+    sftp.posix_rename.assert_called_with("/r/out.mkv.partial", "/r/out.mkv")
+
+
+def test_abort_removes_partial(tmp_path, remote):
+    sftp, _ = remote
+    up = upload.IncrementalUpload(str(tmp_path / "none.mkv"), "/r/x.mkv", interval=60)
+    up.start()
+    up.abort()
+    sftp.remove.assert_called_with("/r/x.mkv.partial")
+    sftp.posix_rename.assert_not_called()
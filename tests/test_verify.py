@@ -0,0 +1,89 @@
+import json
+import types
+from unittest import mock
+
+from tstomkv import verify
+
+SRCINFO = {
+    "streams": [
+        {"codec_type": "video", "avg_frame_rate": "25/1"},
+        {"codec_type": "audio"},
+        {"codec_type": "audio"},
+        {"codec_type": "subtitle"},
+    ],
+    "format": {"duration": "600"},
+}
+DSTINFO = {
+    "streams": [{"codec_type": "video"}, {"codec_type": "audio"}],
+    "format": {"duration": "600"},
+}
+
+
+def frames(timestamps):
+    out = {"frames": [{"best_effort_timestamp_time": str(t)} for t in timestamps]}
+    return types.SimpleNamespace(
+        returncode=0, stdout=json.dumps(out).encode(), stderr=b""
+    )
+
+
+def test_sampleWindows():
+    assert verify.sampleWindows(110, 3, 10) == [(0.0, 10), (49.5, 10), (99.0, 10)]
+    assert verify.sampleWindows(5, 2, 10) == [(0.0, 5), (0.0, 5)]
+    assert verify.sampleWindows(None) == []
+
+
+def test_frameRate():
+    assert verify.frameRate(SRCINFO) == 25
+    assert verify.frameRate({"streams": [{"codec_type": "video"}]}) is None
+
+
+def test_checkStreams():
+    assert verify.checkStreams(SRCINFO, DSTINFO) == ["no subtitle stream in the output"]
+
+
+def test_checkFrames():
+    good = [i / 25 for i in range(250)]
+    assert verify.checkFrames(good, 0, 10, 25) == []
+    short = good[:100]
+    assert "decoded 100 frames" in verify.checkFrames(short, 0, 10, 25)[0]
+    gappy = good[:100] + [t + 5 for t in good[100:]]
+    assert "gap" in verify.checkFrames(gappy, 0, 10, 25)[0]
+    backwards = good[:100] + good[50:]
+    assert "go back" in verify.checkFrames(backwards, 0, 10, 25)[0]
+
+
+def test_parseQuality():
+    text = (
+        "[Parsed_ssim_2 @ 0x1] SSIM Y:0.98 U:0.99 V:0.99 All:0.985 (18.2)\n"
+        "[Parsed_psnr_3 @ 0x2] PSNR y:40.1 u:44.0 v:44.2 average:41.35 min:30\n"
+    )
+    assert verify.parseQuality(text) == (0.985, 41.35)
+    assert verify.parseQuality("") == (None, None)
+
+
+def test_verifyOutput():
+    dstinfo = dict(DSTINFO, streams=DSTINFO["streams"] + [{"codec_type": "subtitle"}])
+    good = frames([100 + i / 25 for i in range(250)])
+    quality = types.SimpleNamespace(
+        returncode=0, stdout=b"", stderr=b"SSIM Y:0.9 All:0.95 (13)\n"
+    )
+
+    def run(cmd, capture_output=True):
+        return good if cmd[0] == "ffprobe" else quality
+
+    with (
+        mock.patch("tstomkv.verify.fileInfo", return_value=dstinfo),
+        mock.patch("tstomkv.verify.subprocess.run", side_effect=run),
+    ):
+        report = verify.verifyOutput("a.ts", "a.mkv", SRCINFO, quality=True)
+        assert report["ok"] and report["windows"] == 4
+        assert report["ssim"] == 0.95 and report["measured"] == 4
+        report = verify.verifyOutput(
+            "a.ts", "a.mkv", SRCINFO, quality=True, minssim=0.99
+        )
+        assert not report["ok"]
+        # no budget left, no quality windows
+        report = verify.verifyOutput(
+            "a.ts", "a.mkv", SRCINFO, quality=True, budget=-1
+        )
+        assert report["ok"] and report["measured"] == 0
@@ -0,0 +1,152 @@
+import sys
+import threading
+from unittest import mock
+
+import pytest
+
+from tstomkv import workers
+from tstomkv.config import WorkerSettings
+
+# stands in for ffmpeg: copies src to dst, writing -progress blocks
+FAKEFFMPEG = """
+import shutil, sys, time
+src, dst, stats = sys.argv[1:4]
+with open(stats, "w") as fp:
+    for n in range(3):
+        fp.write(f"out_time_us={n * 1000000}\\nprogress=continue\\n")
+        fp.flush()
+        time.sleep(0.05)
+    shutil.copyfile(src, dst)
+    fp.write("out_time_us=3000000\\nprogress=end\\n")
+"""
+
+# stands in for an ffmpeg that hangs without making any progress
+HANGINGFFMPEG = "import time; time.sleep(30)"
+
+
+def fakeCommand(script):
+    def command(src, dst, stats, x265params=None, profile=None):
+        return [sys.executable, "-c", script, src, dst, stats]
+
+    return command
+
+
+def localWorkers(tmp_path, n):
+    return [
+        workers.LocalWorker(f"w{i}", "local", workdir=str(tmp_path / f"w{i}"))
+        for i in range(n)
+    ]
+
+
+@pytest.fixture
+def recording(tmp_path):
+    src = tmp_path / "rec.ts"
+    src.write_bytes(b"transport stream")
+    return src
+
+
+def test_makeWorkers():
+    settings = (
+        WorkerSettings("a", "local", None, None, "/tmp/a", 2, None),
+        WorkerSettings("b", "b.lan", "me", "/k", "/tmp/b", 1, 8),
+    )
+    made = workers.makeWorkers(settings)
+    assert isinstance(made[0], workers.LocalWorker)
+    assert type(made[1]) is workers.Worker
+    assert made[1].cores == 8
+
+
+def test_coordinator_encodes_on_local_workers(tmp_path, recording):
+    coord = workers.Coordinator(localWorkers(tmp_path, 2), heartbeat=0.05)
+    dst = tmp_path / "rec.mkv"
+    with mock.patch("tstomkv.workers.transcodeCommand", fakeCommand(FAKEFFMPEG)):
+        assert coord.encode(str(recording), str(dst), duration=3)
+    assert dst.read_bytes() == b"transport stream"
+    assert coord.leases == {}
+    assert coord.free == {"w0": 1, "w1": 1}
+    # the worker tidies up after itself
+    assert list((tmp_path / "w0").iterdir()) == []
+
+
+def test_coordinator_shares_slots(tmp_path):
+    coord = workers.Coordinator(localWorkers(tmp_path, 2), heartbeat=0.05)
+    srcs = []
+    for n in range(4):
+        src = tmp_path / f"rec{n}.ts"
+        src.write_bytes(f"recording {n}".encode())
+        srcs.append(src)
+    with mock.patch("tstomkv.workers.transcodeCommand", fakeCommand(FAKEFFMPEG)):
+        threads = [
+            threading.Thread(
+                target=coord.encode, args=(str(src), str(src.with_suffix(".mkv")))
+            )
+            for src in srcs
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    for n, src in enumerate(srcs):
+        assert src.with_suffix(".mkv").read_bytes() == f"recording {n}".encode()
+
+
+def test_coordinator_keeps_same_named_jobs_apart(tmp_path):
+    worker = workers.LocalWorker("w0", "local", workdir=str(tmp_path / "w0"), slots=2)
+    coord = workers.Coordinator([worker], heartbeat=0.05)
+    srcs = []
+    for n in range(2):
+        (tmp_path / f"d{n}").mkdir()
+        src = tmp_path / f"d{n}" / "rec.ts"
+        src.write_bytes(f"recording {n}".encode())
+        srcs.append(src)
+    assert workers.jobName(srcs[0]) != workers.jobName(srcs[1])
+    with mock.patch("tstomkv.workers.transcodeCommand", fakeCommand(FAKEFFMPEG)):
+        threads = [
+            threading.Thread(
+                target=coord.encode, args=(str(src), str(src.with_suffix(".mkv")))
+            )
+            for src in srcs
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    for n, src in enumerate(srcs):
+        assert src.with_suffix(".mkv").read_bytes() == f"recording {n}".encode()
+
+
+def test_coordinator_takes_back_expired_lease(tmp_path, recording):
+    hang, good = localWorkers(tmp_path, 2)
+    coord = workers.Coordinator([hang, good], lease=1.0, heartbeat=0.05)
+    dst = tmp_path / "rec.mkv"
+
+    def command(src, dst, stats, x265params=None, profile=None):
+        script = HANGINGFFMPEG if str(tmp_path / "w0") in src else FAKEFFMPEG
+        return [sys.executable, "-c", script, src, dst, stats]
+
+    with mock.patch("tstomkv.workers.transcodeCommand", command):
+        assert coord.encode(str(recording), str(dst))
+    assert dst.exists()
+    # the worker that let its lease lapse is rested
+    assert coord.resting["w0"] > 0
+    assert "w1" not in coord.resting
+
+
+def test_coordinator_gives_up(tmp_path, recording):
+    coord = workers.Coordinator(localWorkers(tmp_path, 1), lease=0, heartbeat=0.01)
+    crash = "import sys; sys.exit(1)"
+    with mock.patch("tstomkv.workers.transcodeCommand", fakeCommand(crash)):
+        with pytest.raises(workers.WorkerError):
+            coord.encode(str(recording), str(tmp_path / "rec.mkv"))
+
+
+def test_coordinator_needs_workers():
+    with pytest.raises(workers.WorkerError):
+        workers.Coordinator([])
+
+
+def test_execute_returns_a_failure(tmp_path):
+    worker = localWorkers(tmp_path, 1)[0]
+    cmd = [sys.executable, "-c", "import sys; print('out'); sys.exit(2)"]
+    returncode, stdout, _ = worker.execute(cmd)
+    assert returncode == 2 and stdout.strip() == "out"